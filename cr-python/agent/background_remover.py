@@ -1,116 +1,175 @@
+import asyncio
 import logging
+import time
+from typing import Callable, List, Optional
 
 from livekit import rtc
 from livekit.rtc import VideoFrameEvent
 
-from loadimg import load_img
-
 import numpy as np
-from PIL import Image
 
-import spaces
+from control_room.toolkit import Config, load_config, loop_on, multi_track_queued_frame_looper
+from control_room.toolkit_draw import draw_on_frame
+from control_room.toolkit_batch import MicroBatcher
+from control_room.toolkit_metrics import MASKS_COMPUTED, MASKS_REUSED
+from control_room.toolkit_profile import PROFILER
+from control_room.toolkit_quality import QualityController, QualityKnob
 
-import torch
-from torchvision import transforms
+# torch, transformers and spaces are only imported by load_model(), which main() runs on a
+# thread while the room connects: importing this module stays cheap.
 
-from transformers import AutoModelForImageSegmentation
+WIDTH, HEIGHT = 1024, 768
+MAX_BATCH_SIZE = 4
 
-from control_room.toolkit import load_config, loop_on, first_track_queued_frame_looper
-from control_room.toolkit_draw import draw_on_frame, draw_red_dot
+# Trade quality for latency from config.json: "inference_size" is a fixed model
+# resolution or "auto" to let a QualityController pick one from measured frame time,
+# "inference_dtype" and "channels_last" pick the model's precision and memory format.
+INFERENCE_SIZES = (1024, 768, 512, 384, 256)
 
-logging.basicConfig(level=logging.INFO)
+# Set by load_model()
+backend = None  # InferenceBackend
+preprocess = None  # SegmentationPreprocessor
+mask_cache = None  # TemporalMaskCache
+_gpu_batch: Optional[Callable[[List[np.ndarray]], List[np.ndarray]]] = None
 
-# ensure LIVEKIT_URL, LIVEKIT_API_KEY, and LIVEKIT_API_SECRET are set
-loaded_config = load_config()
 
-WIDTH, HEIGHT = 1024, 768
+def is_adaptive(config: Config) -> bool:
+    return str(config.INFERENCE_SIZE) == "auto"
+
+
+def inference_sizes(config: Config) -> List[int]:
+    """Every input size the model may be run at with this config."""
+    return list(INFERENCE_SIZES) if is_adaptive(config) else [int(config.INFERENCE_SIZE)]
+
+
+def load_model(config: Config):
+    """Import torch, load BiRefNet on the configured inference backend and warm it up.
+
+    Blocking, takes seconds to minutes on a cold start: run it on a thread.
+    """
+    global backend, preprocess, mask_cache, _gpu_batch
+    start_time = time.perf_counter()
+
+    import spaces
+    import torch
+
+    from agent.inference_backend import create_backend
+    from agent.segmentation import SegmentationPreprocessor, TemporalMaskCache
+
+    torch.set_float32_matmul_precision(["high", "highest"][0])
+
+    # Replace CUDA-specific code with device-agnostic code
+    device = "cuda" if torch.cuda.is_available() and not config.QUANTIZATION else "cpu"
+    print("DEVICE: ", device)
+
+    # "torch": eager or TorchScript, on the GPU if there's one, "onnxruntime": exported model, CPU.
+    backend = create_backend(config, device)
+    sizes = [backend.fixed_size] if backend.fixed_size else inference_sizes(config)
+    print(f"INFERENCE: {backend.name} {sizes} {backend.dtype} channels_last={backend.channels_last}")
+
+    # Resize to the inference size, convert to tensor and normalize with ImageNet means and stds,
+    # straight from the numpy frames into a preallocated batch tensor.
+    preprocess = SegmentationPreprocessor(sizes[0], backend.device, backend.dtype, backend.channels_last)
+    _gpu_batch = spaces.GPU(_remove_background_batch)
+
+    warmup(sizes, int(config.WARMUP_FRAMES))
+
+    # Talking heads barely move, run BiRefNet on keyframes only and reuse their
+    # masks in between. keyframe_interval=1 runs the model on every frame.
+    # Created after the warmup, so no synthetic keyframe lingers in it.
+    mask_cache = TemporalMaskCache(keyframe_interval=5, diff_threshold=6.0, feather=5)
+    logging.info(f"🚀 background remover ready in {time.perf_counter() - start_time:.1f}s")
+
+
+def warmup(sizes: List[int], batches: int):
+    """Run a few synthetic batches per input size, at batch size 1 and MAX_BATCH_SIZE.
+
+    Pays for lazy CUDA context / cuDNN autotuning / allocator growth, and for tracing the
+    models missing from the cache, before the first participant's frame.
+    """
+    if batches <= 0:
+        return
+    start_time = time.perf_counter()
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 256, (HEIGHT, WIDTH, 3), dtype=np.uint8) for _ in range(MAX_BATCH_SIZE)]
+    for size in reversed(sizes):
+        preprocess.request_size(size)
+        for batch_size in (1, MAX_BATCH_SIZE):
+            for _ in range(batches):
+                _gpu_batch([frame.copy() for frame in frames[:batch_size]], [None] * batch_size)
+    preprocess.request_size(sizes[0])
+    logging.info(f"🔥 warmed up {sizes} x {batches} in {time.perf_counter() - start_time:.1f}s")
 
-torch.set_float32_matmul_precision(["high", "highest"][0])
-
-# Replace CUDA-specific code with device-agnostic code
-device = "cuda" if torch.cuda.is_available() else "cpu"
-print("DEVICE: ", device)
-birefnet = AutoModelForImageSegmentation.from_pretrained(
-    "ZhengPeng7/BiRefNet", trust_remote_code=True
-)
-birefnet.to(device)
-
-transform_image = transforms.Compose(
-    [
-        transforms.Resize((1024, 1024)),
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
-    ]
-)
-
-
-@spaces.GPU
-def remove_background(image: Image.Image) -> Image.Image:
-    # Store original image dimensions for later resizing
-    image_size = image.size
-
-    # Step 1: Prepare the image for the model
-    input_images = transform_image(image).unsqueeze(0).to(device)
-    # transform_image applies:
-    # - Resize to 1024x1024
-    # - Convert to tensor
-    # - Normalize with ImageNet means and stds
-    # unsqueeze adds batch dimension
-    # to(device) moves to GPU if available
-
-    # Step 2: Run the model
-    with torch.no_grad():  # Disable gradient calculation for inference
-        preds = birefnet(input_images)[-1].sigmoid().cpu()
-    pred = preds[0].squeeze()  # Remove batch dimension
-    
-    # Step 3: Convert prediction to PIL Image
-    pred_pil = transforms.ToPILImage()(pred)
-    
-    # Step 4: Resize mask back to original image size
-    mask = pred_pil.resize(image_size)
-
-    # Step 5: Apply mask as alpha channel
-
-    # Create a new black image with the same mode and size as the original image
-    black_background = Image.new("RGB", image_size, (0, 0, 0))
-
-    # Paste the original image onto the black background, using the mask as the transparency mask
-    black_background.paste(image.convert("RGB"), mask=mask)
-
-    return black_background  # Returns the resulting image with the background blacked out
-    # image.putalpha(mask)  # This makes background transparent
-    #
-    # return image #
-    # return mask.convert("RGB")  # Returns the mask as a PIL Image
+
+def request_inference_size(size: int):
+    """QualityKnob apply, ignored by models exported for a single input size."""
+    if backend.fixed_size is None:
+        preprocess.request_size(size)
+
+
+def _remove_background_batch(frames: List[np.ndarray], tracks: List[Optional[str]]) -> List[np.ndarray]:
+    from agent.segmentation import composite_mask, masks_to_numpy
+
+    # During warmup every frame is a keyframe.
+    if mask_cache is not None:
+        with PROFILER.span("mask_cache"):
+            probes = [mask_cache.probe(frame) for frame in frames]
+            masks = [mask_cache.lookup(probe, track) for probe, track in zip(probes, tracks)]
+        for track, mask in zip(tracks, masks):
+            (MASKS_REUSED if mask is not None else MASKS_COMPUTED).labels(track or "").inc()
+    else:
+        probes, masks = [None] * len(frames), [None] * len(frames)
+    keyframes = [i for i, mask in enumerate(masks) if mask is None]
+
+    if keyframes:
+        # Step 1: Prepare the keyframes for the model
+        with PROFILER.span("model_preprocess"):
+            input_images = preprocess([frames[i] for i in keyframes])
+
+        # Step 2: Run the model
+        with PROFILER.span("model_inference"):
+            preds = backend(input_images)
+
+        # Masks stay at inference resolution, composite_mask upsamples them to frame size.
+        with PROFILER.span("model_postprocess"):
+            for i, mask in zip(keyframes, masks_to_numpy(preds)):
+                if mask_cache is not None:
+                    mask_cache.store(probes[i], mask, tracks[i])
+                masks[i] = mask
+
+    if mask_cache is not None and (mask_cache.keyframes + mask_cache.reused) % 300 < len(frames):
+        logging.info(f"🎭 mask reuse ratio {mask_cache.reuse_ratio:.2f}")
+
+    # Step 3: Scatter each mask back onto its own frame, resized to the frame's size
+    with PROFILER.span("composite"):
+        return [composite_mask(frame, mask) for frame, mask in zip(frames, masks)]
+
+
+def remove_background_batch(
+        frames: List[np.ndarray],
+        tracks: Optional[List[Optional[str]]] = None,
+) -> List[np.ndarray]:
+    """Black out the background of several RGB frames with a single BiRefNet call.
+
+    Frames are modified in-place and returned, they may differ in size.
+    Frames close enough to a recent keyframe of their track (tracks: each frame's input
+    track sid) reuse its mask and skip the model.
+    load_model() must have run.
+    """
+    return _gpu_batch(frames, tracks or [None] * len(frames))
+
+
+def remove_background(frame: np.ndarray) -> np.ndarray:
+    return remove_background_batch([frame])[0]
+
+
+def batch_frame_processor(input_frames: List[np.ndarray], tracks: List[Optional[str]]) -> List[np.ndarray]:
+    """frame_processor for a batch of frames, possibly coming from several tracks."""
+    return remove_background_batch(input_frames, tracks)
 
 
 def frame_processor(input_frame: np.ndarray) -> np.ndarray:
-    # Debug input shape and type
-    input_shape = input_frame.shape
-    input_dtype = input_frame.dtype
-    print(f"Input frame: shape={input_shape}, dtype={input_dtype}")
-
-    # Convert numpy array to PIL Image
-    pil_image: Image.Image = Image.fromarray(input_frame)
-    
-    # Get mask from background removal
-    mask: Image.Image = remove_background(pil_image)
-
-    # Convert back to numpy array for output
-    output_frame: np.ndarray = np.array(mask, dtype=np.uint8)
-
-    # Debug input shape and type
-    output_shape = output_frame.shape
-    output_dtype = output_frame.dtype
-    print(f"Output frame: shape={output_shape}, dtype={output_dtype}")
-    
-    # Debug: Show output array in separate window
-    # import cv2cv2
-    # cv2.imshow("5. Output NumPy Array", cv2.cvtColor(output_frame, cv2.COLOR_RGB2BGR))
-    # cv2.waitKey(1)  # Refresh window, wait 1ms
-    # print("5")
-    
-    return output_frame
+    return remove_background(input_frame)
 
 
 async def handle_frame_event(frame_event: VideoFrameEvent, output_source: rtc.VideoSource):
@@ -119,12 +178,35 @@ async def handle_frame_event(frame_event: VideoFrameEvent, output_source: rtc.Vi
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    # ensure LIVEKIT_URL, LIVEKIT_API_KEY, and LIVEKIT_API_SECRET are set
+    loaded_config = load_config()
+
     async def main(room: rtc.Room):
-        return await first_track_queued_frame_looper(
+        # Imports, model loading and warmup run on a thread while the room connects,
+        # output tracks get published once they're done.
+        model_ready = asyncio.get_running_loop().run_in_executor(None, load_model, loaded_config)
+
+        # torch releases the GIL during inference, so running batches on the
+        # batcher's worker thread keeps the event loop (room callbacks, producer) responsive.
+        # Every participant's track shares the batcher, so their frames get batched together.
+        batcher = MicroBatcher(
+            batch_frame_processor, max_batch_size=MAX_BATCH_SIZE, max_latency=0.010, with_tracks=True
+        )
+
+        quality = None
+        if is_adaptive(loaded_config):
+            size_knob = QualityKnob("inference_size", INFERENCE_SIZES, request_inference_size)
+            quality = QualityController(target_fps=15, knobs=[size_knob], max_skip=2)
+
+        return await multi_track_queued_frame_looper(
             room=room,
             lk_id="bkg_remover",
             lk_name="Background Remover",
-            handle_frame=handle_frame_event)
+            executor=batcher,
+            quality=quality,
+            ready=model_ready)
 
 
     loop_on(main)
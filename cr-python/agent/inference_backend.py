@@ -0,0 +1,246 @@
+import logging
+import os
+import time
+from typing import Optional, Sequence
+
+import torch
+
+from agent.model_loader import BIREFNET_MODEL_ID, TracedModelCache, load_pretrained
+from agent.quantization import QUANTIZATION_DYNAMIC, check_mode, quantize_onnx, quantize_torch_dynamic
+
+BACKEND_TORCH = "torch"
+BACKEND_ONNXRUNTIME = "onnxruntime"
+BACKENDS = (BACKEND_TORCH, BACKEND_ONNXRUNTIME)
+
+# onnxruntime GraphOptimizationLevel by config name, from none to every fusion / layout change.
+GRAPH_OPTIMIZATION_LEVELS = ("disable", "basic", "extended", "all")
+
+
+class InferenceBackend:
+    """Runs the segmentation model on a preprocessed NCHW batch, returns (N, 1, S, S) sigmoid masks.
+
+    The SegmentationPreprocessor feeding a backend is built from its device, dtype and
+    channels_last, fixed_size is set when the model only accepts one input resolution.
+    """
+    name = ""
+    device = "cpu"
+    dtype = torch.float32
+    channels_last = False
+    fixed_size: Optional[int] = None
+
+    def __call__(self, batch: torch.Tensor) -> torch.Tensor:
+        raise NotImplementedError
+
+
+class TorchBackend(InferenceBackend):
+    name = BACKEND_TORCH
+
+    def __init__(
+            self,
+            device: str,
+            dtype: torch.dtype,
+            channels_last: bool,
+            cache_dir: Optional[str] = None,
+            intra_op_threads: int = 0,
+            inter_op_threads: int = 0,
+            quantization: Optional[str] = None,
+    ):
+        """The PyTorch model, eager or as cached TorchScript traces (see TracedModelCache).
+
+        Args:
+            device, dtype, channels_last: where and how the model runs
+            cache_dir: keep TorchScript traces there, None runs the eager model
+            intra_op_threads: threads a single op may use, 0 keeps torch's default (one per core)
+            inter_op_threads: threads running independent ops concurrently, 0 keeps torch's default
+            quantization: None, or QUANTIZATION_DYNAMIC for int8 Linear layers, CPU and float32 only,
+                          static quantization needs the onnxruntime backend
+        """
+        if quantization is not None:
+            check_mode(quantization)
+            if quantization != QUANTIZATION_DYNAMIC:
+                raise ValueError(f"the torch backend only supports '{QUANTIZATION_DYNAMIC}' quantization")
+            if device != "cpu" or dtype != torch.float32:
+                raise ValueError("torch dynamic quantization runs on the cpu, in float32")
+        self.device = device
+        self.dtype = dtype
+        self.channels_last = channels_last
+        _set_torch_threads(intra_op_threads, inter_op_threads)
+
+        def load_eager():
+            model = load_pretrained(BIREFNET_MODEL_ID, device, dtype, channels_last)
+            return quantize_torch_dynamic(model) if quantization else model
+
+        if cache_dir:
+            variant = f"int8-{quantization}" if quantization else ""
+            self.model = TracedModelCache(
+                cache_dir, BIREFNET_MODEL_ID, device, dtype, channels_last, load_eager, variant
+            )
+        else:
+            self.model = load_eager()
+
+    def __call__(self, batch: torch.Tensor) -> torch.Tensor:
+        with torch.inference_mode():
+            return self.model(batch)[-1].sigmoid()
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    name = BACKEND_ONNXRUNTIME
+
+    def __init__(
+            self,
+            model_path: Optional[str] = None,
+            cache_dir: Optional[str] = None,
+            intra_op_threads: int = 0,
+            inter_op_threads: int = 0,
+            graph_optimization: str = "all",
+            providers: Optional[Sequence[str]] = None,
+            quantization: Optional[str] = None,
+            calibration_dir: Optional[str] = None,
+            calibration_frames: int = 32,
+            calibration_size: int = 1024,
+    ):
+        """The model exported to ONNX, on ONNX Runtime's CPU engine (or another execution provider).
+
+        Without model_path, BiRefNet is exported from PyTorch into cache_dir on first start,
+        with dynamic batch and spatial axes. BiRefNet's deformable convolutions have no
+        standard ONNX op in some torch versions, if the export fails, export it with a
+        deform_conv2d symbolic offline and point model_path (config "onnx_model") at the file.
+
+        The graph, optimized at graph_optimization, is saved next to the model, later starts
+        skip the optimization passes.
+
+        Args:
+            model_path: an exported .onnx file, float32 NCHW input, last output is the mask logits
+            cache_dir: where exports and optimized graphs are kept
+            intra_op_threads: threads a single op may use, 0 lets onnxruntime use one per core
+            inter_op_threads: threads running independent graph branches, 0 or 1 runs them in sequence
+            graph_optimization: one of GRAPH_OPTIMIZATION_LEVELS
+            providers: execution providers by preference, e.g. ["OpenVINOExecutionProvider"],
+                       unavailable ones are skipped, CPUExecutionProvider is always last
+            quantization: None, QUANTIZATION_DYNAMIC or QUANTIZATION_STATIC, the int8 model is
+                          created next to the float one on first start
+            calibration_dir: sample images / videos for static quantization
+            calibration_frames: how many sample frames to calibrate on
+            calibration_size: input size frames are calibrated at
+        """
+        import onnxruntime as ort
+
+        if graph_optimization not in GRAPH_OPTIMIZATION_LEVELS:
+            raise ValueError(
+                f"unknown graph optimization '{graph_optimization}', expected one of {GRAPH_OPTIMIZATION_LEVELS}"
+            )
+        if model_path is None:
+            if not cache_dir:
+                raise ValueError("the onnxruntime backend needs either onnx_model or model_cache_dir")
+            model_path = export_birefnet_onnx(cache_dir)
+        if quantization is not None:
+            model_path = quantize_onnx(model_path, quantization, calibration_dir, calibration_frames, calibration_size)
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = (
+            ort.ExecutionMode.ORT_PARALLEL if inter_op_threads > 1 else ort.ExecutionMode.ORT_SEQUENTIAL
+        )
+        options.graph_optimization_level = {
+            "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+            "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+            "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        }[graph_optimization]
+
+        optimized_path = f"{os.path.splitext(model_path)[0]}.{graph_optimization}.ort.onnx"
+        if os.path.exists(optimized_path):
+            # Already optimized, don't pay for the passes again.
+            model_path = optimized_path
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        elif os.access(os.path.dirname(os.path.abspath(model_path)), os.W_OK):
+            options.optimized_model_filepath = optimized_path
+
+        available = ort.get_available_providers()
+        chosen = [p for p in (providers or []) if p in available and p != "CPUExecutionProvider"]
+        chosen.append("CPUExecutionProvider")
+
+        start_time = time.perf_counter()
+        self.session = ort.InferenceSession(model_path, options, providers=chosen)
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_name = self.session.get_outputs()[-1].name
+        height, width = self.session.get_inputs()[0].shape[2:]
+        self.fixed_size = height if isinstance(height, int) and height == width else None
+        logging.info(
+            f"📦 onnxruntime {model_path} on {self.session.get_providers()} in {time.perf_counter() - start_time:.1f}s,"
+            f" threads={intra_op_threads}/{inter_op_threads} optimization={graph_optimization}"
+            + (f" fixed size {self.fixed_size}" if self.fixed_size else "")
+        )
+
+    def __call__(self, batch: torch.Tensor) -> torch.Tensor:
+        logits = self.session.run([self.output_name], {self.input_name: batch.numpy()})[0]
+        return torch.from_numpy(logits).sigmoid_()
+
+
+def export_birefnet_onnx(cache_dir: str, size: int = 1024, opset: int = 17) -> str:
+    """Export BiRefNet to cache_dir once, float32 with dynamic batch / height / width, returns the path."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{BIREFNET_MODEL_ID.replace('/', '--')}-opset{opset}.onnx")
+    if os.path.exists(path):
+        return path
+
+    start_time = time.perf_counter()
+    model = load_pretrained(BIREFNET_MODEL_ID, "cpu", torch.float32, False)
+    example = torch.zeros((1, 3, size, size))
+    partial = f"{path}.{os.getpid()}.partial"
+    with torch.no_grad():
+        torch.onnx.export(
+            model, example, partial,
+            input_names=["input"],
+            dynamic_axes={"input": {0: "batch", 2: "height", 3: "width"}},
+            opset_version=opset,
+        )
+    os.replace(partial, path)
+    logging.info(f"📦 exported {BIREFNET_MODEL_ID} to {path} in {time.perf_counter() - start_time:.1f}s")
+    return path
+
+
+def create_backend(config, device: str) -> InferenceBackend:
+    """The backend config.json's "inference_backend" asks for, with its threads / optimization settings."""
+    backend = config.INFERENCE_BACKEND
+    if backend == BACKEND_TORCH:
+        return TorchBackend(
+            device,
+            getattr(torch, config.INFERENCE_DTYPE),
+            bool(config.CHANNELS_LAST),
+            config.MODEL_CACHE_DIR,
+            int(config.INTRA_OP_THREADS),
+            int(config.INTER_OP_THREADS),
+            config.QUANTIZATION,
+        )
+    if backend == BACKEND_ONNXRUNTIME:
+        return OnnxRuntimeBackend(
+            config.ONNX_MODEL,
+            config.MODEL_CACHE_DIR,
+            int(config.INTRA_OP_THREADS),
+            int(config.INTER_OP_THREADS),
+            config.GRAPH_OPTIMIZATION,
+            config.ONNX_PROVIDERS,
+            config.QUANTIZATION,
+            config.CALIBRATION_DIR,
+            int(config.CALIBRATION_FRAMES),
+            _calibration_size(config),
+        )
+    raise ValueError(f"unknown inference backend '{backend}', expected one of {BACKENDS}")
+
+
+def _calibration_size(config) -> int:
+    size = str(config.INFERENCE_SIZE)
+    return 1024 if size == "auto" else int(size)
+
+
+def _set_torch_threads(intra_op_threads: int, inter_op_threads: int):
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads > 0:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            # Only settable before torch's first parallel work.
+            logging.warning(f"⚠️ can't set inter-op threads: {e}")
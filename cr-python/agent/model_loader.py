@@ -0,0 +1,119 @@
+import logging
+import os
+import time
+from typing import Callable, Dict, Optional
+
+import torch
+
+from agent.segmentation import prepare_model
+
+BIREFNET_MODEL_ID = "ZhengPeng7/BiRefNet"
+
+
+def load_pretrained(
+        model_id: str,
+        device: str,
+        dtype: torch.dtype,
+        channels_last: bool,
+) -> torch.nn.Module:
+    """from_pretrained + prepare_model, transformers is only imported when this runs."""
+    from transformers import AutoModelForImageSegmentation
+
+    start_time = time.perf_counter()
+    model = AutoModelForImageSegmentation.from_pretrained(model_id, trust_remote_code=True)
+    prepare_model(model, device, dtype, channels_last)
+    logging.info(f"📦 loaded {model_id} in {time.perf_counter() - start_time:.1f}s")
+    return model
+
+
+class TracedModelCache:
+    def __init__(
+            self,
+            cache_dir: str,
+            model_id: str,
+            device: str,
+            dtype: torch.dtype,
+            channels_last: bool,
+            load_eager: Callable[[], torch.nn.Module],
+            variant: str = "",
+    ):
+        """TorchScript versions of a model, one per square input size, kept on local disk.
+
+        The first start traces the eager model, freezes and optimizes the trace for inference
+        and saves it, later starts load it with torch.jit.load, skipping from_pretrained,
+        remote code and the trace altogether. The eager model is only loaded when a trace is
+        missing, or if a trace fails at run time, in which case the eager model takes over.
+
+        Files are keyed by model, variant, size, dtype, device, memory format and torch version,
+        delete the directory to force a re-trace, e.g. after a model update.
+
+        Args:
+            cache_dir: where traces are stored, created if missing
+            model_id: for file names and logs
+            device, dtype, channels_last: what the traces are specialized for
+            load_eager: loads the prepared eager model
+            variant: what load_eager does to the pretrained model, e.g. "int8-dynamic"
+        """
+        self.cache_dir = cache_dir
+        self.model_id = model_id
+        self.device = device
+        self.dtype = dtype
+        self.channels_last = channels_last
+        self._load_eager = load_eager
+        self.variant = variant
+        self._eager: Optional[torch.nn.Module] = None
+        self._traced: Dict[int, torch.jit.ScriptModule] = {}
+        self._fallback = False
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, size: int) -> str:
+        name = self.model_id.replace("/", "--") + (f"-{self.variant}" if self.variant else "")
+        dtype = str(self.dtype).replace("torch.", "")
+        memory_format = "cl" if self.channels_last else "cf"
+        device = torch.device(self.device).type
+        return os.path.join(
+            self.cache_dir, f"{name}-{size}-{dtype}-{device}-{memory_format}-torch{torch.__version__}.pt"
+        )
+
+    def eager(self) -> torch.nn.Module:
+        if self._eager is None:
+            self._eager = self._load_eager()
+        return self._eager
+
+    def get(self, size: int) -> torch.jit.ScriptModule:
+        """The traced model for size x size inputs, from memory, disk, or traced now."""
+        traced = self._traced.get(size)
+        if traced is not None:
+            return traced
+
+        path = self.path(size)
+        start_time = time.perf_counter()
+        if os.path.exists(path):
+            traced = torch.jit.load(path, map_location=self.device)
+            logging.info(f"📦 loaded traced {self.model_id} [{size}] in {time.perf_counter() - start_time:.1f}s")
+        else:
+            traced = self._trace(size)
+            # Write then rename, a crash mid-save must not leave a truncated trace behind.
+            partial = f"{path}.{os.getpid()}.partial"
+            torch.jit.save(traced, partial)
+            os.replace(partial, path)
+            logging.info(f"📦 traced {self.model_id} [{size}] in {time.perf_counter() - start_time:.1f}s -> {path}")
+        self._traced[size] = traced
+        return traced
+
+    def _trace(self, size: int) -> torch.jit.ScriptModule:
+        memory_format = torch.channels_last if self.channels_last else torch.contiguous_format
+        example = torch.zeros((1, 3, size, size), device=self.device, dtype=self.dtype)
+        example = example.contiguous(memory_format=memory_format)
+        with torch.no_grad():
+            traced = torch.jit.trace(self.eager(), example, strict=False, check_trace=False)
+        return torch.jit.optimize_for_inference(traced.eval())
+
+    def __call__(self, batch: torch.Tensor):
+        if not self._fallback:
+            try:
+                return self.get(batch.shape[-1])(batch)
+            except Exception as e:
+                logging.warning(f"⚠️ traced {self.model_id} failed ({e}), falling back to the eager model")
+                self._fallback = True
+        return self.eager()(batch)
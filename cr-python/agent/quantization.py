@@ -0,0 +1,176 @@
+import logging
+import os
+import time
+from typing import Callable, Iterator, List, Optional
+
+import cv2
+import numpy as np
+import torch
+
+QUANTIZATION_DYNAMIC = "dynamic"  # int8 weights, activations quantized on the fly, no calibration
+QUANTIZATION_STATIC = "static"  # int8 weights and activations, ranges calibrated on sample frames
+QUANTIZATION_MODES = (QUANTIZATION_DYNAMIC, QUANTIZATION_STATIC)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".mkv", ".webm", ".avi")
+
+
+def check_mode(mode: str):
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"unknown quantization '{mode}', expected one of {QUANTIZATION_MODES}")
+
+
+def quantize_torch_dynamic(model: torch.nn.Module) -> torch.nn.Module:
+    """int8 dynamic quantization of the model's Linear layers, most of BiRefNet's Swin backbone, CPU only."""
+    start_time = time.perf_counter()
+    quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    logging.info(f"🗜 quantized (dynamic int8) in {time.perf_counter() - start_time:.1f}s")
+    return quantized
+
+
+def sample_frames(path: str, count: int) -> Iterator[np.ndarray]:
+    """Up to count RGB frames from the images and videos in directory path, or a single video file.
+
+    Videos contribute frames spread evenly over their length, so a few recordings cover
+    varied scenes without decoding every frame.
+    """
+    if os.path.isdir(path):
+        files = sorted(
+            os.path.join(path, name) for name in os.listdir(path)
+            if name.lower().endswith(IMAGE_EXTENSIONS + VIDEO_EXTENSIONS)
+        )
+    else:
+        files = [path]
+    if not files:
+        raise ValueError(f"no images or videos in {path}")
+
+    images = [f for f in files if f.lower().endswith(IMAGE_EXTENSIONS)]
+    videos = [f for f in files if f.lower().endswith(VIDEO_EXTENSIONS)]
+    emitted = 0
+    for file in images:
+        if emitted >= count:
+            return
+        bgr = cv2.imread(file, cv2.IMREAD_COLOR)
+        if bgr is None:
+            logging.warning(f"⚠️ can't read {file}")
+            continue
+        emitted += 1
+        yield cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+    for i, file in enumerate(videos):
+        # Share what's left evenly between the remaining videos.
+        per_video = (count - emitted) // (len(videos) - i)
+        capture = cv2.VideoCapture(file)
+        try:
+            length = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            for index in np.linspace(0, max(length - 1, 0), per_video).astype(int):
+                capture.set(cv2.CAP_PROP_POS_FRAMES, int(index))
+                ok, bgr = capture.read()
+                if not ok:
+                    break
+                emitted += 1
+                yield cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+        finally:
+            capture.release()
+
+
+class FrameCalibrationReader:
+    def __init__(self, input_name: str, frames: Iterator[np.ndarray], preprocess: Callable[[List[np.ndarray]], torch.Tensor]):
+        """onnxruntime.quantization CalibrationDataReader, feeding preprocessed sample frames one at a time.
+
+        Preprocessed inputs are kept as they're read, rewind() replays them without decoding
+        or preprocessing the frames again.
+
+        Args:
+            input_name: the model's input
+            frames: RGB sample frames
+            preprocess: turns a list of frames into the model's float32 NCHW batch
+        """
+        self.input_name = input_name
+        self.frames = frames
+        self.preprocess = preprocess
+        self.inputs: List[np.ndarray] = []
+        self.index = 0
+
+    @property
+    def count(self) -> int:
+        return len(self.inputs)
+
+    def get_next(self) -> Optional[dict]:
+        if self.index == len(self.inputs):
+            frame = next(self.frames, None)
+            if frame is None:
+                return None
+            # .numpy() shares the preprocessor's reused buffer, keep a copy.
+            self.inputs.append(self.preprocess([frame]).numpy().copy())
+        self.index += 1
+        return {self.input_name: self.inputs[self.index - 1]}
+
+    def rewind(self):
+        self.index = 0
+
+
+def quantize_onnx(
+        model_path: str,
+        mode: str,
+        calibration_dir: Optional[str] = None,
+        calibration_frames: int = 32,
+        calibration_size: int = 1024,
+) -> str:
+    """int8 version of an ONNX model, created next to it on first use, returns its path.
+
+    Static quantization calibrates activation ranges on calibration_frames frames from
+    calibration_dir, preprocessed at calibration_size, and uses the QDQ format, which
+    onnxruntime's CPU engine fuses into int8 kernels.
+    """
+    check_mode(mode)
+    path = f"{os.path.splitext(model_path)[0]}.int8-{mode}.onnx"
+    if os.path.exists(path):
+        return path
+
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_dynamic, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    start_time = time.perf_counter()
+    partial = f"{path}.{os.getpid()}.partial"
+    prepared = f"{os.path.splitext(model_path)[0]}.{os.getpid()}.preprocessed.onnx"
+    try:
+        # Shape inference + graph cleanup, recommended before quantizing.
+        quant_pre_process(model_path, prepared, skip_symbolic_shape=True)
+        if mode == QUANTIZATION_DYNAMIC:
+            quantize_dynamic(prepared, partial, weight_type=QuantType.QInt8)
+        else:
+            if not calibration_dir:
+                raise ValueError("static quantization needs sample frames, set calibration_dir")
+            import onnx
+
+            from agent.segmentation import SegmentationPreprocessor
+
+            input_name = onnx.load(prepared, load_external_data=False).graph.input[0].name
+            reader = FrameCalibrationReader(
+                input_name,
+                sample_frames(calibration_dir, calibration_frames),
+                SegmentationPreprocessor(calibration_size),
+            )
+            quantize_static(
+                prepared, partial, reader,
+                quant_format=QuantFormat.QDQ,
+                per_channel=True,
+                activation_type=QuantType.QUInt8,
+                weight_type=QuantType.QInt8,
+            )
+            logging.info(f"🗜 calibrated on {reader.count} frames from {calibration_dir}")
+        os.replace(partial, path)
+    finally:
+        for leftover in (prepared, partial):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    logging.info(f"🗜 quantized ({mode} int8) {model_path} in {time.perf_counter() - start_time:.1f}s -> {path}")
+    return path
+
+
+def mask_iou(a: np.ndarray, b: np.ndarray, threshold: float = 0.5) -> float:
+    """Intersection over union of two probability masks, binarized at threshold, 1.0 when both are empty."""
+    a, b = a >= threshold, b >= threshold
+    union = np.count_nonzero(a | b)
+    return np.count_nonzero(a & b) / union if union else 1.0
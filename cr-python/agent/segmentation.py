@@ -0,0 +1,217 @@
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+import torch
+from numpy import ndarray
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+class SegmentationPreprocessor:
+    def __init__(
+            self,
+            size: int = 1024,
+            device: str = "cpu",
+            dtype: torch.dtype = torch.float32,
+            channels_last: bool = False,
+    ):
+        """Turns RGB uint8 frames into a normalized NCHW batch, without PIL.
+
+        Frames are resized with cv2 into preallocated uint8 buffers, then converted and
+        normalized into a preallocated float tensor with a single fused multiply-add:
+        (x / 255 - mean) / std == x * (1 / (255 * std)) + (-mean / std)
+
+        Buffers are reused between calls, so one instance must not be called concurrently.
+
+        Args:
+            size: square model input resolution, see request_size()
+            device: where the returned batch lives
+            dtype: dtype of the returned batch, should match the model's
+            channels_last: return the batch in channels last memory format
+        """
+        self.device = device
+        self.dtype = dtype
+        self.channels_last = channels_last
+        self._scale = torch.tensor([1.0 / (255.0 * s) for s in IMAGENET_STD]).view(3, 1, 1)
+        self._bias = torch.tensor([-m / s for m, s in zip(IMAGENET_MEAN, IMAGENET_STD)]).view(3, 1, 1)
+        self._resized: List[ndarray] = []
+        self._batches: Dict[int, torch.Tensor] = {}
+        self._size = size
+        self._requested_size = size
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def request_size(self, size: int):
+        """Switch resolution from the next call on, safe to call from another thread."""
+        self._requested_size = size
+
+    def _apply_requested_size(self):
+        size = self._requested_size
+        if size != self._size:
+            self._size = size
+            self._resized.clear()
+            self._batches.clear()
+
+    def _batch(self, batch_size: int) -> torch.Tensor:
+        batch = self._batches.get(batch_size)
+        if batch is None:
+            batch = torch.empty((batch_size, 3, self.size, self.size), dtype=torch.float32)
+            self._batches[batch_size] = batch
+        while len(self._resized) < batch_size:
+            self._resized.append(np.empty((self.size, self.size, 3), dtype=np.uint8))
+        return batch
+
+    def __call__(self, frames: List[ndarray]) -> torch.Tensor:
+        self._apply_requested_size()
+        batch = self._batch(len(frames))
+        for i, frame in enumerate(frames):
+            resized = cv2.resize(
+                frame, (self.size, self.size), dst=self._resized[i], interpolation=cv2.INTER_LINEAR
+            )
+            # HWC uint8 view -> CHW float, then the fused normalize, in-place.
+            batch[i].copy_(torch.from_numpy(resized).permute(2, 0, 1))
+            torch.addcmul(self._bias, batch[i], self._scale, out=batch[i])
+
+        memory_format = torch.channels_last if self.channels_last else torch.contiguous_format
+        return batch.to(self.device, self.dtype, non_blocking=True, memory_format=memory_format)
+
+
+def prepare_model(model: torch.nn.Module, device: str, dtype: torch.dtype, channels_last: bool) -> torch.nn.Module:
+    """Move model to device, in eval mode, with the dtype / memory format the preprocessor feeds it."""
+    model.eval()
+    model.to(device, dtype)
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    return model
+
+
+def masks_to_numpy(preds: torch.Tensor) -> ndarray:
+    """(N, 1, S, S) sigmoid model output -> (N, S, S) float32 numpy masks in [0, 1]."""
+    return preds.squeeze(1).float().cpu().numpy()
+
+
+def composite_mask(frame: ndarray, mask: ndarray) -> ndarray:
+    """Black out frame's background in-place, weighting each pixel by the mask.
+
+    Args:
+        frame: (H, W, 3) uint8 RGB frame, modified in-place
+        mask: (h, w) float32 foreground probability, any resolution
+
+    Returns:
+        ndarray: frame
+    """
+    height, width = frame.shape[:2]
+    if mask.shape != (height, width):
+        mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_LINEAR)
+    # One pass over the frame, computed in float chunks and cast back into the uint8 frame.
+    np.multiply(frame, mask[..., None], out=frame, casting="unsafe")
+    return frame
+
+
+class _CachedMask:
+    def __init__(self, probe: ndarray, mask: ndarray, track: Optional[str] = None):
+        self.probe = probe
+        self.mask = mask
+        self.track = track
+        self.age = 0  # frames served since the keyframe
+
+
+class TemporalMaskCache:
+    def __init__(
+            self,
+            keyframe_interval: int = 5,
+            diff_threshold: float = 6.0,
+            feather: int = 0,
+            warp: bool = False,
+            probe_size: int = 64,
+            max_entries: int = 8,
+    ):
+        """Reuse the last segmentation mask while the scene barely changes.
+
+        Each frame is reduced to a tiny grayscale probe. A frame reuses a cached mask when
+        the mean absolute difference between its probe and the keyframe's probe is below
+        diff_threshold, and the mask has served fewer than keyframe_interval frames. Otherwise
+        the caller runs the model and stores the new mask, making the frame a keyframe.
+
+        Entries belong to the track their keyframe came from, a frame only reuses masks of its
+        own track: two participants in similar rooms must not swap masks. Frames of unknown
+        tracks (track=None) share their entries.
+
+        Not thread safe, call it from the single thread running the model.
+
+        Args:
+            keyframe_interval: run the model at least every N frames, 1 disables reuse
+            diff_threshold: probe mean absolute difference (0-255) forcing a new keyframe
+            feather: Gaussian blur kernel applied to reused masks to soften their edges, 0 for none
+            warp: shift reused masks by the probe's global translation (phase correlation)
+            probe_size: probe resolution
+            max_entries: cached keyframes, least recently used are evicted
+        """
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.diff_threshold = diff_threshold
+        self.feather = feather | 1 if feather else 0  # kernel sizes must be odd
+        self.warp = warp
+        self.probe_size = probe_size
+        self.max_entries = max_entries
+        self._entries: List[_CachedMask] = []
+
+        self.keyframes = 0
+        self.reused = 0
+
+    @property
+    def reuse_ratio(self) -> float:
+        total = self.keyframes + self.reused
+        return self.reused / total if total else 0.0
+
+    def probe(self, frame: ndarray) -> ndarray:
+        small = cv2.resize(frame, (self.probe_size, self.probe_size), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_RGB2GRAY).astype(np.float32)
+
+    def lookup(self, probe: ndarray, track: Optional[str] = None) -> Optional[ndarray]:
+        """Returns a mask to reuse for the frame behind probe, or None when a keyframe is due."""
+        best, best_diff = None, self.diff_threshold
+        for entry in self._entries:
+            if entry.track != track:
+                continue
+            diff = float(cv2.norm(probe, entry.probe, cv2.NORM_L1)) / probe.size
+            if diff < best_diff:
+                best, best_diff = entry, diff
+
+        if best is None or best.age + 1 >= self.keyframe_interval:
+            return None
+
+        best.age += 1
+        self._entries.remove(best)
+        self._entries.append(best)
+        self.reused += 1
+
+        mask = best.mask
+        if self.warp:
+            (dx, dy), _ = cv2.phaseCorrelate(best.probe, probe)
+            height, width = mask.shape
+            shift = np.float32([[1, 0, dx * width / self.probe_size], [0, 1, dy * height / self.probe_size]])
+            mask = cv2.warpAffine(mask, shift, (width, height), borderMode=cv2.BORDER_REPLICATE)
+        if self.feather:
+            mask = cv2.GaussianBlur(mask, (self.feather, self.feather), 0)
+        return mask
+
+    def store(self, probe: ndarray, mask: ndarray, track: Optional[str] = None):
+        """Record a freshly computed keyframe mask for track."""
+        self.keyframes += 1
+        # Replace the keyframe this frame drifted away from, if any.
+        nearest, nearest_diff = None, 4 * self.diff_threshold
+        for entry in self._entries:
+            if entry.track != track:
+                continue
+            diff = float(cv2.norm(probe, entry.probe, cv2.NORM_L1)) / probe.size
+            if diff < nearest_diff:
+                nearest, nearest_diff = entry, diff
+        if nearest is not None:
+            self._entries.remove(nearest)
+        self._entries.append(_CachedMask(probe, mask, track))
+        if len(self._entries) > self.max_entries:
+            self._entries.pop(0)
@@ -0,0 +1,314 @@
+"""
+Offline frame pipeline benchmark, no LiveKit room needed.
+
+Plays generated frames, or a video file, through the same producer / consumer /
+draw_on_frame path the agents use, into a fake VideoSource, and reports fps,
+latency percentiles, drop rate and peak RSS per block and resolution.
+
+Each case runs in its own process, so peak RSS is measured per case. Worker pools are
+warmed up before the clock starts, and input frames the harness emitted late are
+reported apart from the block's drops.
+
+    python -m bench.frame_pipeline --blocks empty,color_cycle --resolutions 640x480,1024x768
+    python -m bench.frame_pipeline --video webcam.mp4 --executor thread --json results.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from livekit import rtc
+from livekit.rtc import VideoFrameEvent
+
+from control_room.toolkit import consumer, executor_consumer, producer
+from control_room.toolkit_contours import ContourStage
+from control_room.toolkit_draw import PerfDecorator, draw_color_cycle, draw_on_frame, draw_red_dot, empty_block
+from control_room.toolkit_executor import EXECUTOR_INLINE, EXECUTOR_MODES, FrameExecutor
+from control_room.toolkit_mailbox import LatestFrameMailbox
+from control_room.toolkit_overlay import SPRITES, Sprite, blit
+from control_room.toolkit_pipeline import FRAME, EffectGraph, Stage
+
+
+def _perf_hud():
+    return PerfDecorator(draw_red_dot)
+
+
+def _effect_graph():
+    """Color cycle + red dot fused, brightness and edge density measured side by side, shown in a HUD."""
+    def brightness(frame: np.ndarray) -> str:
+        return f"luma {int(cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY).mean())}"
+
+    def edges(frame: np.ndarray, out: np.ndarray) -> np.ndarray:
+        small = cv2.resize(frame, (out.shape[1], out.shape[0]), interpolation=cv2.INTER_AREA)
+        return cv2.Canny(cv2.cvtColor(small, cv2.COLOR_RGB2GRAY), 100, 200, edges=out)
+
+    def hud(luma: str, edge_map: np.ndarray) -> Sprite:
+        return SPRITES.text(f"{luma} edges {np.count_nonzero(edge_map)}", background_alpha=0.5, padding=5)
+
+    return EffectGraph([
+        Stage("edges", edges, output="edges", out_spec=lambda f: ((f.shape[0] // 4, f.shape[1] // 4), np.uint8)),
+        Stage("brightness", brightness, output="luma"),
+        Stage("hud", hud, inputs=("luma", "edges"), output="hud"),
+        Stage("color_cycle", draw_color_cycle),
+        Stage("red_dot", draw_red_dot),
+        Stage("draw_hud", lambda frame, sprite: blit(frame, sprite, (10, 40)), inputs=(FRAME, "hud"), optional=True),
+    ])
+
+
+def _background_remover():
+    """BiRefNet background removal, as configured in config.json (model cache, warmup, size...)."""
+    from agent import background_remover
+    from control_room.toolkit import load_config
+
+    background_remover.load_model(load_config())
+    return background_remover.frame_processor
+
+
+# name -> factory returning an ndarray in, ndarray out block.
+BLOCKS: Dict[str, Callable[[], Callable[[np.ndarray], np.ndarray]]] = {
+    "empty": lambda: empty_block,
+    "red_dot": lambda: draw_red_dot,
+    "color_cycle": lambda: draw_color_cycle,
+    "perf_hud": _perf_hud,
+    "effect_graph": _effect_graph,
+    "contours": lambda: ContourStage(scale=0.5),
+    "contours_full": lambda: ContourStage(scale=1.0, label_shapes=False),
+    "background_remover": _background_remover,
+}
+
+
+class FakeVideoSource:
+    def __init__(self):
+        """Stands in for rtc.VideoSource, counts captured frames."""
+        self.captured = 0
+
+    def capture_frame(self, frame: rtc.VideoFrame):
+        self.captured += 1
+
+
+def generated_frames(width: int, height: int, distinct: int = 30) -> Iterator[np.ndarray]:
+    """Endless moving gradient RGB frames, `distinct` of them precomputed and cycled."""
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :]
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    frames = []
+    for i in range(distinct):
+        shift = 255.0 * i / distinct
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[..., 0] = (x + shift) % 256
+        frame[..., 1] = (y + shift) % 256
+        frame[..., 2] = (x + y + shift) % 256
+        frames.append(frame)
+    while True:
+        yield from frames
+
+
+def video_file_frames(path: str, width: int, height: int) -> Iterator[np.ndarray]:
+    """Endless RGB frames from a video file, resized, looping back at the end."""
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f"can't open video file {path}")
+    try:
+        while True:
+            ok, bgr = capture.read()
+            if not ok:
+                capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ok, bgr = capture.read()
+                if not ok:
+                    raise ValueError(f"no frames in video file {path}")
+            yield cv2.cvtColor(cv2.resize(bgr, (width, height)), cv2.COLOR_BGR2RGB)
+    finally:
+        capture.release()
+
+
+class PlaybackStream:
+    def __init__(self, frames: Iterator[np.ndarray], fps: float, seconds: float):
+        """Stands in for rtc.VideoStream, yields VideoFrameEvents at a steady rate.
+
+        Each event gets its own freshly allocated RGB24 VideoFrame, like a real stream,
+        and a timestamp_us on the monotonic clock, like libwebrtc's.
+
+        Frames emitted a whole interval behind schedule are counted as late: the event loop
+        was busy elsewhere, they come back to back and the mailbox drops all but the last,
+        drops the harness caused, not the block.
+        """
+        self.frames = frames
+        self.interval = 1.0 / fps
+        self.count = int(fps * seconds)
+        self.emitted = 0
+        self.late = 0
+
+    async def __aiter__(self):
+        start_time = time.monotonic()
+        for i in range(self.count):
+            delay = start_time + i * self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                if delay <= -self.interval:
+                    self.late += 1
+                await asyncio.sleep(0)  # let the consumer run even when we're late
+            np_frame = next(self.frames)
+            height, width = np_frame.shape[:2]
+            frame = rtc.VideoFrame(width, height, rtc.VideoBufferType.RGB24, np_frame.tobytes())
+            self.emitted += 1
+            yield VideoFrameEvent(
+                frame=frame,
+                timestamp_us=int(time.monotonic() * 1_000_000),
+                rotation=rtc.VideoRotation.VIDEO_ROTATION_0,
+            )
+
+
+async def run_pipeline(
+        block: Callable[[np.ndarray], np.ndarray],
+        frames: Iterator[np.ndarray],
+        fps: float,
+        seconds: float,
+        executor_mode: str = EXECUTOR_INLINE,
+        max_workers: Optional[int] = None,
+) -> dict:
+    stream = PlaybackStream(frames, fps, seconds)
+    mailbox: LatestFrameMailbox[VideoFrameEvent] = LatestFrameMailbox("bench")
+    output_source = FakeVideoSource()
+    latencies: List[float] = []
+
+    def on_published(frame_event: VideoFrameEvent):
+        latencies.append(time.monotonic() - frame_event.timestamp_us / 1_000_000)
+
+    if executor_mode == EXECUTOR_INLINE:
+        executor = None
+        block(next(frames).copy())
+
+        async def handle_frame(frame_event: VideoFrameEvent, source):
+            draw_on_frame(frame_event, source, block)
+
+        frame_consumer = consumer(mailbox, output_source, handle_frame, on_published=on_published)
+    else:
+        executor = FrameExecutor(block, executor_mode, max_workers)
+        frame_consumer = executor_consumer(mailbox, output_source, executor, on_published=on_published)
+
+    try:
+        if executor is not None:
+            # Start the pool's threads / processes, and run the block once on each, before the
+            # clock starts: worker startup would otherwise show up as the block's drops.
+            warmups = [executor.submit(next(frames).copy()) for _ in range(executor.max_in_flight)]
+            await asyncio.gather(*warmups)
+            for future in warmups:
+                executor.release(future)
+
+        start_time = time.perf_counter()
+        await asyncio.gather(producer(mailbox, stream), frame_consumer)
+        elapsed = time.perf_counter() - start_time
+    finally:
+        frame_consumer.close()  # never started when the warmup failed
+        # Also on failure: process mode workers and their shared memory ring must not outlive the case.
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    percentiles = np.percentile(latencies, [50, 95, 99]) if latencies else [float("nan")] * 3
+    return {
+        "frames_in": stream.emitted,
+        "frames_out": output_source.captured,
+        "fps": output_source.captured / elapsed,
+        "drop_rate": mailbox.drop_rate,
+        # Share of the input the harness itself emitted late, the drops they cause aren't the block's.
+        "late_rate": stream.late / stream.emitted if stream.emitted else 0.0,
+        "p50_ms": float(percentiles[0]) * 1000,
+        "p95_ms": float(percentiles[1]) * 1000,
+        "p99_ms": float(percentiles[2]) * 1000,
+    }
+
+
+def run_case(case: Tuple[str, int, int, dict]) -> dict:
+    """Runs one block at one resolution, meant to run in a fresh process."""
+    block_name, width, height, options = case
+    # Imports, model loading and warmup, a fresh process makes this a cold(ish) start.
+    start_time = time.perf_counter()
+    block = BLOCKS[block_name]()
+    startup = time.perf_counter() - start_time
+    if options["video"]:
+        frames = video_file_frames(options["video"], width, height)
+    else:
+        frames = generated_frames(width, height)
+
+    result = asyncio.run(run_pipeline(
+        block, frames, options["fps"], options["seconds"], options["executor"], options["workers"]
+    ))
+    result.update({
+        "block": block_name,
+        "resolution": f"{width}x{height}",
+        "executor": options["executor"],
+        "startup_s": startup,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+    return result
+
+
+def print_results(results: List[dict]):
+    header = f"{'block':<16}{'resolution':<12}{'executor':<10}{'fps':>8}{'drop %':>8}{'late %':>8}" \
+             f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'rss MB':>9}{'start s':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['block']:<16}{r['resolution']:<12}{r['executor']:<10}{r['fps']:>8.1f}"
+            f"{r['drop_rate'] * 100:>8.1f}{r['late_rate'] * 100:>8.1f}{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}{r['p99_ms']:>9.2f}"
+            f"{r['peak_rss_mb']:>9.1f}{r['startup_s']:>9.2f}"
+        )
+
+
+def parse_resolution(text: str) -> Tuple[int, int]:
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline frame pipeline benchmark.")
+    parser.add_argument("--blocks", default=",".join(BLOCKS), help=f"comma separated, from {list(BLOCKS)}")
+    parser.add_argument("--resolutions", default="640x480,1024x768", help="comma separated WxH")
+    parser.add_argument("--fps", type=float, default=30.0, help="input frame rate")
+    parser.add_argument("--seconds", type=float, default=10.0, help="input duration per case")
+    parser.add_argument("--video", default=None, help="video file to play instead of generated frames")
+    parser.add_argument("--executor", default=EXECUTOR_INLINE, choices=EXECUTOR_MODES)
+    parser.add_argument("--workers", type=int, default=None, help="worker pool size")
+    parser.add_argument("--json", default=None, help="also write results to this file")
+    args = parser.parse_args()
+
+    options = {
+        "fps": args.fps,
+        "seconds": args.seconds,
+        "video": args.video,
+        "executor": args.executor,
+        "workers": args.workers,
+    }
+    cases = [
+        (block_name, *parse_resolution(resolution), options)
+        for block_name in args.blocks.split(",")
+        for resolution in args.resolutions.split(",")
+    ]
+
+    # One fresh process per case keeps peak RSS and warm caches from leaking between cases.
+    # Not a multiprocessing.Pool: its workers are daemonic, and process mode starts its own workers.
+    results = []
+    for case in cases:
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            try:
+                results.append(pool.submit(run_case, case).result())
+            except Exception as e:
+                # e.g. process mode with a block that can't be pickled, the other cases still run.
+                print(f"{case[0]} {case[1]}x{case[2]} {options['executor']} failed: {type(e).__name__}: {e}")
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Quantized vs float segmentation: speed and mask quality on the same frames.
+
+Builds the inference backend from config.json twice, once without quantization and
+once with the requested mode, runs both on sample frames from disk and reports
+latency, speedup and how far the int8 masks drift: IoU of the binarized masks and
+mean absolute difference of the probabilities.
+
+    python -m bench.quantization --frames samples/ --mode dynamic
+    python -m bench.quantization --frames webcam.mp4 --mode static --backend onnxruntime --json q.json
+"""
+import argparse
+import copy
+import json
+import time
+from typing import List
+
+import numpy as np
+
+from agent.inference_backend import BACKENDS, create_backend
+from agent.quantization import QUANTIZATION_MODES, mask_iou, sample_frames
+from agent.segmentation import SegmentationPreprocessor, masks_to_numpy
+from control_room.toolkit import load_config
+
+
+def run_backend(backend, frames: List[np.ndarray], size: int, warmup: int) -> dict:
+    """Masks for frames, one at a time, and the per frame latency once warmed up."""
+    preprocess = SegmentationPreprocessor(size, backend.device, backend.dtype, backend.channels_last)
+    for frame in frames[:warmup]:
+        backend(preprocess([frame]))
+
+    masks, seconds = [], []
+    for frame in frames:
+        batch = preprocess([frame])
+        start_time = time.perf_counter()
+        preds = backend(batch)
+        seconds.append(time.perf_counter() - start_time)
+        masks.append(masks_to_numpy(preds)[0])
+    return {"masks": masks, "seconds": seconds}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantized vs float segmentation benchmark.")
+    parser.add_argument("--frames", default=None, help="images directory or video, defaults to calibration_dir")
+    parser.add_argument("--count", type=int, default=50, help="frames to compare on")
+    parser.add_argument("--mode", default=None, choices=QUANTIZATION_MODES, help="defaults to config's quantization")
+    parser.add_argument("--backend", default=None, choices=BACKENDS, help="defaults to config's inference_backend")
+    parser.add_argument("--size", type=int, default=None, help="inference size, defaults to config's")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed frames per backend")
+    parser.add_argument("--json", default=None, help="also write results to this file")
+    args = parser.parse_args()
+
+    config = load_config()
+    if args.backend:
+        config.INFERENCE_BACKEND = args.backend
+    mode = args.mode or config.QUANTIZATION
+    if not mode:
+        parser.error("pass --mode or set quantization in config.json")
+    size = args.size or (1024 if str(config.INFERENCE_SIZE) == "auto" else int(config.INFERENCE_SIZE))
+    frames_path = args.frames or config.CALIBRATION_DIR
+    if not frames_path:
+        parser.error("pass --frames or set calibration_dir in config.json")
+    frames = list(sample_frames(frames_path, args.count))
+
+    # Quantized kernels are CPU ones, compare on the CPU in float32.
+    float_config = copy.copy(config)
+    float_config.QUANTIZATION = None
+    float_config.INFERENCE_DTYPE = "float32"
+    quantized_config = copy.copy(float_config)
+    quantized_config.QUANTIZATION = mode
+
+    reference = run_backend(create_backend(float_config, "cpu"), frames, size, args.warmup)
+    quantized = run_backend(create_backend(quantized_config, "cpu"), frames, size, args.warmup)
+
+    ious = [mask_iou(a, b) for a, b in zip(reference["masks"], quantized["masks"])]
+    errors = [float(np.abs(a - b).mean()) for a, b in zip(reference["masks"], quantized["masks"])]
+    float_ms = float(np.median(reference["seconds"])) * 1000
+    int8_ms = float(np.median(quantized["seconds"])) * 1000
+    result = {
+        "backend": config.INFERENCE_BACKEND,
+        "mode": mode,
+        "size": size,
+        "frames": len(frames),
+        "float_p50_ms": float_ms,
+        "int8_p50_ms": int8_ms,
+        "speedup": float_ms / int8_ms,
+        "iou_mean": float(np.mean(ious)),
+        "iou_min": float(np.min(ious)),
+        "mae_mean": float(np.mean(errors)),
+    }
+
+    print(f"{config.INFERENCE_BACKEND} int8 {mode} @ {size}, {len(frames)} frames")
+    print(f"  float32 p50 {float_ms:8.2f} ms")
+    print(f"  int8    p50 {int8_ms:8.2f} ms   speedup x{result['speedup']:.2f}")
+    print(f"  mask IoU mean {result['iou_mean']:.4f} min {result['iou_min']:.4f}   MAE {result['mae_mean']:.4f}")
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,21 +3,46 @@ import json
 import logging
 import os
 import time
-from asyncio import Queue
-from aiohttp import ClientSession
+from collections import deque
 from signal import SIGINT, SIGTERM
-from typing import Callable, Awaitable, Optional
+from typing import Any, Callable, Awaitable, List, Optional, Sequence, Tuple
 
 import cv2
 import numpy as np
 from livekit import api, rtc
 from livekit.rtc import VideoFrameEvent, VideoFrame, AudioFrameEvent, AudioFrame, AudioStream
-from livekit.agents.stt import SpeechEventType, SpeechEvent, SpeechStream
-from livekit.plugins import deepgram
 
-def build_recoder(filename, fps=20.0, resolution=(640, 480)) -> cv2.VideoWriter:
-    fourcc = cv2.VideoWriter.fourcc(*"MP4V")
-    return cv2.VideoWriter(f"{filename}.mp4v", fourcc, fps, resolution)
+from control_room.toolkit_frame import FrameBuffer, publish_frame
+from control_room.toolkit_mailbox import LatestFrameMailbox
+from control_room.toolkit_mock_stt import mock_stt_factory
+from control_room.toolkit_profile import PROFILER, install_profiling_signals
+from control_room.toolkit_quality import QualityController, QualityKnob
+from control_room.toolkit_recorder import BackgroundRecorder, RecordingVideoSource
+from control_room.toolkit_metrics import (
+    FRAMES_DROPPED,
+    FRAMES_PROCESSED,
+    FRAMES_PUBLISHED,
+    FRAMES_RECEIVED,
+    FRAME_LATENCY_SECONDS,
+    IN_FLIGHT,
+    QUEUE_DEPTH,
+    STAGE_SECONDS,
+    forget_track,
+    frame_age,
+    start_metrics_export,
+)
+from control_room.toolkit_audio import AudioTranscriber, EnergyGate, SttFactory, deepgram_stt
+from control_room.toolkit_batch import MicroBatcher
+from control_room.toolkit_executor import FrameExecutor, EXECUTOR_INLINE
+from control_room.toolkit_supervisor import config_overrides, configure_worker_threads, owns_participant, worker_shard
+
+def build_recoder(filename, fps=20.0, resolution=(640, 480), **options) -> BackgroundRecorder:
+    """An MP4V BackgroundRecorder writing filename-<index>-<time>.mp4 segments off the caller's thread.
+
+    resolution=None records frames at their own size, options go to BackgroundRecorder
+    (segment_seconds, segment_bytes, max_queue, channel_order...).
+    """
+    return BackgroundRecorder(filename, fps, "mp4v", "mp4", resolution, **options)
 
 
 class Config:
@@ -32,6 +57,25 @@ class Config:
             openai_api_key,
             output_width,
             output_height,
+            inference_size="1024",
+            inference_dtype="float32",
+            channels_last=False,
+            metrics_port=None,
+            metrics_file=None,
+            model_cache_dir=None,
+            warmup_frames=2,
+            inference_backend="torch",
+            intra_op_threads=0,
+            inter_op_threads=0,
+            graph_optimization="all",
+            onnx_model=None,
+            onnx_providers=None,
+            quantization=None,
+            calibration_dir=None,
+            calibration_frames=32,
+            stt_url=None,
+            vad_threshold_db=-45.0,
+            stt_max_latency=0.1,
     ):
         self.TARGET_ROOM_NAME = target_room_name
         self.LIVEKIT_URL = livekit_url
@@ -42,11 +86,46 @@ class Config:
         self.OPENAI_API_KEY = openai_api_key
         self.OUTPUT_WIDTH = output_width
         self.OUTPUT_HEIGHT = output_height
+        # Segmentation agents: model input resolution ("256", "512", "1024"... or "auto"),
+        # model dtype ("float32", "bfloat16", "float16") and channels last memory format.
+        self.INFERENCE_SIZE = inference_size
+        self.INFERENCE_DTYPE = inference_dtype
+        self.CHANNELS_LAST = channels_last
+        # Pipeline metrics export, Prometheus text format over http://0.0.0.0:<port>/metrics
+        # and/or rewritten to a file every few seconds.
+        self.METRICS_PORT = metrics_port
+        self.METRICS_FILE = metrics_file
+        # Model agents: directory keeping compiled (TorchScript) models between starts, None to
+        # always load the eager model, and synthetic batches run per input size before publishing.
+        self.MODEL_CACHE_DIR = model_cache_dir
+        self.WARMUP_FRAMES = warmup_frames
+        # Model agents: "torch" or "onnxruntime", thread counts (0 for the runtime's default),
+        # onnxruntime graph optimization ("disable", "basic", "extended", "all"), an exported
+        # .onnx file (exported into model_cache_dir when missing) and preferred execution providers.
+        self.INFERENCE_BACKEND = inference_backend
+        self.INTRA_OP_THREADS = intra_op_threads
+        self.INTER_OP_THREADS = inter_op_threads
+        self.GRAPH_OPTIMIZATION = graph_optimization
+        self.ONNX_MODEL = onnx_model
+        self.ONNX_PROVIDERS = onnx_providers
+        # Model agents: int8 model, None, "dynamic" or "static" (onnxruntime only), static
+        # quantization calibrates on calibration_frames frames from the images / videos in calibration_dir.
+        self.QUANTIZATION = quantization
+        self.CALIBRATION_DIR = calibration_dir
+        self.CALIBRATION_FRAMES = calibration_frames
+        # Audio agents: a mock STT server's websocket (see toolkit_mock_stt) instead of Deepgram,
+        # the level in dBFS audio must reach to be sent for transcription, None sends silence too,
+        # and seconds of audio gathered per push to the STT stream.
+        self.STT_URL = stt_url
+        self.VAD_THRESHOLD_DB = vad_threshold_db
+        self.STT_MAX_LATENCY = stt_max_latency
 
 
 def load_config(config_json="config.json"):
     with open(config_json, "r") as file:
         data = json.load(file)
+        # Set by the supervisor for its workers: room, metrics file, threads...
+        data.update(config_overrides())
         config = Config(**data)
         os.environ["LIVEKIT_API_KEY"] = config.LIVEKIT_API_KEY
         os.environ["LIVEKIT_API_SECRET"] = config.LIVEKIT_API_SECRET
@@ -57,6 +136,14 @@ def load_config(config_json="config.json"):
         os.environ["OPENAI_API_KEY"] = config.OPENAI_API_KEY
         os.environ["DEEPGRAM_API_KEY"] = config.DEEPGRAM_API_KEY
         os.environ["ELEVEN_API_KEY"] = config.ELEVEN_API_KEY
+        if config.METRICS_PORT:
+            os.environ["METRICS_PORT"] = str(config.METRICS_PORT)
+        if config.METRICS_FILE:
+            os.environ["METRICS_FILE"] = config.METRICS_FILE
+        if config.STT_URL:
+            os.environ["STT_URL"] = config.STT_URL
+        os.environ["VAD_THRESHOLD_DB"] = str(config.VAD_THRESHOLD_DB)
+        os.environ["STT_MAX_LATENCY"] = str(config.STT_MAX_LATENCY)
 
         return config
 
@@ -106,116 +193,264 @@ def log_room_activity(room: rtc.Room):
 
 
 async def producer(
-        queue: asyncio.Queue[Optional[VideoFrameEvent]], input_stream: rtc.VideoStream
+        mailbox: LatestFrameMailbox[VideoFrameEvent], input_stream: rtc.VideoStream
 ):
     """
     Asynchronously produce frames from the input_stream
-    and put them into the queue.
+    and put them into the mailbox, where they replace any frame
+    the consumer hasn't picked up yet.
     """
     logging.info("frame_event producer start")
-    total = 0
-    dropped = 0
+    frames_received = FRAMES_RECEIVED.labels(mailbox.name)
+    frames_dropped = FRAMES_DROPPED.labels(mailbox.name)
+    queue_depth = QUEUE_DEPTH.labels(mailbox.name)
     frame_event: VideoFrameEvent
-    # TODO: Review this code... works ok, but something 🐟 re: task_done() / join() usage.
-    async for frame_event in input_stream:
-        total += 1
-        if not queue.full():
-            await queue.put(frame_event)
-        else:
-            dropped += 1
-            if dropped % 100 == 0:
-                print(f"{dropped / total} frames drop %")
-
-    logging.info("frame_event producer end")
-    await queue.put(None)
+    try:
+        async for frame_event in input_stream:
+            overwritten = mailbox.overwritten
+            mailbox.put(frame_event)
+            frames_received.inc()
+            queue_depth.set(1)
+            if mailbox.overwritten != overwritten:
+                frames_dropped.inc()
+                if mailbox.overwritten % 100 == 0:
+                    print(f"{mailbox.drop_rate} frames drop %")
+    finally:
+        logging.info("frame_event producer end")
+        mailbox.close()
 
 
 async def consumer(
-        queue: asyncio.Queue[Optional[VideoFrameEvent]],
+        mailbox: LatestFrameMailbox[VideoFrameEvent],
         output_source: rtc.VideoSource,
         handle_frame: Callable[[VideoFrameEvent, rtc.VideoSource], Awaitable[None]],
+        quality: Optional[QualityController] = None,
+        on_published: Optional[Callable[[VideoFrameEvent], None]] = None,
 ):
     """
-    Asynchronously consume frames from the queue
+    Asynchronously consume the latest frames from the mailbox, until it is closed.
+    Frame times are reported to the quality controller, if any, and on_published
+    is called with each frame event once handled.
     """
     logging.info("frame_event consumer start")
+    frames_processed = FRAMES_PROCESSED.labels(mailbox.name)
+    frames_published = FRAMES_PUBLISHED.labels(mailbox.name)
+    frame_latency = FRAME_LATENCY_SECONDS.labels(mailbox.name)
+    queue_depth = QUEUE_DEPTH.labels(mailbox.name)
     count = 0
     try:
-        while True:
-            frame = await queue.get()
-            if frame is None:
-                break
+        async for frame in mailbox:
+            queue_depth.set(0)
+            if quality is not None and not quality.should_process(mailbox):
+                continue
             start_time = time.perf_counter()
-            await handle_frame(frame, output_source)
+            with PROFILER.span("handle_frame"):
+                await handle_frame(frame, output_source)
 
             end_time = time.perf_counter()
+            frames_processed.inc()
+            frames_published.inc()
+            age = frame_age(frame.timestamp_us)
+            if age is not None:
+                frame_latency.observe(age)
+            if on_published is not None:
+                on_published(frame)
+            if quality is not None:
+                quality.record(end_time - start_time, mailbox)
             count += 1
             if count % 60 == 0:
                 print(f"frame handled in: {end_time - start_time} seconds")
 
-            queue.task_done()
         logging.info("frame_event consumer end")
     except asyncio.CancelledError:
         logging.info("frame_event consumer Task cancelled")
 
 
-async def audio_to_text_looper(
-        room: rtc.Room,
-        lk_id: str,
-        lk_name: str,
-        handle_audio: Callable[[AudioFrameEvent], Awaitable[None]]
+async def executor_consumer(
+        mailbox: LatestFrameMailbox[VideoFrameEvent],
+        output_source: rtc.VideoSource,
+        executor: FrameExecutor | MicroBatcher,
+        quality: Optional[QualityController] = None,
+        on_published: Optional[Callable[[VideoFrameEvent], None]] = None,
 ):
+    """
+    Asynchronously consume the latest frames from the mailbox, hands them to the
+    executor's workers and publishes the results on output_source, in arrival order.
 
-    log_room_activity(room)
-    stt = deepgram.STT(http_session=ClientSession())
-    stt_stream = stt.stream()
+    At most executor.max_in_flight frames are submitted but not yet published,
+    so the event loop stays free while workers crunch on frames.
+    Per frame publish intervals are reported to the quality controller, if any, and
+    on_published is called with each frame event once published.
+    """
+    logging.info(f"frame_event executor_consumer start [{executor.mode}]")
+    frames_processed = FRAMES_PROCESSED.labels(mailbox.name)
+    frames_published = FRAMES_PUBLISHED.labels(mailbox.name)
+    frame_latency = FRAME_LATENCY_SECONDS.labels(mailbox.name)
+    queue_depth = QUEUE_DEPTH.labels(mailbox.name)
+    in_flight = IN_FLIGHT.labels(mailbox.name)
+    block_seconds = STAGE_SECONDS.labels("block")
+    pending: deque = deque()
+    count = 0
+    # Executors handing out shared memory views want them back once published.
+    release = getattr(executor, "release", None)
+
+    last_published: Optional[float] = None
+
+    def publish_done():
+        """Publish every finished frame at the head of pending, keeping arrival order."""
+        nonlocal count, last_published
+        while pending and pending[0][3].done():
+            frame, frame_buffer, start_time, future = pending.popleft()
+            in_flight.set(len(pending))
+            if future.cancelled():
+                continue
+            if future.exception() is not None:
+                logging.error("frame block failed, frame skipped", exc_info=future.exception())
+                continue
+            frames_processed.inc()
+            # blocks returning None are assumed to have drawn in-place.
+            new_frame = future.result()
+            if new_frame is None:
+                new_frame = frame_buffer.array
+            with PROFILER.span("publish"):
+                publish_frame(output_source, new_frame, frame_buffer)
+            if release is not None:
+                release(future)
+            frames_published.inc()
+            age = frame_age(frame.timestamp_us)
+            if age is not None:
+                frame_latency.observe(age)
+            if on_published is not None:
+                on_published(frame)
+
+            end_time = time.perf_counter()
+            if quality is not None:
+                # What this frame cost the output: from its submission, or from the previous
+                # publish when it was queued behind it, frames running side by side on several
+                # workers don't count each other's time.
+                since = start_time if last_published is None else max(start_time, last_published)
+                quality.record(end_time - since, mailbox)
+            last_published = end_time
+            count += 1
+            if count % 60 == 0:
+                print(f"frame handled in: {end_time - start_time} seconds ({len(pending)} in flight)")
 
-    async def listen(stt_stream: SpeechStream):
-        async for event in stt_stream:
-            if event.type == SpeechEventType.FINAL_TRANSCRIPT:
-                text = event.alternatives[0].text
-                await handle_audio(text)
-                logging.info(f"🔊 {text}")
-                # Do something with text
-            elif event.type == SpeechEventType.INTERIM_TRANSCRIPT:
-                pass
-            elif event.type == SpeechEventType.START_OF_SPEECH:
-                pass
-            elif event.type == SpeechEventType.END_OF_SPEECH:
-                pass
+    try:
+        async for frame in mailbox:
+            queue_depth.set(0)
+            if quality is not None and not quality.should_process(mailbox):
+                continue
+            start_time = time.perf_counter()
+            with PROFILER.span("buffer_wrap"):
+                frame_buffer = FrameBuffer(frame.frame)
+            submit_time = time.perf_counter()
+            STAGE_SECONDS.labels("buffer_wrap").observe(submit_time - start_time)
+
+            future = executor.submit(frame_buffer.array, track=mailbox.name, timestamp_us=frame.timestamp_us)
+            pending.append((frame, frame_buffer, submit_time, future))
+            in_flight.set(len(pending))
+
+            def on_done(_, submitted=submit_time):
+                block_seconds.observe(time.perf_counter() - submitted)
+                publish_done()
+
+            future.add_done_callback(on_done)
+
+            # Don't pick up another frame until a worker slot frees up,
+            # the mailbox keeps the freshest frame for us meanwhile.
+            while len(pending) >= executor.max_in_flight:
+                await asyncio.wait([pending[0][3]])
+                publish_done()
+
+        while pending:
+            await asyncio.wait([pending[0][3]])
+            publish_done()
+        logging.info("frame_event executor_consumer end")
+    except asyncio.CancelledError:
+        for _, _, _, future in pending:
+            future.cancel()
+        logging.info("frame_event executor_consumer Task cancelled")
 
 
-    async def audio_to_text(track: rtc.Track):
-        audio_stream = rtc.AudioStream(track)
+async def audio_to_text_looper(
+        room: rtc.Room,
+        lk_id: str,
+        lk_name: str,
+        handle_audio: Callable[[str], Awaitable[None]],
+        stt_factory: Optional[SttFactory] = None,
+):
+    """
+    Transcribes every subscribed audio track, each on its own STT stream, and awaits
+    handle_audio with each final transcript.
 
-        asyncio.ensure_future(listen(stt_stream))
+    As one of several supervisor workers in the room, only the participants hashed to this
+    worker's shard are transcribed. Streams share one http session, silence is gated out before it's sent (VAD_THRESHOLD_DB,
+    "None" to send everything), the rest is converted to the STT's format and pushed in
+    STT_MAX_LATENCY second chunks, see AudioTranscriber.
 
-        async for ev in audio_stream:
-            stt_stream.push_frame(ev.frame)
+    Args:
+        stt_factory: builds the STT client, defaults to Deepgram, or the mock server at STT_URL
+    """
+    log_room_activity(room)
+    if stt_factory is None:
+        stt_url = os.getenv("STT_URL")
+        stt_factory = mock_stt_factory(stt_url) if stt_url else deepgram_stt
+    threshold = os.getenv("VAD_THRESHOLD_DB", "-45.0")
+    gate_factory = None if threshold == "None" else (lambda: EnergyGate(float(threshold)))
 
-        stt_stream.end_input()
+    async def handle_text(text: str, _identity: str):
+        await handle_audio(text)
 
+    max_latency = float(os.getenv("STT_MAX_LATENCY", "0.1"))
+    transcriber = AudioTranscriber(handle_text, stt_factory, gate_factory, max_latency=max_latency)
 
     @room.on("track_subscribed")
-    def on_track_subscribed(subscribed_track: rtc.Track, *_):
+    def on_track_subscribed(
+            subscribed_track: rtc.Track,
+            publication: rtc.RemoteTrackPublication,
+            participant: rtc.RemoteParticipant,
+    ):
         logging.info(f"🛤 on_track_subscribed('{subscribed_track.sid}')")
-        if subscribed_track.kind == rtc.TrackKind.KIND_AUDIO:
-
-            #asyncio.create_task(audio_to_text(subscribed_track))
-
-            asyncio.ensure_future(audio_to_text(subscribed_track))
-
+        if subscribed_track.kind != rtc.TrackKind.KIND_AUDIO:
+            return
+        if is_agent_output(publication, participant, lk_id):
+            logging.info(f"🛤 skipping {participant.identity}'s agent audio {publication.sid}")
+            return
+        transcriber.add_track(subscribed_track, participant.identity)
 
     @room.on("track_unsubscribed")
     def on_track_unsubscribed(unsubscribed_track: rtc.Track, *_):
         logging.info(f"🛤 on_track_unsubscribed({unsubscribed_track.name})")
+        transcriber.remove_track(unsubscribed_track.sid)
+
+    @room.on("disconnected")
+    def on_disconnected(*_):
+        asyncio.ensure_future(transcriber.aclose())
 
+    # Sharded, each worker transcribes the participants hashed to it.
+    options, subscribe_published = subscribe_by_shard(room, lk_id, rtc.TrackKind.KIND_AUDIO)
     token = build_token(lk_id, lk_name)
-    await room.connect(os.getenv("LIVEKIT_URL"), token.to_jwt())
+    await room.connect(os.getenv("LIVEKIT_URL"), token.to_jwt(), options)
     logging.info(f"connected to room: {room.name}")
+    subscribe_published()
+
+
+async def when_ready(ready: Optional[asyncio.Future], coroutine: Awaitable[Any]) -> Any:
+    """Runs coroutine once ready resolved, ready may be awaited by many callers at once."""
+    if ready is not None:
+        try:
+            await asyncio.shield(ready)
+        except BaseException:
+            coroutine.close()
+            raise
+    return await coroutine
 
 
 def build_token(lk_id, lk_name):
+    shard = worker_shard()
+    if shard is not None:
+        # Several workers share the room, identities must be unique.
+        lk_id, lk_name = f"{lk_id}-{shard[0]}", f"{lk_name} #{shard[0]}"
     token = (
         api.AccessToken()
         .with_identity(lk_id)
@@ -230,32 +465,119 @@ def build_token(lk_id, lk_name):
     return token
 
 
+def is_agent_output(publication: rtc.TrackPublication, participant: rtc.RemoteParticipant, lk_id: str) -> bool:
+    """Tracks published by agents: this one's other workers (identity lk_id-<shard>), any other
+    agent, or anything named like our outputs ("masked", "masked-*"). They aren't inputs, masking
+    them would mask the masks."""
+    return (
+            participant.identity == lk_id
+            or participant.identity.startswith(f"{lk_id}-")
+            or participant.kind == rtc.ParticipantKind.PARTICIPANT_KIND_AGENT
+            or publication.name == "masked"
+            or publication.name.startswith("masked-")
+    )
+
+
+def subscribe_by_shard(
+        room: rtc.Room, lk_id: str, kind: rtc.TrackKind.ValueType
+) -> Tuple[rtc.RoomOptions, Callable[[], None]]:
+    """Room options to connect with, and a function to call once connected.
+
+    Started by the supervisor as one of several workers in this room (CR_SHARD), the worker
+    only subscribes to the kind tracks of the participants hashed to it, the other workers
+    take the rest, and never to agent outputs. Otherwise every track is auto subscribed.
+    The function subscribes to the tracks published before we joined, they don't get a
+    track_published event.
+    """
+    shard = worker_shard()
+    if shard is None:
+        return rtc.RoomOptions(auto_subscribe=True), lambda: None
+
+    def subscribe_if_owned(publication: rtc.RemoteTrackPublication, participant: rtc.RemoteParticipant):
+        if publication.kind != kind or is_agent_output(publication, participant, lk_id):
+            return
+        if owns_participant(participant.identity, shard):
+            logging.info(f"🧩 shard {shard} takes {participant.identity}'s {publication.sid}")
+            publication.set_subscribed(True)
+
+    @room.on("track_published")
+    def on_track_published(publication: rtc.RemoteTrackPublication, participant: rtc.RemoteParticipant):
+        subscribe_if_owned(publication, participant)
+
+    def subscribe_published():
+        for participant in room.remote_participants.values():
+            for publication in participant.track_publications.values():
+                subscribe_if_owned(publication, participant)
+
+    return rtc.RoomOptions(auto_subscribe=False), subscribe_published
+
+
 async def first_track_queued_frame_looper(
         room: rtc.Room,
         lk_id: str,
         lk_name: str,
-        handle_frame: Callable[[VideoFrameEvent, rtc.VideoSource], Awaitable[None]],
+        handle_frame: Optional[Callable[[VideoFrameEvent, rtc.VideoSource], Awaitable[None]]] = None,
+        block: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+        executor_mode: str = EXECUTOR_INLINE,
+        max_workers: Optional[int] = None,
+        max_in_flight: Optional[int] = None,
+        executor: Optional[FrameExecutor | MicroBatcher] = None,
+        quality: Optional[QualityController] = None,
+        ready: Optional[Awaitable[Any]] = None,
+        recorder: Optional[BackgroundRecorder] = None,
 ):
     """
     A main loop that listens for first subscribed KIND_VIDEO track,
-    then sets up a producer-consumer frame queue. Frames are dropped when
-    queue is waiting
+    then sets up a producer-consumer frame mailbox. When the consumer is busy
+    the pending frame is overwritten by newer ones, the consumer always gets
+    the latest frame.
+
+    Either pass an async handle_frame, which runs on the event loop, a synchronous
+    ndarray block, which runs according to executor_mode (see toolkit_executor),
+    or a ready made executor such as a MicroBatcher (see toolkit_batch).
+
+    Agent outputs are never picked, and as one of several supervisor workers in the room
+    only the tracks of the participants hashed to this worker's shard are subscribed to.
 
     @param room: the livekit room object, has a looper associated to it.
     @param lk_id: livekit user id
     @param lk_name: livekit username
     @param handle_frame: the callback that will be responsible for inference and
+    @param block: ndarray in, ndarray out processing block, used instead of handle_frame
+    @param executor_mode: EXECUTOR_INLINE, EXECUTOR_THREAD or EXECUTOR_PROCESS, for block
+    @param max_workers: worker pool size, for block
+    @param max_in_flight: bound on frames submitted to workers but not yet published, for block
+    @param executor: FrameExecutor or MicroBatcher frames are submitted to, owned by the caller
+    @param quality: controller stepping quality down/up to hold its target fps, it picks up
+    the block's `quality_knobs`, if any
+    @param ready: e.g. model loading and warmup, runs while the room connects, frames are
+    processed and the output track published once it's done
+    @param recorder: records the published frames off the event loop, see build_recoder
     @return:
     """
+    if [handle_frame, block, executor].count(None) != 2:
+        raise ValueError("pass exactly one of handle_frame, block or executor")
+
     width: int = int(os.getenv("OUTPUT_WIDTH")) or 1024
     height: int = int(os.getenv("OUTPUT_HEIGHT")) or 768
     logging.info(f"called first_track_queued_frame_looper({room.name}) [{width}x{height}]")
+    start_metrics_export()
+    ready = asyncio.ensure_future(ready) if ready is not None else None
     input_video_stream = None
 
+    owns_executor = block is not None
+    if block is not None:
+        executor = FrameExecutor(block, executor_mode, max_workers, max_in_flight)
+    if quality is not None:
+        quality.add_knobs(getattr(block, "quality_knobs", []))
+
     log_room_activity(room)
 
     # prepare a track
-    output_source = rtc.VideoSource(width, height)
+    if recorder is not None:
+        output_source = RecordingVideoSource(width, height, recorder)
+    else:
+        output_source = rtc.VideoSource(width, height)
     output_track = rtc.LocalVideoTrack.create_video_track("masked", output_source)
     output_track_options = rtc.TrackPublishOptions()
     output_track_options.source = rtc.TrackSource.SOURCE_CAMERA
@@ -264,10 +586,17 @@ async def first_track_queued_frame_looper(
     tasks = set()
 
     @room.on("track_subscribed")
-    def on_track_subscribed(subscribed_track: rtc.Track, *_):
+    def on_track_subscribed(
+            subscribed_track: rtc.Track,
+            publication: rtc.RemoteTrackPublication,
+            participant: rtc.RemoteParticipant,
+    ):
         logging.info(f"🛤 on_track_subscribed('{subscribed_track.sid}')")
         if subscribed_track.kind == rtc.TrackKind.KIND_VIDEO:
             nonlocal input_video_stream
+            if is_agent_output(publication, participant, lk_id):
+                logging.info(f"🛤 skipping {participant.identity}'s agent output {publication.name}")
+                return
             if input_video_stream is not None:
                 # only process the first stream received
                 return
@@ -278,29 +607,36 @@ async def first_track_queued_frame_looper(
             input_video_stream = rtc.VideoStream(
                 subscribed_track, format=rtc.VideoBufferType.RGB24
             )
-            queue: Queue[Optional[VideoFrameEvent]] = asyncio.Queue(maxsize=1)
+            mailbox: LatestFrameMailbox[VideoFrameEvent] = LatestFrameMailbox(subscribed_track.sid)
 
-            # Approach 1, the 'cancel reaction'
-            producer_task = asyncio.create_task(producer(queue, input_video_stream))
+            # The producer closes the mailbox when the input stream ends,
+            # the consumer drains the last frame and stops on its own.
+            producer_task = asyncio.create_task(producer(mailbox, input_video_stream))
             tasks.add(producer_task)
-            consumer_task = asyncio.create_task(
-                consumer(queue, output_source, handle_frame)
-            )
+            # Until ready, the producer keeps overwriting the one pending frame.
+            if executor is not None:
+                consumer_task = asyncio.create_task(
+                    when_ready(ready, executor_consumer(mailbox, output_source, executor, quality))
+                )
+            else:
+                consumer_task = asyncio.create_task(
+                    when_ready(ready, consumer(mailbox, output_source, handle_frame, quality))
+                )
             tasks.add(consumer_task)
 
-            def done_handler(t):
+            def consumer_done_handler(t):
                 tasks.remove(t)
-                consumer_task.cancel("producer is done, consumer cancelled.")
+                if owns_executor:
+                    executor.shutdown()
 
-            producer_task.add_done_callback(done_handler)
-            consumer_task.add_done_callback(tasks.remove)
-
-            # TODO Approach 2, the emit-none on end of input stream?
+            producer_task.add_done_callback(tasks.remove)
+            consumer_task.add_done_callback(consumer_done_handler)
 
         @room.on("track_unsubscribed")
         def on_track_unsubscribed(unsubscribed_track: rtc.Track, *_):
             logging.info(f"🛤 on_track_unsubscribed({unsubscribed_track.name})")
 
+    options, subscribe_published = subscribe_by_shard(room, lk_id, rtc.TrackKind.KIND_VIDEO)
     token = build_token(lk_id, lk_name)
     # token = (
     #     api.AccessToken()
@@ -313,8 +649,12 @@ async def first_track_queued_frame_looper(
     #         )
     #     )
     # )
-    await room.connect(os.getenv("LIVEKIT_URL"), token.to_jwt())
+    await room.connect(os.getenv("LIVEKIT_URL"), token.to_jwt(), options)
     logging.info(f"connected to room: {room.name}")
+    subscribe_published()
+    if ready is not None:
+        await ready
+        logging.info(f"ready: {room.name}")
 
     publication = await room.local_participant.publish_track(
         output_track, output_track_options
@@ -322,6 +662,221 @@ async def first_track_queued_frame_looper(
     logging.info(f"published track {publication.sid}")
 
 
+class TrackPipeline:
+    def __init__(
+            self,
+            room: rtc.Room,
+            input_track: rtc.Track,
+            output_name: str,
+            width: int,
+            height: int,
+            handle_frame: Optional[Callable[[VideoFrameEvent, rtc.VideoSource], Awaitable[None]]] = None,
+            executor: Optional[FrameExecutor | MicroBatcher] = None,
+            quality: Optional[QualityController] = None,
+            ready: Optional[asyncio.Future] = None,
+            recorder: Optional[BackgroundRecorder] = None,
+    ):
+        """One input video track's producer-consumer loop, publishing to its own output track.
+
+        Args:
+            room: the connected room to publish the output track in
+            input_track: subscribed KIND_VIDEO track to read frames from
+            output_name: name of the published output track
+            width, height: output VideoSource resolution
+            handle_frame: async frame handler, running on the event loop
+            executor: FrameExecutor or MicroBatcher, shared with the room's other pipelines
+            quality: QualityController, shared with the room's other pipelines
+            ready: future the output track and consumer wait for, e.g. the model loading
+            recorder: records the published frames, closed by stop()
+        """
+        self.room = room
+        self.input_track = input_track
+        self.output_name = output_name
+        self.handle_frame = handle_frame
+        self.executor = executor
+        self.quality = quality
+        self.ready = ready
+        self.recorder = recorder
+
+        self.input_stream = rtc.VideoStream(input_track, format=rtc.VideoBufferType.RGB24)
+        self.mailbox: LatestFrameMailbox[VideoFrameEvent] = LatestFrameMailbox(input_track.sid)
+        if recorder is not None:
+            self.output_source = RecordingVideoSource(width, height, recorder)
+        else:
+            self.output_source = rtc.VideoSource(width, height)
+        self.output_track = rtc.LocalVideoTrack.create_video_track(output_name, self.output_source)
+        self.publication: Optional[rtc.LocalTrackPublication] = None
+        self.tasks = set()
+
+    async def start(self):
+        # Read the input right away, until ready the mailbox just keeps the latest frame.
+        self._track(asyncio.create_task(producer(self.mailbox, self.input_stream)))
+        if self.ready is not None:
+            await asyncio.shield(self.ready)
+            if self.mailbox.closed:
+                return  # stopped while waiting
+
+        options = rtc.TrackPublishOptions()
+        options.source = rtc.TrackSource.SOURCE_CAMERA
+        self.publication = await self.room.local_participant.publish_track(self.output_track, options)
+        logging.info(f"published track {self.publication.sid} for {self.input_track.sid}")
+
+        if self.executor is not None:
+            consumer_task = asyncio.create_task(
+                executor_consumer(self.mailbox, self.output_source, self.executor, self.quality)
+            )
+        else:
+            consumer_task = asyncio.create_task(
+                consumer(self.mailbox, self.output_source, self.handle_frame, self.quality)
+            )
+        self._track(consumer_task)
+
+    def _track(self, task: asyncio.Task):
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def stop(self):
+        """Stop reading the input, let the consumer drain, then unpublish the output track."""
+        await self.input_stream.aclose()
+        self.mailbox.close()
+        if self.tasks:
+            await asyncio.wait(set(self.tasks), timeout=5.0)
+        for task in self.tasks:
+            task.cancel()
+        if self.recorder is not None:
+            # Finishing the segment may wait on the encoder, not on the event loop.
+            await asyncio.get_running_loop().run_in_executor(None, self.recorder.close)
+        forget_track(self.input_track.sid)
+
+        if self.publication is not None and self.room.isconnected():
+            await self.room.local_participant.unpublish_track(self.publication.sid)
+            logging.info(f"unpublished track {self.publication.sid} for {self.input_track.sid}")
+        self.publication = None
+
+
+# Tracks a multi track looper's executor is sized for, more still work, past its shared memory slots.
+MULTI_TRACK_PIPELINES = 4
+
+
+async def multi_track_queued_frame_looper(
+        room: rtc.Room,
+        lk_id: str,
+        lk_name: str,
+        handle_frame: Optional[Callable[[VideoFrameEvent, rtc.VideoSource], Awaitable[None]]] = None,
+        block: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+        executor_mode: str = EXECUTOR_INLINE,
+        max_workers: Optional[int] = None,
+        max_in_flight: Optional[int] = None,
+        executor: Optional[FrameExecutor | MicroBatcher] = None,
+        quality: Optional[QualityController] = None,
+        ready: Optional[Awaitable[Any]] = None,
+        recorder_factory: Optional[Callable[[str], BackgroundRecorder]] = None,
+):
+    """
+    Like first_track_queued_frame_looper, but every subscribed KIND_VIDEO track gets
+    its own TrackPipeline and its own "masked-<identity>" output track. Pipelines share
+    the one executor, so a single worker pool (and model instance) serves the whole room.
+    A pipeline is torn down and its output unpublished when its track is unsubscribed.
+    Tracks of agents, including this agent's other workers, and "masked-*" tracks are skipped.
+    When run as one of several supervisor workers in the room (see toolkit_supervisor),
+    it only subscribes to the participants hashed to its shard.
+
+    @param room: the livekit room object, has a looper associated to it.
+    @param lk_id: livekit user id
+    @param lk_name: livekit username
+    @param handle_frame: async frame handler, running on the event loop
+    @param block: ndarray in, ndarray out processing block, used instead of handle_frame
+    @param executor_mode: EXECUTOR_INLINE, EXECUTOR_THREAD or EXECUTOR_PROCESS, for block
+    @param max_workers: worker pool size, for block
+    @param max_in_flight: bound on frames in flight per track, for block
+    @param executor: FrameExecutor or MicroBatcher frames are submitted to, owned by the caller
+    @param quality: controller shared by every pipeline, it picks up the block's `quality_knobs`
+    @param ready: e.g. model loading and warmup, runs while the room connects, pipelines
+    start and publish their output track once it's done
+    @param recorder_factory: called with a pipeline's output track name, returns the recorder
+    of its published frames, closed with the pipeline
+    @return:
+    """
+    if [handle_frame, block, executor].count(None) != 2:
+        raise ValueError("pass exactly one of handle_frame, block or executor")
+
+    width: int = int(os.getenv("OUTPUT_WIDTH")) or 1024
+    height: int = int(os.getenv("OUTPUT_HEIGHT")) or 768
+    logging.info(f"called multi_track_queued_frame_looper({room.name}) [{width}x{height}]")
+    start_metrics_export()
+    ready = asyncio.ensure_future(ready) if ready is not None else None
+
+    owns_executor = block is not None
+    if block is not None:
+        # Every track's pipeline shares it, each with up to max_in_flight frames out.
+        executor = FrameExecutor(
+            block, executor_mode, max_workers, max_in_flight, pipelines=MULTI_TRACK_PIPELINES
+        )
+    if quality is not None:
+        quality.add_knobs(getattr(block, "quality_knobs", []))
+
+    log_room_activity(room)
+
+    pipelines: dict[str, TrackPipeline] = {}
+    tasks = set()
+
+    def run(coroutine):
+        task = asyncio.create_task(coroutine)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    # Started by the supervisor as one of several workers in this room: only subscribe to
+    # the video of the participants hashed to this worker, the other workers take the rest.
+    options, subscribe_published = subscribe_by_shard(room, lk_id, rtc.TrackKind.KIND_VIDEO)
+
+    @room.on("track_subscribed")
+    def on_track_subscribed(
+            subscribed_track: rtc.Track,
+            publication: rtc.RemoteTrackPublication,
+            participant: rtc.RemoteParticipant,
+    ):
+        logging.info(f"🛤 on_track_subscribed('{subscribed_track.sid}')")
+        if subscribed_track.kind != rtc.TrackKind.KIND_VIDEO or subscribed_track.sid in pipelines:
+            return
+        if is_agent_output(publication, participant, lk_id):
+            logging.info(f"🛤 skipping {participant.identity}'s agent output {publication.name}")
+            publication.set_subscribed(False)  # auto subscribed, don't keep receiving it
+            return
+
+        output_name = f"masked-{participant.identity}"
+        recorder = recorder_factory(output_name) if recorder_factory is not None else None
+        pipeline = TrackPipeline(
+            room, subscribed_track, output_name, width, height,
+            handle_frame=handle_frame, executor=executor, quality=quality, ready=ready, recorder=recorder,
+        )
+        pipelines[subscribed_track.sid] = pipeline
+        logging.info(f"🛤️ {subscribed_track.sid} pipeline #{len(pipelines)} started.")
+        run(pipeline.start())
+
+    @room.on("track_unsubscribed")
+    def on_track_unsubscribed(unsubscribed_track: rtc.Track, *_):
+        logging.info(f"🛤 on_track_unsubscribed({unsubscribed_track.name})")
+        pipeline = pipelines.pop(unsubscribed_track.sid, None)
+        if pipeline is not None:
+            run(pipeline.stop())
+
+    @room.on("disconnected")
+    def on_disconnected(*_):
+        for pipeline in pipelines.values():
+            pipeline.mailbox.close()
+        pipelines.clear()
+        if owns_executor:
+            executor.shutdown()
+
+    token = build_token(lk_id, lk_name)
+    await room.connect(os.getenv("LIVEKIT_URL"), token.to_jwt(), options)
+    logging.info(f"connected to room: {room.name}")
+    subscribe_published()
+    if ready is not None:
+        await ready
+        logging.info(f"ready: {room.name}")
+
+
 def loop_on(main: Callable[[rtc.Room], Awaitable[None]]):
     """
     Sets up the main loop, preps a rtc.Room with said loop,
@@ -331,6 +886,8 @@ def loop_on(main: Callable[[rtc.Room], Awaitable[None]]):
         main (Callable[[rtc.Room], Awaitable[None]]): The main function to be called with the room.
 
     """
+    # CR_THREADS, when started by the supervisor.
+    configure_worker_threads()
     loop = asyncio.get_event_loop()
     room = rtc.Room(loop=loop)
 
@@ -341,6 +898,8 @@ def loop_on(main: Callable[[rtc.Room], Awaitable[None]]):
     asyncio.ensure_future(main(room))
     for signal in [SIGINT, SIGTERM]:
         loop.add_signal_handler(signal, lambda: asyncio.ensure_future(cleanup()))
+    # kill -USR1 <pid> toggles hot path profiling, kill -USR2 <pid> tracemalloc.
+    install_profiling_signals(loop)
 
     try:
         loop.run_forever()
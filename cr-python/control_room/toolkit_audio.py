@@ -0,0 +1,324 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from aiohttp import ClientSession, TCPConnector
+from livekit import rtc
+from livekit.agents import stt
+from livekit.agents.stt import SpeechEventType
+
+from control_room.toolkit_metrics import (
+    AUDIO_BYTES_PUSHED,
+    AUDIO_FRAMES_GATED,
+    AUDIO_FRAMES_PUSHED,
+    AUDIO_FRAMES_RECEIVED,
+    STT_STREAMS,
+    forget_track,
+)
+
+# Builds the speech to text client, given the agent's shared http session.
+SttFactory = Callable[[ClientSession], stt.STT]
+# Called with each final transcript and the identity of the participant who said it.
+TextHandler = Callable[[str, str], Awaitable[None]]
+
+
+def deepgram_stt(session: ClientSession) -> stt.STT:
+    """Deepgram streaming STT, DEEPGRAM_API_KEY is read from the environment (see load_config)."""
+    from livekit.plugins import deepgram
+
+    return deepgram.STT(http_session=session)
+
+
+def frame_level_db(frame: rtc.AudioFrame) -> float:
+    """RMS level of a 16 bit frame in dBFS, all channels together, -100 for digital silence."""
+    samples = np.frombuffer(frame.data, dtype=np.int16).astype(np.float32)
+    if samples.size == 0:
+        return -100.0
+    rms = np.sqrt(np.mean(np.square(samples))) / 32768.0
+    return float(20.0 * np.log10(max(rms, 1e-5)))
+
+
+class EnergyGate:
+    def __init__(self, threshold_db: float = -45.0, hangover: float = 0.5, preroll: float = 0.2):
+        """Voice activity by frame energy: let speech through, hold silence back.
+
+        The gate opens on the first frame louder than threshold_db and stays open for hangover
+        seconds after the last loud one, so word endings and pauses inside sentences go through.
+        While closed, the last preroll seconds are kept and sent ahead of the frame that opens
+        it, the quiet onset of a word isn't clipped.
+
+        Args:
+            threshold_db: RMS level in dBFS a frame needs to open the gate, about -45 for a
+                          close microphone, lower it for distant / quiet speakers
+            hangover: seconds the gate stays open after speech
+            preroll: seconds of audio held back while closed, sent when it opens
+        """
+        self.threshold_db = threshold_db
+        self.hangover = hangover
+        self.preroll = preroll
+        self._open_for = 0.0
+        self._held: deque = deque()  # (frame, seconds), the preroll
+        self._held_seconds = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return self._open_for > 0.0
+
+    def push(self, frame: rtc.AudioFrame) -> List[rtc.AudioFrame]:
+        """Frames to send upstream now, empty while the gate is closed."""
+        seconds = frame.samples_per_channel / frame.sample_rate
+        if frame_level_db(frame) >= self.threshold_db:
+            self._open_for = self.hangover
+            frames = [held for held, _ in self._held] + [frame]
+            self._held.clear()
+            self._held_seconds = 0.0
+            return frames
+
+        if self._open_for > 0.0:
+            self._open_for -= seconds
+            return [frame]
+
+        self._held.append((frame, seconds))
+        self._held_seconds += seconds
+        while self._held and self._held_seconds - self._held[0][1] >= self.preroll:
+            _, dropped = self._held.popleft()
+            self._held_seconds -= dropped
+        return []
+
+
+def lowpass_taps(cutoff: float, taps: int = 63) -> np.ndarray:
+    """Hamming windowed sinc low-pass FIR, cutoff in cycles per sample (0.5 is Nyquist), unity DC gain."""
+    n = np.arange(taps) - (taps - 1) / 2
+    h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+    return (h / h.sum()).astype(np.float32)
+
+
+def stt_audio_format(client: stt.STT) -> Tuple[int, int]:
+    """(sample rate, channels) client's streams expect, Deepgram's plugin streams 48kHz mono."""
+    options = getattr(client, "_opts", client)
+    return int(getattr(options, "sample_rate", 48000)), int(getattr(options, "num_channels", 1))
+
+
+class AudioChunker:
+    def __init__(self, sample_rate: int = 48000, channels: int = 1, max_latency: float = 0.1):
+        """Converts audio frames to one format and regroups them into fixed size chunks.
+
+        Frames are downmixed to mono by averaging channels (or duplicated to more channels),
+        resampled by linear interpolation, carrying the phase between frames so chunk
+        boundaries don't click, and written straight into the next chunk's AudioFrame buffer.
+        When downsampling, e.g. 48kHz WebRTC audio to a 16kHz STT, a windowed sinc low-pass
+        first removes what's above the output's Nyquist frequency, which would otherwise
+        alias into the speech band, its history carried between frames too.
+        A chunk holds max_latency seconds, it's the most audio kept back before it's pushed.
+
+        Deepgram's plugin already regroups pushed frames into 100ms pieces and takes 48kHz
+        mono, so with it the chunker mostly saves per frame overhead, rechunking pays off
+        with the mock STT and other services sending whatever they're pushed.
+
+        Args:
+            sample_rate, channels: output format, what the STT stream expects
+            max_latency: chunk length in seconds, e.g. 0.1 turns 10ms WebRTC frames into 100ms pushes
+        """
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.chunk_samples = max(1, int(round(sample_rate * max_latency)))
+        self._chunk: Optional[rtc.AudioFrame] = None
+        self._chunk_array: Optional[np.ndarray] = None
+        self._filled = 0
+        self._input_rate = 0
+        self._last: Optional[float] = None  # last input sample of the previous frame
+        self._position = 0.0  # next output sample, in input samples from _last
+        self._taps: Optional[np.ndarray] = None  # anti-aliasing filter, when downsampling
+        self._history: Optional[np.ndarray] = None  # last len(_taps) - 1 input samples
+
+    def _convert(self, frame: rtc.AudioFrame) -> np.ndarray:
+        """frame as (samples,) float32 mono at sample_rate."""
+        samples = np.frombuffer(frame.data, dtype=np.int16).reshape(-1, frame.num_channels)
+        if samples.size == 0:
+            return np.empty(0, np.float32)
+        mono = samples[:, 0].astype(np.float32) if frame.num_channels == 1 else samples.mean(axis=1, dtype=np.float32)
+        if frame.sample_rate != self._input_rate:
+            self._input_rate = frame.sample_rate
+            self._last = None
+            self._position = 0.0
+            self._taps = None
+            if frame.sample_rate > self.sample_rate:
+                # Pass band up to 90% of the output's Nyquist frequency.
+                self._taps = lowpass_taps(0.45 * self.sample_rate / frame.sample_rate)
+                self._history = np.zeros(len(self._taps) - 1, np.float32)
+        if frame.sample_rate == self.sample_rate:
+            return mono
+
+        if self._taps is not None:
+            padded = np.concatenate((self._history, mono))
+            self._history = padded[len(mono):]
+            mono = np.convolve(padded, self._taps, mode="valid").astype(np.float32)
+
+        source = mono if self._last is None else np.concatenate(([self._last], mono))
+        step = frame.sample_rate / self.sample_rate
+        positions = np.arange(self._position, len(source) - 1 + 1e-6, step)
+        resampled = np.interp(positions, np.arange(len(source)), source).astype(np.float32)
+        end = positions[-1] + step if len(positions) else self._position
+        self._position = end - (len(source) - 1)
+        self._last = float(source[-1])
+        return resampled
+
+    def push(self, frame: rtc.AudioFrame) -> List[rtc.AudioFrame]:
+        """Chunks completed by frame, often none."""
+        mono = self._convert(frame)
+        chunks = []
+        offset = 0
+        while offset < len(mono):
+            if self._chunk is None:
+                self._chunk = rtc.AudioFrame.create(self.sample_rate, self.channels, self.chunk_samples)
+                self._chunk_array = np.frombuffer(self._chunk.data, dtype=np.int16).reshape(-1, self.channels)
+                self._filled = 0
+            count = min(len(mono) - offset, self.chunk_samples - self._filled)
+            block = np.clip(np.rint(mono[offset:offset + count]), -32768, 32767)
+            # Broadcast over the output channels, the cast to int16 happens in the assignment.
+            self._chunk_array[self._filled:self._filled + count] = block[:, None]
+            self._filled += count
+            offset += count
+            if self._filled == self.chunk_samples:
+                chunks.append(self._chunk)
+                self._chunk = None
+        return chunks
+
+    def flush(self) -> List[rtc.AudioFrame]:
+        """The partial chunk, if any, e.g. when speech ends or the track does."""
+        if self._chunk is None or self._filled == 0:
+            return []
+        samples = self._filled
+        data = self._chunk_array[:samples].tobytes()
+        self._chunk = None
+        self._filled = 0
+        return [rtc.AudioFrame(data, self.sample_rate, self.channels, samples)]
+
+
+class AudioTranscriber:
+    def __init__(
+            self,
+            handle_text: TextHandler,
+            stt_factory: SttFactory = deepgram_stt,
+            gate_factory: Optional[Callable[[], EnergyGate]] = EnergyGate,
+            max_connections: int = 32,
+            max_latency: float = 0.1,
+    ):
+        """One STT stream per subscribed audio track, over one pooled http session.
+
+        Each track gets its own rtc.AudioStream, EnergyGate, AudioChunker and stt.SpeechStream,
+        so speakers are never mixed in one transcript, and a listener task handing final
+        transcripts to handle_text. Silent frames never leave the process, the others are
+        converted to the STT's format and pushed in max_latency long chunks, the stream is
+        flushed each time the gate closes so the service finalizes the utterance right away.
+
+        Args:
+            handle_text: awaited with (text, participant identity) for each final transcript
+            stt_factory: builds the STT client from the shared session, deepgram_stt by default,
+                         see toolkit_mock_stt.mock_stt_factory for a local test server
+            gate_factory: builds a track's EnergyGate, None sends every frame
+            max_connections: connection pool size of the shared session
+            max_latency: seconds of audio gathered per push, see AudioChunker
+        """
+        self.handle_text = handle_text
+        self.stt_factory = stt_factory
+        self.gate_factory = gate_factory
+        self.max_connections = max_connections
+        self.max_latency = max_latency
+        self.session: Optional[ClientSession] = None
+        self.stt: Optional[stt.STT] = None
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def _ensure_stt(self) -> stt.STT:
+        if self.stt is None:
+            # Created on the running loop, and only once: every stream shares its connections.
+            self.session = ClientSession(connector=TCPConnector(limit=self.max_connections))
+            self.stt = self.stt_factory(self.session)
+        return self.stt
+
+    def add_track(self, track: rtc.Track, identity: str = ""):
+        """Start transcribing track, a no-op if it's already being transcribed."""
+        if track.sid in self._tasks:
+            return
+        task = asyncio.ensure_future(self._transcribe(track, identity))
+        self._tasks[track.sid] = task
+        task.add_done_callback(lambda _, sid=track.sid: self._tasks.pop(sid, None))
+
+    def remove_track(self, sid: str):
+        task = self._tasks.get(sid)
+        if task is not None:
+            task.cancel()
+
+    async def _listen(self, stream: stt.SpeechStream, identity: str):
+        async for event in stream:
+            if event.type == SpeechEventType.FINAL_TRANSCRIPT and event.alternatives:
+                text = event.alternatives[0].text
+                if not text:
+                    continue
+                logging.info(f"🔊 [{identity}] {text}")
+                try:
+                    await self.handle_text(text, identity)
+                except Exception:
+                    logging.exception("transcript handler failed")
+
+    async def _transcribe(self, track: rtc.Track, identity: str):
+        logging.info(f"🎙 transcribing {track.sid} ({identity})")
+        client = self._ensure_stt()
+        stream = client.stream()
+        STT_STREAMS.inc()
+        listener = asyncio.ensure_future(self._listen(stream, identity))
+        audio_stream = rtc.AudioStream(track)
+        gate = self.gate_factory() if self.gate_factory is not None else None
+        chunker = AudioChunker(*stt_audio_format(client), self.max_latency)
+        frames_received = AUDIO_FRAMES_RECEIVED.labels(track.sid)
+        frames_gated = AUDIO_FRAMES_GATED.labels(track.sid)
+        frames_pushed = AUDIO_FRAMES_PUSHED.labels(track.sid)
+        bytes_pushed = AUDIO_BYTES_PUSHED.labels(track.sid)
+
+        def push(chunks: List[rtc.AudioFrame]):
+            for chunk in chunks:
+                stream.push_frame(chunk)
+                frames_pushed.inc()
+                bytes_pushed.inc(chunk.data.nbytes)
+
+        try:
+            async for event in audio_stream:
+                frames_received.inc()
+                if gate is None:
+                    push(chunker.push(event.frame))
+                    continue
+                was_open = gate.is_open
+                frames = gate.push(event.frame)
+                if not frames:
+                    frames_gated.inc()
+                for frame in frames:
+                    push(chunker.push(frame))
+                if was_open and not gate.is_open:
+                    push(chunker.flush())
+                    stream.flush()
+            # Track ended: let the service finish what it has, then stop listening.
+            push(chunker.flush())
+            stream.end_input()
+            await listener
+        finally:
+            listener.cancel()
+            STT_STREAMS.dec()
+            await stream.aclose()
+            await audio_stream.aclose()
+            forget_track(track.sid)
+            logging.info(f"🎙 stopped transcribing {track.sid}")
+
+    async def aclose(self):
+        """Stop every track's stream, then close the STT client and the shared session."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.stt is not None:
+            await self.stt.aclose()
+            self.stt = None
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+from numpy import ndarray
+
+from control_room.toolkit_profile import PROFILER
+
+
+class MicroBatcher:
+    def __init__(
+            self,
+            batch_block: Callable[[List[ndarray]], List[ndarray]],
+            max_batch_size: int = 4,
+            max_latency: float = 0.010,
+            with_tracks: bool = False,
+    ):
+        """Gather frames, from one or several tracks, into batches for a single batch_block call.
+
+        A batch is dispatched as soon as max_batch_size frames are waiting, or max_latency
+        seconds after its first frame arrived. Only one batch runs at a time, on a dedicated
+        worker thread, frames arriving meanwhile accumulate into the next batch.
+
+        Exposes the same submit() / max_in_flight / shutdown() surface as FrameExecutor,
+        so it can be handed to the frame loopers in its place.
+
+        Args:
+            batch_block: Function taking a list of frames and returning the list of processed
+                         frames, in the same order. Frames may differ in size.
+            max_batch_size: Upper bound on frames per batch_block call.
+            max_latency: Seconds the first frame of a batch may wait for company.
+            with_tracks: Call batch_block(frames, tracks) instead, tracks being the sid of each
+                         frame's input track (or None), for blocks keeping per track state.
+        """
+        self.batch_block = batch_block
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_latency = max_latency
+        self.with_tracks = with_tracks
+        self.mode = "batch"
+        # Keep enough frames in flight for a track to fill a batch on its own.
+        self.max_in_flight = self.max_batch_size
+
+        self.batches = 0
+        self.frames = 0
+
+        self._waiting: List[Tuple[ndarray, Optional[str], asyncio.Future]] = []
+        self._deadline: Optional[asyncio.TimerHandle] = None
+        self._running = False
+        self._task: Optional[asyncio.Future] = None
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="batch-worker")
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.frames / self.batches if self.batches else 0.0
+
+    def submit(self, np_frame: ndarray, track: Optional[str] = None, timestamp_us: int = 0) -> asyncio.Future:
+        """Queue np_frame, from input track, for the next batch, returns a future resolving to the processed frame.
+
+        timestamp_us is accepted for FrameExecutor compatibility, unused.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._waiting.append((np_frame, track, future))
+
+        if len(self._waiting) >= self.max_batch_size:
+            self._flush()
+        elif self._deadline is None:
+            self._deadline = loop.call_later(self.max_latency, self._flush)
+        return future
+
+    def _flush(self):
+        if self._deadline is not None:
+            self._deadline.cancel()
+            self._deadline = None
+        if self._running or not self._waiting:
+            # the running batch flushes again when it completes.
+            return
+
+        batch = [entry for entry in self._waiting[:self.max_batch_size] if not entry[2].cancelled()]
+        del self._waiting[:self.max_batch_size]
+        if not batch:
+            self._flush()
+            return
+
+        self._running = True
+        self._task = asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: List[Tuple[ndarray, Optional[str], asyncio.Future]]):
+        loop = asyncio.get_running_loop()
+        frames = [f for f, _, _ in batch]
+        tracks = [t for _, t, _ in batch]
+        start_time = time.perf_counter()
+        try:
+            results = await loop.run_in_executor(self._executor, self._run_batch, frames, tracks)
+            if len(results) != len(frames):
+                raise ValueError(f"batch_block returned {len(results)} frames for {len(frames)}")
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._running = False
+
+        self.batches += 1
+        self.frames += len(frames)
+        if self.batches % 60 == 0:
+            logging.info(
+                f"📦 batch of {len(frames)} in {time.perf_counter() - start_time:.4f}s,"
+                f" mean batch size {self.mean_batch_size:.2f}"
+            )
+
+        # Whatever piled up while we were busy goes out right away if it's a full
+        # batch or its deadline fired meanwhile, otherwise its deadline still runs.
+        if len(self._waiting) >= self.max_batch_size or (self._waiting and self._deadline is None):
+            self._flush()
+
+    def _run_batch(self, frames: List[ndarray], tracks: List[Optional[str]]) -> List[ndarray]:
+        with PROFILER.span("batch_worker"), PROFILER.sample():
+            if self.with_tracks:
+                return self.batch_block(frames, tracks)
+            return self.batch_block(frames)
+
+    def shutdown(self, wait: bool = False):
+        if self._deadline is not None:
+            self._deadline.cancel()
+            self._deadline = None
+        for _, _, future in self._waiting:
+            future.cancel()
+        self._waiting.clear()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
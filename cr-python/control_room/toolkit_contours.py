@@ -0,0 +1,214 @@
+import threading
+from typing import List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from control_room.toolkit_overlay import SPRITES, blit
+from control_room.toolkit_profile import PROFILER
+from control_room.toolkit_quality import QualityKnob
+
+
+def detect_shape(contour: ndarray) -> str:
+    """Name the polygon a contour approximates: triangle, square, rectangle, pentagon, hexagon or circle."""
+    shape = "unidentified"
+    perimeter = cv2.arcLength(contour, True)
+    approximation = cv2.approxPolyDP(contour, 0.04 * perimeter, True)
+
+    if len(approximation) == 3:
+        shape = "triangle"
+    elif len(approximation) == 4:
+        (x, y, w, h) = cv2.boundingRect(approximation)
+        aspect_ratio = w / float(h)
+        shape = "square" if 0.95 <= aspect_ratio <= 1.05 else "rectangle"
+    elif len(approximation) == 5:
+        shape = "pentagon"
+    elif len(approximation) == 6:
+        shape = "hexagon"
+    else:
+        shape = "circle"
+    return shape
+
+
+class _ContourBuffers:
+    def __init__(self, small_shape: Tuple[int, int]):
+        height, width = small_shape
+        self.small = np.empty((height, width, 3), dtype=np.uint8)
+        self.gray = np.empty((height, width), dtype=np.uint8)
+        self.blurred = np.empty((height, width), dtype=np.uint8)
+        self.thresh = np.empty((height, width), dtype=np.uint8)
+
+
+class _ShapeTrack:
+    __slots__ = ("center", "area", "shape", "age", "missed")
+
+    def __init__(self, center: Tuple[float, float], area: float, shape: str):
+        self.center = center
+        self.area = area
+        self.shape = shape
+        self.age = 0
+        self.missed = 0
+
+
+class ContourStage:
+    def __init__(
+            self,
+            scale: float = 0.5,
+            blur: int = 7,
+            threshold: int = 120,
+            min_area: float = 100.0,
+            color: Tuple[int, int, int] = (0, 255, 0),
+            thickness: int = 2,
+            label_shapes: bool = True,
+            reclassify_every: int = 30,
+            max_missed: int = 5,
+            scales: Optional[Sequence[float]] = None,
+    ):
+        """Outline dark shapes on RGB frames in-place, optionally labelled with their shape.
+
+        The analysis (gray, blur, threshold, findContours) runs on a copy downscaled by `scale`
+        into preallocated buffers, contours are scaled back up and drawn on the full resolution
+        frame with a single drawContours call.
+
+        Shape classification is cached on lightweight tracks, contours are matched to last
+        frame's tracks by centroid and area, a matched contour reuses its track's shape and is
+        only classified again every reclassify_every frames.
+
+        Buffers are per thread, tracks are shared, so it can run on several frame workers.
+
+        Args:
+            scale: analysis resolution, as a fraction of the frame's
+            blur: Gaussian kernel size at full resolution, scaled along with the frame
+            threshold: gray level under which pixels count as shape
+            min_area: ignore contours smaller than this, in full resolution pixels
+            color: outline and label color, RGB
+            thickness: outline thickness in full resolution pixels
+            label_shapes: draw the detected shape name next to each contour
+            reclassify_every: frames a track keeps its shape before it's classified again
+            max_missed: frames a track survives without a matching contour
+            scales: analysis scales a QualityController may step down through,
+                    defaults to scale, scale / 2 and scale / 4
+        """
+        self.scale = scale
+        self.blur = blur
+        self.threshold = threshold
+        self.min_area = min_area
+        self.color = color
+        self.thickness = thickness
+        self.label_shapes = label_shapes
+        self.reclassify_every = reclassify_every
+        self.max_missed = max_missed
+
+        self._local = threading.local()
+        self._tracks: List[_ShapeTrack] = []
+        self._tracks_lock = threading.Lock()
+        self.classified = 0
+        self.cached = 0
+
+        scales = scales or (scale, scale / 2, scale / 4)
+        self.quality_knobs = [QualityKnob("contour_scale", scales, self._set_scale)]
+
+    def _set_scale(self, scale: float):
+        # Read once per frame, buffers for the new size are created on first use.
+        self.scale = scale
+
+    def _buffers(self, small_shape: Tuple[int, int]) -> _ContourBuffers:
+        buffers_by_shape = getattr(self._local, "buffers", None)
+        if buffers_by_shape is None:
+            buffers_by_shape = self._local.buffers = {}
+        buffers = buffers_by_shape.get(small_shape)
+        if buffers is None:
+            buffers = buffers_by_shape[small_shape] = _ContourBuffers(small_shape)
+        return buffers
+
+    def find(self, np_frame: ndarray, scale: float) -> Tuple[List[ndarray], float]:
+        """Contours of np_frame at analysis scale, and the factor mapping them back to full resolution."""
+        height, width = np_frame.shape[:2]
+        small_w, small_h = max(1, round(width * scale)), max(1, round(height * scale))
+        buffers = self._buffers((small_h, small_w))
+
+        with PROFILER.span("contours_analyse"):
+            if (small_w, small_h) == (width, height):
+                cv2.cvtColor(np_frame, cv2.COLOR_RGB2GRAY, dst=buffers.gray)
+            else:
+                cv2.resize(np_frame, (small_w, small_h), dst=buffers.small, interpolation=cv2.INTER_AREA)
+                cv2.cvtColor(buffers.small, cv2.COLOR_RGB2GRAY, dst=buffers.gray)
+            kernel = max(3, int(self.blur * small_w / width) | 1)
+            cv2.GaussianBlur(buffers.gray, (kernel, kernel), 0, dst=buffers.blurred)
+            cv2.threshold(buffers.blurred, self.threshold, 255, cv2.THRESH_BINARY_INV, dst=buffers.thresh)
+            contours, _ = cv2.findContours(buffers.thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        upscale = width / small_w
+        min_area = self.min_area / (upscale * upscale)
+        return [contour for contour in contours if cv2.contourArea(contour) >= min_area], upscale
+
+    def classify(self, contours: List[ndarray]) -> List[str]:
+        """Shape per contour, from the matching track when there is one."""
+        moments = [cv2.moments(contour) for contour in contours]
+        centers = [
+            (m["m10"] / m["m00"], m["m01"] / m["m00"]) if m["m00"] else tuple(contour[0, 0])
+            for m, contour in zip(moments, contours)
+        ]
+        areas = [m["m00"] for m in moments]
+
+        with self._tracks_lock:
+            unmatched = list(self._tracks)
+            tracks = []
+            shapes = []
+            for contour, center, area in zip(contours, centers, areas):
+                track = _nearest_track(unmatched, center, area)
+                if track is None or track.age >= self.reclassify_every:
+                    shape = detect_shape(contour)
+                    self.classified += 1
+                    if track is None:
+                        track = _ShapeTrack(center, area, shape)
+                    else:
+                        unmatched.remove(track)
+                        track.shape, track.age = shape, 0
+                else:
+                    unmatched.remove(track)
+                    self.cached += 1
+                track.center, track.area, track.missed = center, area, 0
+                track.age += 1
+                tracks.append(track)
+                shapes.append(track.shape)
+
+            for track in unmatched:
+                track.missed += 1
+                if track.missed <= self.max_missed:
+                    tracks.append(track)
+            self._tracks = tracks
+        return shapes
+
+    def __call__(self, np_frame: ndarray) -> ndarray:
+        contours, upscale = self.find(np_frame, self.scale)
+        if not contours:
+            return np_frame
+
+        with PROFILER.span("contours_draw"):
+            if upscale != 1.0:
+                full = [(contour * upscale).astype(np.int32) for contour in contours]
+            else:
+                full = contours
+            cv2.drawContours(np_frame, full, -1, self.color, self.thickness)
+
+            if self.label_shapes:
+                for contour, shape in zip(full, self.classify(contours)):
+                    x, y = contour[:, 0].min(axis=0)
+                    blit(np_frame, SPRITES.text(shape, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1, self.color), (x, y - 10))
+        return np_frame
+
+
+def _nearest_track(tracks: List[_ShapeTrack], center: Tuple[float, float], area: float) -> Optional[_ShapeTrack]:
+    """Closest track within half its size, whose area is within a factor 1.5 of area."""
+    best, best_distance = None, None
+    for track in tracks:
+        if not (track.area / 1.5 <= area <= track.area * 1.5):
+            continue
+        distance = (track.center[0] - center[0]) ** 2 + (track.center[1] - center[1]) ** 2
+        if distance > track.area / 4:
+            continue
+        if best_distance is None or distance < best_distance:
+            best, best_distance = track, distance
+    return best
@@ -1,9 +1,12 @@
 from collections import deque
 
+from control_room.toolkit_frame import FrameBuffer, publish_frame
+from control_room.toolkit_metrics import STAGE_SECONDS
+from control_room.toolkit_profile import PROFILER
+from control_room.toolkit_quality import QualityKnob
 from control_room.toolkit_object_detect import draw_perf_bkg
 
 from livekit import rtc
-from livekit.rtc import VideoFrame
 from livekit.rtc import VideoFrameEvent
 
 from numpy import ndarray
@@ -12,7 +15,9 @@ from typing import Callable
 
 import colorsys
 import cv2
+import math
 import numpy as np
+import threading
 import time
 
 
@@ -37,10 +42,58 @@ def draw_red_dot(image: np.ndarray) -> np.ndarray:
     return image
 
 
+class _TintBuffers:
+    def __init__(self, shape):
+        self.color = None
+        self.premultiplied = np.empty(shape, dtype=np.uint16)  # color * alpha, per pixel
+        self.work = np.empty(shape, dtype=np.uint16)
+
+
+class TintEffect:
+    def __init__(self, alpha: float = 0.5):
+        """Blend a color over whole frames in-place, with 8-bit fixed-point integer math.
+
+        Keeps a preallocated, premultiplied tint buffer per resolution, only refreshed when
+        the color changes, and a work buffer, so applying the tint allocates nothing:
+        frame = (frame * (256 - a) + color * a) >> 8
+
+        Buffers are per thread, so the effect can run on several frame workers at once.
+
+        Args:
+            alpha: tint opacity, 0 to 1
+        """
+        self.alpha = int(round(alpha * 256))
+        self._local = threading.local()
+
+    def _buffers(self, shape) -> _TintBuffers:
+        buffers_by_shape = getattr(self._local, "buffers", None)
+        if buffers_by_shape is None:
+            buffers_by_shape = self._local.buffers = {}
+        buffers = buffers_by_shape.get(shape)
+        if buffers is None:
+            buffers = buffers_by_shape[shape] = _TintBuffers(shape)
+        return buffers
+
+    def __call__(self, np_frame: ndarray, color) -> ndarray:
+        buffers = self._buffers(np_frame.shape)
+        color = tuple(color)
+        if color != buffers.color:
+            buffers.premultiplied[...] = np.array(color, dtype=np.uint16) * self.alpha
+            buffers.color = color
+
+        work = buffers.work
+        np.multiply(np_frame, 256 - self.alpha, out=work, dtype=np.uint16)
+        work += buffers.premultiplied
+        np.right_shift(work, 8, out=work)
+        np.copyto(np_frame, work, casting="unsafe")
+        return np_frame
+
+
+# 50% transparency
+_color_cycle_tint = TintEffect(alpha=0.5)
+
+
 def draw_color_cycle(np_frame: ndarray) -> ndarray:
-    import math
-    import time
-    
     # Calculate hue using sine wave oscillating between 0 and 1
     # Time-based animation creates smooth color cycling
     # Divide time by 5 to slow down the cycle by 5x
@@ -53,12 +106,8 @@ def draw_color_cycle(np_frame: ndarray) -> ndarray:
     # Fill entire frame with the RGB color
     # np_frame[:, :] = rgb
 
-    # Instead, overlay RGB color with alpha blending
-    alpha = 0.5  # 50% transparency
-    overlay = np.full_like(np_frame, rgb)
-    cv2.addWeighted(overlay, alpha, np_frame, 1 - alpha, 0, np_frame)
-
-    return np_frame
+    # Instead, overlay RGB color with alpha blending, in-place, from a cached tint buffer
+    return _color_cycle_tint(np_frame, rgb)
 
 
 def empty_block(np_frame: ndarray) -> ndarray:
@@ -74,11 +123,20 @@ class PerfDecorator:
         """
         self.block = block
         self.frame_times = deque(maxlen=120)
-        
+        self.hud = True
+        # The HUD is the first thing to go when a QualityController runs short on time.
+        self.quality_knobs = [QualityKnob("perf_hud", (True, False), self._set_hud)]
+        self.quality_knobs += getattr(block, "quality_knobs", [])
+
+    def _set_hud(self, hud: bool):
+        self.hud = hud
+
     def __call__(self, np_frame: ndarray) -> ndarray:
         start_time = time.perf_counter()
         # Call block
         new_frame = self.block(np_frame)
+        if new_frame is None:
+            new_frame = np_frame
         end_time = time.perf_counter()
         # Calculate FPS
         self.frame_times.append(end_time)
@@ -86,6 +144,8 @@ class PerfDecorator:
             fps = len(self.frame_times) / (self.frame_times[-1] - self.frame_times[0])
         else:
             fps = 0.0
+        if not self.hud:
+            return new_frame
         return draw_perf_bkg(new_frame, fps, end_time - start_time)
 
 
@@ -103,17 +163,18 @@ def draw_on_frame(
         block: Function that takes and returns a numpy array representing an image.
               Defaults to empty_block which makes no changes.
     """
-    buffer: VideoFrame = frame_event.frame
-    np_frame: ndarray = np.frombuffer(buffer.data, dtype=np.uint8)
-    np_frame = np_frame.reshape((buffer.height, buffer.width, 3))
-
-    # Call block
-    new_frame = block(np_frame)
-
-    frame = rtc.VideoFrame(
-        buffer.width, buffer.height,
-        rtc.VideoBufferType.RGB24,
-        new_frame.data
-    )
-    output_source.capture_frame(frame)
-
+    # Writable RGB view over the event's own buffer, in-place blocks cost no copies.
+    start_time = time.perf_counter()
+    with PROFILER.span("buffer_wrap"):
+        frame_buffer = FrameBuffer(frame_event.frame)
+    wrapped_time = time.perf_counter()
+    STAGE_SECONDS.labels("buffer_wrap").observe(wrapped_time - start_time)
+
+    # Call block, blocks returning None are assumed to have drawn in-place.
+    with PROFILER.span("block"), PROFILER.sample():
+        new_frame = block(frame_buffer.array)
+    if new_frame is None:
+        new_frame = frame_buffer.array
+    STAGE_SECONDS.labels("block").observe(time.perf_counter() - wrapped_time)
+
+    publish_frame(output_source, new_frame, frame_buffer)
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional
+
+from numpy import ndarray
+
+from control_room.toolkit_profile import PROFILER
+from control_room.toolkit_shm import SharedMemoryWorkers
+
+# Where a processing block runs relative to the asyncio event loop.
+EXECUTOR_INLINE = "inline"  # on the event loop itself (legacy behaviour)
+EXECUTOR_THREAD = "thread"  # on a thread pool, good for cv2 / torch which release the GIL
+EXECUTOR_PROCESS = "process"  # on worker processes, frames go through shared memory, the block must be picklable
+EXECUTOR_MODES = (EXECUTOR_INLINE, EXECUTOR_THREAD, EXECUTOR_PROCESS)
+
+
+class FrameExecutor:
+    def __init__(
+            self,
+            block: Callable[[ndarray], ndarray],
+            mode: str = EXECUTOR_INLINE,
+            max_workers: Optional[int] = None,
+            max_in_flight: Optional[int] = None,
+            pipelines: int = 1,
+    ):
+        """Run a synchronous ndarray processing block off the event loop.
+
+        Args:
+            block: Function that takes and returns a numpy array representing an image.
+                   In process mode it must be a picklable, module level callable,
+                   frames are handed over in a SharedMemoryWorkers ring, not pickled.
+            mode: One of EXECUTOR_INLINE, EXECUTOR_THREAD or EXECUTOR_PROCESS.
+            max_workers: Pool size, defaults to 1 (inline) or 2 (thread/process).
+            max_in_flight: Upper bound on frames submitted but not yet published,
+                           defaults to max_workers, per pipeline.
+            pipelines: Pipelines expected to share the executor, in process mode the
+                       shared memory ring gets max_in_flight slots for each.
+        """
+        if mode not in EXECUTOR_MODES:
+            raise ValueError(f"unknown executor mode '{mode}', expected one of {EXECUTOR_MODES}")
+
+        self.block = block
+        self.mode = mode
+        self.max_workers = 1 if mode == EXECUTOR_INLINE else (max_workers or 2)
+        self.max_in_flight = max(1, max_in_flight or self.max_workers)
+        self.pipelines = max(1, pipelines)
+
+        self._executor: Optional[Executor] = None
+        self._shared: Optional[SharedMemoryWorkers] = None
+        if mode == EXECUTOR_THREAD:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="frame-worker")
+        elif mode == EXECUTOR_PROCESS:
+            # One slot per frame in flight, frames larger than OUTPUT_WIDTH x OUTPUT_HEIGHT, or
+            # coming while every slot is taken (more pipelines than expected), fall back to a
+            # pickling process pool, started on first use.
+            self._shared = SharedMemoryWorkers(block, self.max_workers, self.max_in_flight * self.pipelines)
+
+        logging.info(
+            f"🧵 FrameExecutor({mode}) workers={self.max_workers} max_in_flight={self.max_in_flight}"
+            f" pipelines={self.pipelines}"
+        )
+
+    def submit(self, np_frame: ndarray, track: Optional[str] = None, timestamp_us: int = 0) -> asyncio.Future:
+        """Schedule the block on np_frame, returns a future resolving to the processed frame.
+
+        track, the frame's input track sid, is accepted for MicroBatcher compatibility, unused.
+        timestamp_us, the frame's capture time, goes in its shared memory slot header in process mode.
+        """
+        loop = asyncio.get_running_loop()
+        if self.mode == EXECUTOR_PROCESS:
+            # profiling state lives in this process, workers run the bare block.
+            if self._shared.fits(np_frame) and self._shared.available:
+                return self._shared.submit(np_frame, timestamp_us)
+            return loop.run_in_executor(self._process_pool(), self.block, np_frame)
+
+        if self._executor is None:
+            future = loop.create_future()
+            try:
+                future.set_result(self._run_block(np_frame))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        return loop.run_in_executor(self._executor, self._run_block, np_frame)
+
+    def _process_pool(self) -> Executor:
+        if self._executor is None:
+            logging.info(f"🧵 FrameExecutor({self.mode}) starting the fallback process pool")
+            # spawn, like the shared memory workers: don't fork livekit's FFI threads.
+            self._executor = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def release(self, future: asyncio.Future):
+        """Done with future's result, in process mode it's a shared memory slot, handed back for reuse."""
+        if self._shared is not None:
+            self._shared.release(future)
+
+    def _run_block(self, np_frame: ndarray) -> ndarray:
+        with PROFILER.span("block_worker"), PROFILER.sample():
+            return self.block(np_frame)
+
+    def shutdown(self, wait: bool = False):
+        if self._shared is not None:
+            self._shared.shutdown(wait=wait)
+            self._shared = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
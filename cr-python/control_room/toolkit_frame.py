@@ -0,0 +1,125 @@
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from livekit import rtc
+from livekit.rtc import VideoFrame
+from numpy import ndarray
+
+from control_room.toolkit_metrics import STAGE_SECONDS
+from control_room.toolkit_profile import PROFILER
+
+# Channel order of the numpy views handed to processing blocks. Blocks should
+# pick their cv2 conversion codes from this (e.g. COLOR_RGB2GRAY) rather than
+# round-tripping through BGR.
+CHANNEL_ORDER_RGB = "RGB"
+CHANNEL_ORDER_RGBA = "RGBA"
+CHANNEL_ORDER_BGRA = "BGRA"
+# OpenCV's own order, cv2.VideoCapture frames, never handed to blocks by the pipelines.
+CHANNEL_ORDER_BGR = "BGR"
+
+_BUFFER_TYPE_LAYOUTS = {
+    rtc.VideoBufferType.RGB24: (CHANNEL_ORDER_RGB, 3),
+    rtc.VideoBufferType.RGBA: (CHANNEL_ORDER_RGBA, 4),
+    rtc.VideoBufferType.BGRA: (CHANNEL_ORDER_BGRA, 4),
+}
+
+
+class FrameBuffer:
+    def __init__(self, video_frame: VideoFrame):
+        """A writable (height, width, channels) numpy view over a VideoFrame's own memory.
+
+        Writing to `array` writes straight into `video_frame`, so the frame can be
+        captured by a VideoSource without any further copy.
+
+        Args:
+            video_frame: A packed VideoFrame, RGB24, RGBA or BGRA.
+        """
+        if video_frame.type not in _BUFFER_TYPE_LAYOUTS:
+            raise ValueError(f"unsupported VideoBufferType {video_frame.type}")
+
+        self.video_frame = video_frame
+        self.channel_order, channels = _BUFFER_TYPE_LAYOUTS[video_frame.type]
+        self.array: ndarray = np.frombuffer(video_frame.data, dtype=np.uint8).reshape(
+            (video_frame.height, video_frame.width, channels)
+        )
+
+    @property
+    def width(self) -> int:
+        return self.video_frame.width
+
+    @property
+    def height(self) -> int:
+        return self.video_frame.height
+
+    def is_view(self, np_frame: ndarray) -> bool:
+        """True when np_frame is this buffer's full frame view (same memory, same layout)."""
+        return (
+                np_frame.__array_interface__["data"][0] == self.array.__array_interface__["data"][0]
+                and np_frame.shape == self.array.shape
+                and np_frame.strides == self.array.strides
+        )
+
+
+class FrameBufferPool:
+    def __init__(self, buffer_type: int = rtc.VideoBufferType.RGB24):
+        """Preallocated output FrameBuffers, one per resolution.
+
+        Buffers are reused from one frame to the next. This is safe as long as a buffer
+        is filled and captured without awaiting in between, VideoSource.capture_frame()
+        copies synchronously.
+        """
+        self.buffer_type = buffer_type
+        self._buffers: Dict[Tuple[int, int], FrameBuffer] = {}
+
+    def acquire(self, width: int, height: int) -> FrameBuffer:
+        key = (width, height)
+        frame_buffer = self._buffers.get(key)
+        if frame_buffer is None:
+            _, channels = _BUFFER_TYPE_LAYOUTS[self.buffer_type]
+            video_frame = rtc.VideoFrame(
+                width, height, self.buffer_type, bytearray(width * height * channels)
+            )
+            frame_buffer = FrameBuffer(video_frame)
+            self._buffers[key] = frame_buffer
+        return frame_buffer
+
+
+# Shared by every output path running on the event loop thread.
+OUTPUT_BUFFER_POOL = FrameBufferPool()
+
+
+def publish_frame(
+        output_source: rtc.VideoSource,
+        np_frame: ndarray,
+        source: Optional[FrameBuffer] = None,
+        pool: FrameBufferPool = OUTPUT_BUFFER_POOL,
+):
+    """Capture np_frame on output_source with as few copies as possible.
+
+    - np_frame is a view of source (block drew in-place): source's VideoFrame is captured as is.
+    - np_frame is a view of a pooled buffer (block wrote into it): that buffer is captured as is.
+    - anything else is copied once into the pooled buffer for its resolution.
+
+    Args:
+        output_source: VideoSource to output the frame to
+        np_frame: (height, width, channels) frame to publish
+        source: the FrameBuffer the block was handed, if any
+        pool: where output buffers come from
+    """
+    if source is not None and source.is_view(np_frame):
+        video_frame = source.video_frame
+    else:
+        start_time = time.perf_counter()
+        with PROFILER.span("video_frame"):
+            height, width = np_frame.shape[:2]
+            out = pool.acquire(width, height)
+            if not out.is_view(np_frame):
+                np.copyto(out.array, np_frame)
+            video_frame = out.video_frame
+        STAGE_SECONDS.labels("encode").observe(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    with PROFILER.span("capture_frame"):
+        output_source.capture_frame(video_frame)
+    STAGE_SECONDS.labels("capture_frame").observe(time.perf_counter() - start_time)
@@ -0,0 +1,80 @@
+import asyncio
+from typing import Generic, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class LatestFrameMailbox(Generic[T]):
+    def __init__(self, name: str = ""):
+        """Single slot 'latest value wins' channel between one producer and one consumer.
+
+        put() never blocks and never refuses a value: when the consumer hasn't picked up
+        the pending value yet it gets overwritten, so the consumer always works on the
+        freshest frame. Both ends must live on the same event loop, there are no locks
+        because nothing here awaits between reading and writing the slot.
+
+        close() marks the end of stream, a pending value is still delivered before
+        get() starts returning None.
+
+        Args:
+            name: identifies the stream in logs and metrics, e.g. the input track sid
+        """
+        self.name = name
+        self._value: Optional[T] = None
+        self._has_value = False
+        self._closed = False
+        self._ready = asyncio.Event()
+
+        self.received = 0  # values put
+        self.overwritten = 0  # values replaced before the consumer got them
+        self.delivered = 0  # values handed to the consumer
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def pending(self) -> bool:
+        return self._has_value
+
+    @property
+    def drop_rate(self) -> float:
+        return self.overwritten / self.received if self.received else 0.0
+
+    def put(self, value: T):
+        """Store value, replacing any pending one. Values put after close() are ignored."""
+        if self._closed:
+            return
+        self.received += 1
+        if self._has_value:
+            self.overwritten += 1
+        self._value = value
+        self._has_value = True
+        self._ready.set()
+
+    def close(self):
+        self._closed = True
+        self._ready.set()
+
+    async def get(self) -> Optional[T]:
+        """Wait for the latest value, returns None once closed and drained."""
+        while not self._has_value:
+            if self._closed:
+                return None
+            self._ready.clear()
+            await self._ready.wait()
+
+        value = self._value
+        self._value = None
+        self._has_value = False
+        self.delivered += 1
+        return value
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> T:
+        value = await self.get()
+        if value is None:
+            raise StopAsyncIteration
+        return value
@@ -0,0 +1,301 @@
+import asyncio
+import bisect
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+# Seconds, tuned for per-frame work: a 30 fps budget is 0.033.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.033, 0.05, 0.1, 0.2, 0.5, 1.0, 2.5, 5.0)
+
+
+def _format_labels(labelnames: Sequence[str], labelvalues: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children: Dict[Tuple[str, ...], "_Metric"] = {}
+
+    def labels(self, *labelvalues) -> "_Metric":
+        """The child metric for these label values, created on first use."""
+        key = tuple(str(v) for v in labelvalues)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def remove(self, *labelvalues):
+        """Drop the child metric for these label values, it's no longer rendered."""
+        key = tuple(str(v) for v in labelvalues)
+        with self._lock:
+            self._children.pop(key, None)
+
+    def _new_child(self) -> "_Metric":
+        return type(self)(self.name, self.documentation)
+
+    def _samples(self) -> List[Tuple[str, Tuple[str, ...], str, float]]:
+        """(suffix, labelvalues, extra label, value) of this metric and its children."""
+        if not self.labelnames:
+            return [(suffix, (), extra, value) for suffix, extra, value in self._values()]
+        return [
+            (suffix, key, extra, value)
+            for key, child in list(self._children.items())
+            for suffix, extra, value in child._values()
+        ]
+
+    def _values(self) -> List[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labelvalues, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, labelvalues, extra)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def _values(self):
+        return [("", "", self.value)]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.inc(-amount)
+
+    def _values(self):
+        return [("", "", self.value)]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Sequence[str] = (),
+            buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def _new_child(self):
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def _values(self):
+        values = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            values.append(("_bucket", f'le="{le}"', cumulative))
+        values.append(("_sum", "", self.sum))
+        values.append(("_count", "", self.count))
+        return values
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """Named metrics, rendered in the Prometheus text exposition format."""
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric):
+                raise ValueError(f"metric {metric.name} already registered as a {existing.kind}")
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Sequence[str] = (),
+            buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in list(self._metrics.values())) + "\n"
+
+    def write(self, path: str):
+        """Atomically replace path with the current rendering (node_exporter textfile style)."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file:
+            file.write(self.render())
+        os.replace(tmp_path, path)
+
+
+REGISTRY = MetricsRegistry()
+
+# Frame pipeline metrics, labelled by input track sid.
+FRAMES_RECEIVED = REGISTRY.counter("cr_frames_received_total", "Frames read from input video streams", ("track",))
+FRAMES_DROPPED = REGISTRY.counter("cr_frames_dropped_total", "Frames overwritten before being processed", ("track",))
+FRAMES_PROCESSED = REGISTRY.counter("cr_frames_processed_total", "Frames that went through the block", ("track",))
+FRAMES_PUBLISHED = REGISTRY.counter("cr_frames_published_total", "Frames captured on output sources", ("track",))
+STAGE_SECONDS = REGISTRY.histogram(
+    "cr_stage_seconds", "Time spent per pipeline stage: buffer_wrap (FrameBuffer over the decoded frame), block, encode, capture_frame", ("stage",)
+)
+FRAME_LATENCY_SECONDS = REGISTRY.histogram(
+    "cr_frame_latency_seconds", "Input frame event timestamp to output capture", ("track",)
+)
+QUEUE_DEPTH = REGISTRY.gauge("cr_queue_depth", "Frames waiting in the input mailbox", ("track",))
+IN_FLIGHT = REGISTRY.gauge("cr_in_flight", "Frames submitted to workers and not yet published", ("track",))
+
+# Audio pipeline metrics, labelled by input track sid.
+AUDIO_FRAMES_RECEIVED = REGISTRY.counter(
+    "cr_audio_frames_received_total", "Frames read from input audio streams", ("track",)
+)
+AUDIO_FRAMES_GATED = REGISTRY.counter(
+    "cr_audio_frames_gated_total", "Silent audio frames held back from the speech to text service", ("track",)
+)
+AUDIO_FRAMES_PUSHED = REGISTRY.counter(
+    "cr_audio_frames_pushed_total", "Audio chunks pushed to speech to text streams", ("track",)
+)
+AUDIO_BYTES_PUSHED = REGISTRY.counter(
+    "cr_audio_bytes_pushed_total", "Audio bytes pushed to speech to text streams", ("track",)
+)
+STT_STREAMS = REGISTRY.gauge("cr_stt_streams", "Open speech to text streams")
+
+# Segmentation agents, labelled by input track sid: masks from the model vs reused from the mask cache.
+MASKS_COMPUTED = REGISTRY.counter("cr_masks_computed_total", "Segmentation masks computed by the model", ("track",))
+MASKS_REUSED = REGISTRY.counter("cr_masks_reused_total", "Segmentation masks reused from a keyframe", ("track",))
+
+# Recorder metrics, labelled by recorder name.
+RECORDER_FRAMES_WRITTEN = REGISTRY.counter(
+    "cr_recorder_frames_written_total", "Frames encoded into recording segments", ("recorder",)
+)
+RECORDER_FRAMES_DROPPED = REGISTRY.counter(
+    "cr_recorder_frames_dropped_total", "Frames not recorded, the writer being behind", ("recorder", "reason")
+)
+RECORDER_QUEUE_DEPTH = REGISTRY.gauge("cr_recorder_queue_depth", "Frames waiting to be encoded", ("recorder",))
+
+
+# Every metric labelled by input track sid alone.
+TRACK_METRICS = (
+    FRAMES_RECEIVED,
+    FRAMES_DROPPED,
+    FRAMES_PROCESSED,
+    FRAMES_PUBLISHED,
+    FRAME_LATENCY_SECONDS,
+    QUEUE_DEPTH,
+    IN_FLIGHT,
+    AUDIO_FRAMES_RECEIVED,
+    AUDIO_FRAMES_GATED,
+    AUDIO_FRAMES_PUSHED,
+    AUDIO_BYTES_PUSHED,
+    MASKS_COMPUTED,
+    MASKS_REUSED,
+)
+
+
+def forget_track(sid: str):
+    """Remove the children of a track that's gone, so tracks coming and going don't pile up series."""
+    for metric in TRACK_METRICS:
+        metric.remove(sid)
+
+
+def frame_age(timestamp_us: int) -> Optional[float]:
+    """Seconds since a VideoFrameEvent's timestamp_us, None if it's from another clock.
+
+    libwebrtc stamps received frames with its monotonic microsecond clock, which is
+    CLOCK_MONOTONIC on Linux, same as time.monotonic().
+    """
+    age = time.monotonic() - timestamp_us / 1_000_000
+    return age if 0.0 <= age < 60.0 else None
+
+
+async def serve_metrics(port: int, host: str = "0.0.0.0", registry: MetricsRegistry = REGISTRY) -> web.AppRunner:
+    """Expose registry on http://host:port/metrics, returns the runner to cleanup() on exit."""
+
+    async def handle_metrics(_: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"📈 metrics on http://{host}:{port}/metrics")
+    return runner
+
+
+async def export_metrics(path: str, interval: float = 5.0, registry: MetricsRegistry = REGISTRY):
+    """Rewrite path with the registry's rendering every interval seconds, until cancelled."""
+    logging.info(f"📈 metrics exported to {path} every {interval}s")
+    try:
+        while True:
+            registry.write(path)
+            await asyncio.sleep(interval)
+    finally:
+        registry.write(path)
+
+
+_export_tasks = set()
+
+
+def start_metrics_export():
+    """Start the exports configured through METRICS_PORT and/or METRICS_FILE, once per process."""
+    if _export_tasks:
+        return
+    port = os.getenv("METRICS_PORT")
+    path = os.getenv("METRICS_FILE")
+    if port:
+        _export_tasks.add(asyncio.ensure_future(serve_metrics(int(port))))
+    if path:
+        _export_tasks.add(asyncio.ensure_future(export_metrics(path)))
@@ -0,0 +1,188 @@
+"""
+A local stand-in for Deepgram's live transcription websocket, and the STT client talking to it.
+
+The server speaks the part of the protocol the agents use: linear16 audio in binary messages,
+KeepAlive / Finalize / CloseStream text messages, SpeechStarted and Results events out. It
+"transcribes" every utterance_seconds of audio it receives, or whatever it has on Finalize, into
+a transcript describing the audio, and counts connections, bytes and audio seconds received,
+served as JSON on /stats, to see what voice activity gating saves.
+
+    python -m control_room.toolkit_mock_stt --port 8765
+
+then set "stt_url": "ws://localhost:8765/v1/listen" in config.json.
+"""
+import argparse
+import asyncio
+import json
+import logging
+from typing import Optional
+
+import aiohttp
+from aiohttp import ClientSession, web
+from livekit.agents import stt
+from livekit.agents.stt import SpeechData, SpeechEvent, SpeechEventType
+
+from control_room.toolkit_audio import SttFactory
+
+MOCK_LANGUAGE = "en-US"
+
+
+class MockSttServer:
+    def __init__(self, utterance_seconds: float = 2.0):
+        """Deepgram-like live transcription endpoint at /v1/listen, statistics at /stats.
+
+        Args:
+            utterance_seconds: audio received per emitted final transcript
+        """
+        self.utterance_seconds = utterance_seconds
+        self.stats = {"connections": 0, "open": 0, "bytes": 0, "audio_seconds": 0.0, "transcripts": 0}
+        self.app = web.Application()
+        self.app.router.add_get("/v1/listen", self.listen)
+        self.app.router.add_get("/stats", self.get_stats)
+
+    async def get_stats(self, _: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    async def listen(self, request: web.Request) -> web.WebSocketResponse:
+        sample_rate = int(request.query.get("sample_rate", 48000))
+        channels = int(request.query.get("channels", 1))
+        bytes_per_second = sample_rate * channels * 2
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.stats["connections"] += 1
+        self.stats["open"] += 1
+        pending = 0  # bytes not transcribed yet
+        utterances = 0
+
+        async def transcribe():
+            nonlocal pending, utterances
+            if pending == 0:
+                return
+            seconds = pending / bytes_per_second
+            utterances += 1
+            pending = 0
+            self.stats["transcripts"] += 1
+            await ws.send_json({
+                "type": "Results",
+                "is_final": True,
+                "speech_final": True,
+                "channel": {"alternatives": [{
+                    "transcript": f"utterance {utterances}, {seconds:.1f} seconds",
+                    "confidence": 1.0,
+                    "words": [],
+                }]},
+            })
+
+        try:
+            async for message in ws:
+                if message.type == aiohttp.WSMsgType.BINARY:
+                    if pending == 0:
+                        await ws.send_json({"type": "SpeechStarted"})
+                    pending += len(message.data)
+                    self.stats["bytes"] += len(message.data)
+                    self.stats["audio_seconds"] += len(message.data) / bytes_per_second
+                    if pending >= self.utterance_seconds * bytes_per_second:
+                        await transcribe()
+                elif message.type == aiohttp.WSMsgType.TEXT:
+                    kind = json.loads(message.data).get("type")
+                    if kind == "Finalize":
+                        await transcribe()
+                    elif kind == "CloseStream":
+                        await transcribe()
+                        break
+        finally:
+            self.stats["open"] -= 1
+            await ws.close()
+        return ws
+
+    async def serve(self, port: int, host: str = "0.0.0.0") -> web.AppRunner:
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logging.info(f"🎧 mock STT on ws://{host}:{port}/v1/listen")
+        return runner
+
+
+class MockSpeechStream(stt.SpeechStream):
+    def __init__(self, url: str, session: ClientSession, sample_rate: int = 16000, num_channels: int = 1):
+        self._url = f"{url}?encoding=linear16&sample_rate={sample_rate}&channels={num_channels}"
+        self._session = session
+        super().__init__()
+
+    async def _main_task(self) -> None:
+        async with self._session.ws_connect(self._url) as ws:
+            async def send():
+                async for data in self._input_ch:
+                    if isinstance(data, self._FlushSentinel):
+                        await ws.send_str(json.dumps({"type": "Finalize"}))
+                    else:
+                        await ws.send_bytes(data.data.tobytes())
+                await ws.send_str(json.dumps({"type": "CloseStream"}))
+
+            async def receive():
+                async for message in ws:
+                    if message.type != aiohttp.WSMsgType.TEXT:
+                        continue
+                    data = json.loads(message.data)
+                    if data["type"] == "SpeechStarted":
+                        self._event_ch.send_nowait(SpeechEvent(type=SpeechEventType.START_OF_SPEECH))
+                    elif data["type"] == "Results":
+                        alternatives = [
+                            SpeechData(language=MOCK_LANGUAGE, text=alt["transcript"], confidence=alt["confidence"])
+                            for alt in data["channel"]["alternatives"]
+                        ]
+                        self._event_ch.send_nowait(
+                            SpeechEvent(type=SpeechEventType.FINAL_TRANSCRIPT, alternatives=alternatives)
+                        )
+                        self._event_ch.send_nowait(SpeechEvent(type=SpeechEventType.END_OF_SPEECH))
+
+            sender = asyncio.ensure_future(send())
+            try:
+                await receive()
+            finally:
+                sender.cancel()
+
+
+class MockSTT(stt.STT):
+    def __init__(self, url: str, session: ClientSession, sample_rate: int = 16000, num_channels: int = 1):
+        """Streaming STT client for MockSttServer, over the given session.
+
+        sample_rate and num_channels are the audio format its streams expect, 16kHz mono, like
+        most speech models are trained on, by default.
+        """
+        super().__init__(capabilities=stt.STTCapabilities(streaming=True, interim_results=False))
+        self.url = url
+        self.session = session
+        self.sample_rate = sample_rate
+        self.num_channels = num_channels
+
+    async def recognize(self, buffer, *, language: Optional[str] = None) -> SpeechEvent:
+        raise NotImplementedError("the mock STT only streams")
+
+    def stream(self, *, language: Optional[str] = None) -> MockSpeechStream:
+        return MockSpeechStream(self.url, self.session, self.sample_rate, self.num_channels)
+
+
+def mock_stt_factory(url: str, sample_rate: int = 16000) -> SttFactory:
+    """An AudioTranscriber stt_factory transcribing with the MockSttServer at url."""
+    return lambda session: MockSTT(url, session, sample_rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Deepgram-like live transcription server.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--utterance-seconds", type=float, default=2.0, help="audio per final transcript")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.new_event_loop()
+    server = MockSttServer(args.utterance_seconds)
+    loop.run_until_complete(server.serve(args.port))
+    try:
+        loop.run_forever()
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,17 @@
-from typing import Callable
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, List, Optional, Sequence, Tuple
 
 import cv2
 import numpy as np
 
+from control_room.toolkit_metrics import STAGE_SECONDS
+from control_room.toolkit_overlay import SPRITES, blit
+from control_room.toolkit_profile import PROFILER
+from control_room.toolkit_quality import QualityKnob
+
 
 MARGIN = 10  # pixel
 ROW_SIZE = 16  # pixels
@@ -64,15 +73,13 @@ def draw_perf_bkg(image: np.ndarray, fps: float, latency: float) -> np.ndarray:
     latency_text = f"LATENCY: {latency:.4f}"
     wh_text = f"[{width},{height}]"
 
-    # Function to draw text with background
+    # Function to draw text with background, from cached sprites blended over their own rectangle only.
     def draw_text_with_bg(bkg_image, text, loc):
-        (text_w, text_h), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_PLAIN, FONT_SIZE * F, FONT_THICKNESS * F)
-        bg_rect_start = (loc[0] - 5, loc[1] - text_h - 5)
-        bg_rect_end = (loc[0] + text_w + 5, loc[1] + 5)
-        overlay = bkg_image.copy()
-        cv2.rectangle(overlay, bg_rect_start, bg_rect_end, (0, 0, 0), -1)
-        cv2.addWeighted(overlay, 0.5, bkg_image, 0.5, 0, bkg_image)
-        cv2.putText(bkg_image, text, loc, cv2.FONT_HERSHEY_PLAIN, FONT_SIZE * F, (0, 255, 0), FONT_THICKNESS * F)
+        sprite = SPRITES.text(
+            text, cv2.FONT_HERSHEY_PLAIN, FONT_SIZE * F, FONT_THICKNESS * F,
+            color=(0, 255, 0), background=(0, 0, 0), background_alpha=0.5, padding=5,
+        )
+        blit(bkg_image, sprite, loc)
 
     # Draw texts with background
     draw_text_with_bg(image, fps_text, fps_loc)
@@ -113,7 +120,312 @@ def visualize(
         result_text = category_name + ' (' + str(probability) + ')'
         text_location = (MARGIN + bbox.origin_x,
                          MARGIN + ROW_SIZE + bbox.origin_y)
-        cv2.putText(image, result_text, text_location, cv2.FONT_HERSHEY_PLAIN,
-                    FONT_SIZE, TEXT_COLOR, FONT_THICKNESS)
+        label = SPRITES.text(result_text, cv2.FONT_HERSHEY_PLAIN, FONT_SIZE, FONT_THICKNESS, color=TEXT_COLOR)
+        blit(image, label, text_location)
 
     return image
+
+
+# Results, shaped like mediapipe's tasks.vision ObjectDetectorResult, which visualize() draws.
+
+class Category:
+    def __init__(self, category_name: str, score: float, index: int = -1):
+        self.category_name = category_name
+        self.score = score
+        self.index = index
+
+
+class BoundingBox:
+    def __init__(self, origin_x: int, origin_y: int, width: int, height: int):
+        self.origin_x = origin_x
+        self.origin_y = origin_y
+        self.width = width
+        self.height = height
+
+
+class Detection:
+    def __init__(self, bounding_box: BoundingBox, categories: List[Category]):
+        self.bounding_box = bounding_box
+        self.categories = categories
+
+
+class DetectionResult:
+    def __init__(self, detections: Optional[List[Detection]] = None):
+        self.detections = detections or []
+
+
+DNN_SSD = "ssd"  # (1, 1, N, 7) rows of [image, class, score, x0, y0, x1, y1], normalized
+DNN_YOLO = "yolo"  # (1, N, 5 + C) YOLOv5 style or (1, 4 + C, N) YOLOv8 style, center boxes in input pixels
+DNN_OUTPUT_FORMATS = (DNN_SSD, DNN_YOLO)
+
+
+class DnnDetector:
+    def __init__(
+            self,
+            model_path: str,
+            config_path: str = "",
+            labels: Optional[Sequence[str]] = None,
+            output_format: str = DNN_SSD,
+            input_size: Tuple[int, int] = (320, 320),
+            scale: float = 1 / 255,
+            mean: Tuple[float, float, float] = (0, 0, 0),
+            swap_rb: bool = False,
+            score_threshold: float = 0.5,
+            nms_threshold: float = 0.45,
+    ):
+        """A CPU object detector on OpenCV's dnn module, for any model file it can read (.onnx, .pb, .caffemodel...).
+
+        Split in prepare(), cheap and run on the frame's thread, and detect(), the inference,
+        so DetectionStage can hand the latter to a background thread without copying frames.
+
+        Args:
+            model_path: local model file
+            config_path: companion config file for frameworks that need one
+            labels: category names by class index, indices are used as names when missing
+            output_format: DNN_SSD or DNN_YOLO, how to decode the network's output
+            input_size: network input (width, height)
+            scale, mean, swap_rb: blobFromImage preprocessing, frames come in RGB
+            score_threshold: drop detections scoring less
+            nms_threshold: non maximum suppression IoU threshold
+        """
+        if output_format not in DNN_OUTPUT_FORMATS:
+            raise ValueError(f"unknown output format '{output_format}', expected one of {DNN_OUTPUT_FORMATS}")
+        self.net = cv2.dnn.readNet(model_path, config_path)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.labels = list(labels) if labels else []
+        self.output_format = output_format
+        self.input_size = input_size
+        self.scale = scale
+        self.mean = mean
+        self.swap_rb = swap_rb
+        self.score_threshold = score_threshold
+        self.nms_threshold = nms_threshold
+        logging.info(f"🔎 DnnDetector {model_path} {output_format} {input_size}")
+
+    def prepare(self, np_frame: np.ndarray) -> Tuple[np.ndarray, int, int]:
+        """The network input blob for an RGB frame, and the frame's size."""
+        height, width = np_frame.shape[:2]
+        blob = cv2.dnn.blobFromImage(np_frame, self.scale, self.input_size, self.mean, self.swap_rb, crop=False)
+        return blob, width, height
+
+    def detect(self, prepared: Tuple[np.ndarray, int, int]) -> List[Detection]:
+        """Detections in frame pixel coordinates."""
+        blob, width, height = prepared
+        self.net.setInput(blob)
+        output = self.net.forward()
+        if self.output_format == DNN_SSD:
+            boxes, scores, classes = self._decode_ssd(output, width, height)
+        else:
+            boxes, scores, classes = self._decode_yolo(output, width, height)
+        if not boxes:
+            return []
+
+        keep = cv2.dnn.NMSBoxes(boxes, scores, self.score_threshold, self.nms_threshold)
+        return [
+            Detection(BoundingBox(*boxes[i]), [Category(self._label(classes[i]), scores[i], classes[i])])
+            for i in np.array(keep).flatten()
+        ]
+
+    def __call__(self, np_frame: np.ndarray) -> List[Detection]:
+        return self.detect(self.prepare(np_frame))
+
+    def _label(self, index: int) -> str:
+        return self.labels[index] if 0 <= index < len(self.labels) else str(index)
+
+    def _decode_ssd(self, output: np.ndarray, width: int, height: int):
+        rows = output.reshape(-1, 7)
+        rows = rows[rows[:, 2] >= self.score_threshold]
+        boxes, scores, classes = [], [], []
+        for _, class_id, score, x0, y0, x1, y1 in rows:
+            x0, y0 = int(x0 * width), int(y0 * height)
+            boxes.append([x0, y0, int(x1 * width) - x0, int(y1 * height) - y0])
+            scores.append(float(score))
+            classes.append(int(class_id))
+        return boxes, scores, classes
+
+    def _decode_yolo(self, output: np.ndarray, width: int, height: int):
+        rows = output[0]
+        labelled = len(self.labels)
+        if rows.shape[0] < rows.shape[1] and (not labelled or rows.shape[0] == 4 + labelled):
+            # YOLOv8: (4 + C, N), no objectness
+            rows = rows.T
+            class_scores = rows[:, 4:]
+        else:
+            # YOLOv5: (N, 5 + C), class scores weighted by objectness
+            class_scores = rows[:, 5:] * rows[:, 4:5]
+        classes = class_scores.argmax(axis=1)
+        scores = class_scores[np.arange(len(classes)), classes]
+        keep = scores >= self.score_threshold
+        rows, classes, scores = rows[keep], classes[keep], scores[keep]
+
+        x_factor = width / self.input_size[0]
+        y_factor = height / self.input_size[1]
+        boxes = [
+            [int((cx - w / 2) * x_factor), int((cy - h / 2) * y_factor), int(w * x_factor), int(h * y_factor)]
+            for cx, cy, w, h in rows[:, :4]
+        ]
+        return boxes, scores.astype(float).tolist(), classes.astype(int).tolist()
+
+
+class _BoxTrack:
+    __slots__ = ("box", "velocity", "frame_index", "category")
+
+    def __init__(self, box: np.ndarray, frame_index: int, category: Category):
+        self.box = box  # x, y, w, h as floats
+        self.velocity = np.zeros(4)  # per frame
+        self.frame_index = frame_index
+        self.category = category
+
+    def at(self, frame_index: int) -> np.ndarray:
+        return self.box + self.velocity * (frame_index - self.frame_index)
+
+
+class DetectionStage:
+    def __init__(
+            self,
+            detector: Any,
+            every: int = 5,
+            background: bool = True,
+            min_iou: float = 0.3,
+            smoothing: float = 0.5,
+            draw: bool = True,
+    ):
+        """Object detection every few frames, boxes carried along by a constant velocity tracker in between.
+
+        On a detection frame, new boxes are matched to the tracked ones by IoU within the same
+        category, a matched track takes the new box and updates its velocity, unmatched
+        detections start new tracks and unmatched tracks are dropped. In between, boxes are
+        extrapolated, which costs a few multiplications per object.
+
+        In background mode, inference runs on its own thread while frames keep flowing with
+        extrapolated boxes, results are merged at the frame index they were taken from.
+        Otherwise it runs on the frame's thread, making every `every`-th frame slower.
+
+        The latest result is kept in `result`, shaped like mediapipe's, so visualize() draws it.
+
+        Args:
+            detector: either a callable taking an RGB frame and returning a list of Detection,
+                      or an object with prepare(np_frame) and detect(prepared), like DnnDetector,
+                      prepare() runs on the frame's thread and must not keep references to the frame
+            every: run detection on one frame in this many
+            background: run detection off the frame's thread
+            min_iou: IoU a detection needs with a track to continue it
+            smoothing: weight of the new velocity estimate against the previous one
+            draw: __call__ draws the boxes with visualize(), otherwise it only updates `result`
+        """
+        self.detector = detector
+        self.every = every
+        self.min_iou = min_iou
+        self.smoothing = smoothing
+        self.draw = draw
+        self.result = DetectionResult()
+        self.detections_run = 0
+
+        self._prepare = getattr(detector, "prepare", np.copy)
+        self._detect = getattr(detector, "detect", detector)
+        self._tracks: List[_BoxTrack] = []
+        self._lock = threading.Lock()
+        self._frame_index = 0
+        self._last_detection = None
+        self._pending: Optional[Future] = None
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="detector") if background else None
+
+        self.quality_knobs = [QualityKnob("detect_every", (every, every * 2, every * 4), self._set_every)]
+
+    def _set_every(self, every: int):
+        self.every = every
+
+    def update(self, np_frame: np.ndarray) -> DetectionResult:
+        """Advance one frame, detecting if it's time, and return the boxes for this frame."""
+        with self._lock:
+            self._frame_index += 1
+            frame_index = self._frame_index
+            due = self._last_detection is None or frame_index - self._last_detection >= self.every
+
+            if self._pending is not None and self._pending.done():
+                # Cleared first: a failed detection mustn't stop the next keyframe from resubmitting.
+                future, self._pending = self._pending, None
+                try:
+                    self._merge(*future.result())
+                except Exception:
+                    logging.exception("background detection failed, tracks kept as they were")
+
+            if due and self._pending is None:
+                self._last_detection = frame_index
+                prepared = self._prepare(np_frame)
+                if self._executor is not None:
+                    self._pending = self._executor.submit(self._run_detector, prepared, frame_index)
+                else:
+                    self._merge(*self._run_detector(prepared, frame_index))
+
+            height, width = np_frame.shape[:2]
+            self.result = DetectionResult([
+                Detection(_to_bounding_box(track.at(frame_index), width, height), [track.category])
+                for track in self._tracks
+            ])
+        return self.result
+
+    def __call__(self, np_frame: np.ndarray) -> np.ndarray:
+        result = self.update(np_frame)
+        if not self.draw:
+            return np_frame
+        with PROFILER.span("detect_draw"):
+            return visualize(np_frame, result)
+
+    def _run_detector(self, prepared, frame_index: int) -> Tuple[List[Detection], int]:
+        start_time = time.perf_counter()
+        with PROFILER.span("detect"):
+            detections = self._detect(prepared)
+        STAGE_SECONDS.labels("detect").observe(time.perf_counter() - start_time)
+        return detections, frame_index
+
+    def _merge(self, detections: List[Detection], frame_index: int):
+        """Fold a detection result taken at frame_index into the tracks, called with the lock held."""
+        self.detections_run += 1
+        unmatched = list(self._tracks)
+        tracks = []
+        for detection in sorted(detections, key=lambda d: -d.categories[0].score):
+            bbox = detection.bounding_box
+            box = np.array([bbox.origin_x, bbox.origin_y, bbox.width, bbox.height], dtype=np.float64)
+            category = detection.categories[0]
+
+            best, best_iou = None, self.min_iou
+            for track in unmatched:
+                if track.category.category_name != category.category_name:
+                    continue
+                iou = _iou(track.at(frame_index), box)
+                if iou >= best_iou:
+                    best, best_iou = track, iou
+
+            if best is None:
+                tracks.append(_BoxTrack(box, frame_index, category))
+                continue
+            unmatched.remove(best)
+            elapsed = frame_index - best.frame_index
+            if elapsed > 0:
+                velocity = (box - best.box) / elapsed
+                best.velocity = self.smoothing * velocity + (1 - self.smoothing) * best.velocity
+            best.box, best.frame_index, best.category = box, frame_index, category
+            tracks.append(best)
+        self._tracks = tracks
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _iou(a: np.ndarray, b: np.ndarray) -> float:
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[0] + a[2], b[0] + b[2]), min(a[1] + a[3], b[1] + b[3])
+    intersection = max(0.0, x1 - x0) * max(0.0, y1 - y0)
+    union = a[2] * a[3] + b[2] * b[3] - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def _to_bounding_box(box: np.ndarray, width: int, height: int) -> BoundingBox:
+    x0 = int(min(max(box[0], 0), width - 1))
+    y0 = int(min(max(box[1], 0), height - 1))
+    x1 = int(min(max(box[0] + box[2], x0 + 1), width))
+    y1 = int(min(max(box[1] + box[3], y0 + 1), height))
+    return BoundingBox(x0, y0, x1 - x0, y1 - y0)
@@ -0,0 +1,134 @@
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+class Sprite:
+    def __init__(self, rgba: np.ndarray, origin: Tuple[int, int] = (0, 0)):
+        """A small RGBA image, prepared for fixed-point alpha blending.
+
+        Args:
+            rgba: (h, w, 4) uint8, straight (not premultiplied) alpha
+            origin: pixel of the sprite that lands on the blit position, e.g. a text baseline
+        """
+        alpha = rgba[..., 3:4].astype(np.uint16)
+        # alpha scaled to 0..256, so blending divides with a shift: (dst * (256 - a) + src * a) >> 8
+        alpha = (alpha * 256 + 127) // 255
+        self.height, self.width = rgba.shape[:2]
+        self.origin = origin
+        self.premultiplied = rgba[..., :3].astype(np.uint16) * alpha
+        self.inverse_alpha = (256 - alpha).astype(np.uint16)
+
+
+def blit(image: np.ndarray, sprite: Sprite, position: Tuple[int, int]) -> np.ndarray:
+    """Alpha-blend sprite onto image in-place, touching only the pixels under it.
+
+    Args:
+        image: (H, W, 3) uint8 frame, modified in-place
+        sprite: what to draw
+        position: where the sprite's origin lands, sprites are clipped to the image
+
+    Returns:
+        np.ndarray: image
+    """
+    height, width = image.shape[:2]
+    x = position[0] - sprite.origin[0]
+    y = position[1] - sprite.origin[1]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + sprite.width, width), min(y + sprite.height, height)
+    if x0 >= x1 or y0 >= y1:
+        return image
+
+    sx0, sy0 = x0 - x, y0 - y
+    sx1, sy1 = sx0 + (x1 - x0), sy0 + (y1 - y0)
+    roi = image[y0:y1, x0:x1]
+    blended = roi * sprite.inverse_alpha[sy0:sy1, sx0:sx1]
+    blended += sprite.premultiplied[sy0:sy1, sx0:sx1]
+    np.right_shift(blended, 8, out=blended)
+    roi[...] = blended
+    return image
+
+
+def fill(
+        image: np.ndarray,
+        color: Tuple[int, int, int],
+        alpha: float,
+        rect: Optional[Tuple[int, int, int, int]] = None,
+) -> np.ndarray:
+    """Blend a solid color over image, or over rect (x0, y0, x1, y1) only, in-place.
+
+    Two saturating cv2 passes over the region, no frame sized temporary.
+    """
+    roi = image if rect is None else image[rect[1]:rect[3], rect[0]:rect[2]]
+    if roi.size == 0:
+        return image
+    keep = 1.0 - alpha
+    cv2.multiply(roi, (keep, keep, keep, 0), dst=roi)
+    cv2.add(roi, tuple(c * alpha for c in color) + (0,), dst=roi)
+    return image
+
+
+class SpriteCache:
+    def __init__(self, max_entries: int = 256):
+        """Rendered text sprites, keyed by everything that affects their pixels, LRU evicted.
+
+        Safe to share between frame worker threads.
+        """
+        self.max_entries = max_entries
+        self._sprites: "OrderedDict[tuple, Sprite]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def text(
+            self,
+            text: str,
+            font_face: int = cv2.FONT_HERSHEY_PLAIN,
+            font_scale: float = 1.0,
+            thickness: int = 1,
+            color: Tuple[int, int, int] = (0, 255, 0),
+            background: Tuple[int, int, int] = (0, 0, 0),
+            background_alpha: float = 0.0,
+            padding: int = 0,
+    ) -> Sprite:
+        """A sprite of text, on an optional translucent background box.
+
+        The sprite's origin is the text's bottom-left baseline point, like cv2.putText's org.
+        """
+        key = (text, font_face, font_scale, thickness, color, background, background_alpha, padding)
+        with self._lock:
+            sprite = self._sprites.get(key)
+            if sprite is not None:
+                self._sprites.move_to_end(key)
+                self.hits += 1
+                return sprite
+
+        sprite = _render_text(*key)
+        with self._lock:
+            self.misses += 1
+            self._sprites[key] = sprite
+            if len(self._sprites) > self.max_entries:
+                self._sprites.popitem(last=False)
+        return sprite
+
+
+def _render_text(text, font_face, font_scale, thickness, color, background, background_alpha, padding) -> Sprite:
+    (text_w, text_h), baseline = cv2.getTextSize(text, font_face, font_scale, thickness)
+    width = text_w + 2 * padding + 1
+    height = text_h + 2 * padding + 1
+    # Room for descenders / thick strokes when there's no padding to absorb them.
+    height += max(0, baseline + thickness - padding)
+    origin = (padding, padding + text_h)
+
+    rgba = np.zeros((height, width, 4), dtype=np.uint8)
+    rgba[..., :3] = background
+    rgba[..., 3] = int(round(background_alpha * 255))
+    cv2.putText(rgba, text, origin, font_face, font_scale, (*color, 255), thickness)
+    return Sprite(rgba, origin)
+
+
+# Shared by the toolkit's HUD and label drawing.
+SPRITES = SpriteCache()
@@ -0,0 +1,277 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from numpy import ndarray
+
+from control_room.toolkit_profile import PROFILER
+from control_room.toolkit_quality import QualityKnob
+
+FRAME = "frame"
+
+
+class Stage:
+    def __init__(
+            self,
+            name: str,
+            fn: Callable[..., Any],
+            inputs: Sequence[str] = (FRAME,),
+            output: str = FRAME,
+            in_place: bool = True,
+            out_spec: Optional[Callable[..., Tuple[Tuple[int, ...], Any]]] = None,
+            skip_unchanged: bool = False,
+            optional: bool = False,
+    ):
+        """A named step of an EffectGraph.
+
+        Args:
+            name: unique within the graph, shows up in logs, profiling spans and knobs
+            fn: called with the current values of inputs, positionally
+            inputs: names of the values fn reads, FRAME or outputs of earlier stages / graph.set()
+            output: name of the value fn produces, FRAME for stages drawing on the frame
+            in_place: for FRAME stages, fn draws into the frame it was given (and may return None)
+            out_spec: for stages producing a new array, called with the inputs, returns the
+                      (shape, dtype) of a graph owned buffer passed to fn as `out=`
+            skip_unchanged: keep the previous output when no input changed since the last run,
+                            not allowed for FRAME stages, which always draw on the new frame
+            optional: expose a knob letting the QualityController switch the stage off,
+                      readers then see its last output, or None if it never ran
+        """
+        if skip_unchanged and output == FRAME:
+            raise ValueError(f"stage {name}: frame stages can't skip, each frame is a new buffer")
+        self.name = name
+        self.fn = fn
+        self.inputs = tuple(inputs)
+        self.output = output
+        self.in_place = in_place and output == FRAME
+        self.out_spec = out_spec
+        self.skip_unchanged = skip_unchanged
+        self.optional = optional
+        self.enabled = True
+
+        self.runs = 0
+        self.skips = 0
+        self._last_versions: Optional[Tuple[int, ...]] = None
+
+    def _set_enabled(self, enabled: bool):
+        self.enabled = enabled
+
+
+class _BufferPool:
+    def __init__(self):
+        """Free intermediate arrays by (shape, dtype), handed from one stage to the next."""
+        self._free: Dict[Tuple[Tuple[int, ...], str], List[ndarray]] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, shape, dtype) -> ndarray:
+        with self._lock:
+            free = self._free.get((tuple(shape), np.dtype(dtype).str))
+            if free:
+                return free.pop()
+        return np.empty(shape, dtype=dtype)
+
+    def release(self, array: ndarray):
+        with self._lock:
+            self._free.setdefault((array.shape, array.dtype.str), []).append(array)
+
+
+class EffectGraph:
+    def __init__(self, stages: Sequence[Stage], max_workers: int = 2):
+        """Chain named stages into a single ndarray in, ndarray out block.
+
+        Stages run in declaration order, each sees the frame as drawn by the stages before it.
+        When compiled, the chain is split into groups:
+
+        - consecutive in-place FRAME stages are fused: they run back to back on the one
+          frame buffer, no copy or intermediate frame in between.
+        - consecutive non-FRAME stages that don't read each other's outputs are independent
+          branches, they run concurrently on a small thread pool (cv2, numpy and torch release
+          the GIL).
+
+        Arrays requested through out_spec come from a pool shared by all stages, a buffer goes
+        back to the pool once its last reader ran, unless its stage skips unchanged inputs and
+        needs it for the next frame. Frames are the exception, a stage replacing the frame gets
+        a fresh array, the returned frame may still be waiting to be published when the next
+        one comes in.
+
+        Values set with set() are versioned, stages with skip_unchanged re-run only when one
+        of their inputs got a new version. Optional stages can be switched off with their knob.
+
+        Usable anywhere a block is, e.g. draw_on_frame(frame_event, output_source, graph).
+        Stage state is shared, so one graph must process one frame at a time.
+
+        Args:
+            stages: the chain, in order
+            max_workers: threads available to independent branches
+        """
+        names = [stage.name for stage in stages]
+        if len(set(names)) != len(names):
+            raise ValueError(f"stage names must be unique: {names}")
+
+        self.stages = list(stages)
+        self._values: Dict[str, Any] = {}
+        self._versions: Dict[str, int] = {}
+        self._pool = _BufferPool()
+        self._owned: Dict[str, ndarray] = {}  # output name -> pooled buffer holding it
+        self._lock = threading.Lock()
+        self._groups = self._compile(self.stages)
+        self._last_readers = self._find_last_readers(self._groups)
+        parallel = any(kind == "parallel" for kind, _ in self._groups)
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="graph-branch") if parallel else None
+
+        knobs = [
+            QualityKnob(f"stage:{stage.name}", (True, False), stage._set_enabled)
+            for stage in self.stages if stage.optional
+        ]
+        for stage in self.stages:
+            knobs += getattr(stage.fn, "quality_knobs", [])
+        self.quality_knobs = knobs
+
+        logging.info("🕸 EffectGraph " + " → ".join(
+            f"{kind}({', '.join(stage.name for stage in group)})" for kind, group in self._groups
+        ))
+
+    @staticmethod
+    def _compile(stages: Sequence[Stage]) -> List[Tuple[str, List[Stage]]]:
+        groups: List[Tuple[str, List[Stage]]] = []
+        produced = {FRAME}
+        for stage in stages:
+            missing = [name for name in stage.inputs if name not in produced]
+            if missing:
+                # Not produced by an earlier stage, must come from graph.set().
+                logging.debug(f"stage {stage.name} reads external values {missing}")
+
+            kind = "fused" if stage.in_place else ("serial" if stage.output == FRAME else "parallel")
+            if groups and groups[-1][0] == kind == "fused":
+                groups[-1][1].append(stage)
+            elif (
+                    groups and groups[-1][0] == kind == "parallel"
+                    and not any(
+                        name in stage.inputs or name == stage.output
+                        for name in (s.output for s in groups[-1][1])
+                    )
+            ):
+                groups[-1][1].append(stage)
+            else:
+                groups.append((kind, [stage]))
+            produced.add(stage.output)
+        return groups
+
+    @staticmethod
+    def _find_last_readers(groups) -> Dict[str, str]:
+        last_readers: Dict[str, str] = {}
+        for _, group in groups:
+            for stage in group:
+                for name in stage.inputs:
+                    last_readers[name] = stage.name
+        return last_readers
+
+    def set(self, name: str, value: Any):
+        """Feed an external input, bumping its version when it differs from the current one."""
+        with self._lock:
+            current = self._values.get(name, _MISSING)
+            changed = current is _MISSING or current is not value and _differs(current, value)
+            self._values[name] = value
+            if changed:
+                self._versions[name] = self._versions.get(name, 0) + 1
+
+    def get(self, name: str) -> Any:
+        return self._values.get(name)
+
+    def _run_stage(self, stage: Stage) -> Optional[Tuple[str, Any]]:
+        """Runs stage if needed, returns (output, value) or None when skipped."""
+        if not stage.enabled:
+            return None
+        versions = tuple(self._versions.get(name, 0) for name in stage.inputs)
+        if stage.skip_unchanged and versions == stage._last_versions and stage.output in self._values:
+            stage.skips += 1
+            return None
+
+        args = [self._values.get(name) for name in stage.inputs]
+        kwargs = {}
+        if stage.out_spec is not None:
+            shape, dtype = stage.out_spec(*args)
+            previous = self._owned.get(stage.output)
+            if stage.output == FRAME:
+                kwargs["out"] = np.empty(shape, dtype=dtype)
+            elif previous is not None and previous.shape == tuple(shape) and previous.dtype == np.dtype(dtype):
+                kwargs["out"] = previous
+            else:
+                kwargs["out"] = self._pool.acquire(shape, dtype)
+
+        with PROFILER.span(f"stage:{stage.name}"):
+            result = stage.fn(*args, **kwargs)
+        if result is None and stage.in_place:
+            result = args[stage.inputs.index(FRAME)] if FRAME in stage.inputs else self._values[FRAME]
+        stage._last_versions = versions
+        stage.runs += 1
+        return stage.output, result
+
+    def _publish(self, stage: Stage, outcome: Optional[Tuple[str, Any]]):
+        if outcome is None:
+            return
+        name, value = outcome
+        owned = self._owned.get(name)
+        if owned is not None and owned is not value:
+            self._pool.release(owned)
+            del self._owned[name]
+        if stage.out_spec is not None and name != FRAME and isinstance(value, ndarray):
+            self._owned[name] = value
+        self._values[name] = value
+        # FRAME drawn in-place is still the same frame, as far as downstream caches go.
+        if not (name == FRAME and stage.in_place):
+            self._versions[name] = self._versions.get(name, 0) + 1
+
+    def _release_consumed(self, stage: Stage):
+        """Return buffers whose last reader just ran to the pool, unless their stage keeps them:
+        skip_unchanged stages reuse their output, optional ones may be switched off and leave
+        their last output to readers."""
+        for name in stage.inputs:
+            if self._last_readers.get(name) != stage.name or name not in self._owned:
+                continue
+            producer = next((s for s in self.stages if s.output == name), None)
+            if producer is not None and (producer.skip_unchanged or producer.optional):
+                continue
+            self._pool.release(self._owned.pop(name))
+            self._values.pop(name, None)
+
+    def __call__(self, np_frame: ndarray) -> ndarray:
+        self._values[FRAME] = np_frame
+        self._versions[FRAME] = self._versions.get(FRAME, 0) + 1
+
+        for kind, group in self._groups:
+            if kind == "parallel" and self._executor is not None and len(group) > 1:
+                futures = [self._executor.submit(self._run_stage, stage) for stage in group[1:]]
+                outcomes = [self._run_stage(group[0])] + [future.result() for future in futures]
+            else:
+                outcomes = []
+                for stage in group:
+                    # fused / serial stages see each other's frame, publish as we go.
+                    self._publish(stage, self._run_stage(stage))
+                    outcomes.append(None)
+
+            for stage, outcome in zip(group, outcomes):
+                self._publish(stage, outcome)
+            for stage in group:
+                self._release_consumed(stage)
+
+        return self._values[FRAME]
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_MISSING = object()
+
+
+def _differs(a: Any, b: Any) -> bool:
+    if isinstance(a, ndarray) or isinstance(b, ndarray):
+        # arrays are compared by identity, set() a new array to signal a change.
+        return True
+    try:
+        return bool(a != b)
+    except Exception:
+        return True
@@ -0,0 +1,189 @@
+import asyncio
+import contextlib
+import cProfile
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from signal import SIGUSR1, SIGUSR2
+from typing import Dict, List, Optional
+
+from control_room.toolkit_metrics import REGISTRY
+
+PROFILE_SECONDS = REGISTRY.histogram(
+    "cr_profile_seconds", "Hot path spans, recorded only while profiling is on", ("stage",)
+)
+
+_NO_SPAN = contextlib.nullcontext()
+
+
+class _StageStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+class _Span:
+    __slots__ = ("profiler", "stage", "start_time")
+
+    def __init__(self, profiler: "StageProfiler", stage: str):
+        self.profiler = profiler
+        self.stage = stage
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.profiler.record(self.stage, time.perf_counter() - self.start_time)
+        return False
+
+
+class StageProfiler:
+    def __init__(self, sample_every: int = 10, output_dir: str = "."):
+        """Opt-in hot path instrumentation, meant to be toggled at runtime with signals.
+
+        - span(stage): times a stage into PROFILE_SECONDS and a per-stage summary that gets
+          logged when profiling is switched off. Costs a single attribute check while off.
+        - sample(): wraps one frame's processing, every sample_every-th call runs under
+          cProfile, per thread, stats are merged and dumped when profiling is switched off.
+        - tracemalloc snapshots, logged as the top allocation sites and their growth.
+
+        Args:
+            sample_every: profile one frame out of this many with cProfile
+            output_dir: where .prof dumps are written
+        """
+        self.enabled = False
+        self.sample_every = sample_every
+        self.output_dir = output_dir
+        self._lock = threading.Lock()
+        self._stats: Dict[str, _StageStats] = {}
+        self._profiles: List[cProfile.Profile] = []
+        self._local = threading.local()
+        self._samples = 0
+        self._started: Optional[float] = None
+        self._memory_baseline: Optional[tracemalloc.Snapshot] = None
+
+    def span(self, stage: str):
+        """Context manager timing stage while profiling is on, a shared no-op otherwise."""
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, stage)
+
+    def record(self, stage: str, seconds: float):
+        PROFILE_SECONDS.labels(stage).observe(seconds)
+        with self._lock:
+            stats = self._stats.get(stage)
+            if stats is None:
+                stats = self._stats[stage] = _StageStats()
+            stats.add(seconds)
+
+    @contextlib.contextmanager
+    def sample(self):
+        """Runs the wrapped frame under this thread's cProfile, one frame in sample_every."""
+        if not self.enabled:
+            yield
+            return
+        with self._lock:
+            self._samples += 1
+            sampled = self._samples % self.sample_every == 0
+        if not sampled:
+            yield
+            return
+
+        profile = getattr(self._local, "profile", None)
+        if profile is None:
+            profile = self._local.profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profile)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    def start(self):
+        with self._lock:
+            self._stats.clear()
+            self._profiles.clear()
+            self._samples = 0
+        self._local = threading.local()
+        self._started = time.perf_counter()
+        self.enabled = True
+        logging.info(f"🔬 profiling on, cProfile samples 1 frame in {self.sample_every}")
+
+    def stop(self) -> Optional[str]:
+        """Switch profiling off, log the stage summary and dump merged cProfile stats.
+
+        Returns:
+            the .prof file path, if any frame got sampled
+        """
+        self.enabled = False
+        elapsed = time.perf_counter() - (self._started or time.perf_counter())
+        with self._lock:
+            stats = dict(self._stats)
+            profiles = list(self._profiles)
+
+        lines = [f"🔬 profiling off after {elapsed:.1f}s, per stage:"]
+        for stage, s in sorted(stats.items(), key=lambda item: -item[1].total):
+            lines.append(
+                f"  {stage:<20} n={s.count:<6} mean={s.total / s.count * 1000:8.3f}ms"
+                f" max={s.max * 1000:8.3f}ms total={s.total:8.3f}s"
+            )
+        logging.info("\n".join(lines))
+
+        if not profiles:
+            return None
+        merged = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            merged.add(profile)
+        path = os.path.join(self.output_dir, f"profile-{os.getpid()}-{int(time.time())}.prof")
+        merged.dump_stats(path)
+
+        out = io.StringIO()
+        merged.stream = out
+        merged.sort_stats("cumulative").print_stats(20)
+        logging.info(f"🔬 cProfile of sampled frames in {path}\n{out.getvalue()}")
+        return path
+
+    def toggle(self):
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
+
+    def toggle_tracemalloc(self, top: int = 15):
+        """First call starts tracing allocations, the next logs the top sites and stops."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            self._memory_baseline = tracemalloc.take_snapshot()
+            logging.info("🧠 tracemalloc on")
+            return
+
+        snapshot = tracemalloc.take_snapshot()
+        lines = [f"🧠 tracemalloc top {top} allocation sites:"]
+        lines += [f"  {stat}" for stat in snapshot.statistics("lineno")[:top]]
+        if self._memory_baseline is not None:
+            lines.append(f"🧠 growth since tracemalloc on:")
+            lines += [f"  {stat}" for stat in snapshot.compare_to(self._memory_baseline, "lineno")[:top]]
+        logging.info("\n".join(lines))
+        self._memory_baseline = None
+        tracemalloc.stop()
+
+
+PROFILER = StageProfiler()
+
+
+def install_profiling_signals(loop: asyncio.AbstractEventLoop, profiler: StageProfiler = PROFILER):
+    """kill -USR1 <pid> toggles spans + sampled cProfile, kill -USR2 <pid> toggles tracemalloc."""
+    loop.add_signal_handler(SIGUSR1, profiler.toggle)
+    loop.add_signal_handler(SIGUSR2, profiler.toggle_tracemalloc)
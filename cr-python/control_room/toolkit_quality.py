@@ -0,0 +1,146 @@
+import logging
+import weakref
+from typing import Any, Callable, List, Optional, Sequence
+
+from control_room.toolkit_mailbox import LatestFrameMailbox
+
+
+class QualityKnob:
+    def __init__(self, name: str, levels: Sequence[Any], apply: Callable[[Any], None]):
+        """A quality setting a processing block lets the QualityController turn down.
+
+        Blocks declare their knobs in a `quality_knobs` list attribute, the frame loopers
+        register them with their controller.
+
+        Args:
+            name: shown in logs
+            levels: values from best quality / most expensive to cheapest
+            apply: called with the new level's value whenever the level changes
+        """
+        self.name = name
+        self.levels = list(levels)
+        self.apply = apply
+        self.index = 0
+
+    @property
+    def value(self) -> Any:
+        return self.levels[self.index]
+
+    def step(self, direction: int) -> bool:
+        """Move one level cheaper (+1) or better (-1), returns False at either end."""
+        index = self.index + direction
+        if not 0 <= index < len(self.levels):
+            return False
+        self.index = index
+        self.apply(self.value)
+        logging.info(f"🎚 {self.name} -> {self.value}")
+        return True
+
+
+class QualityController:
+    def __init__(
+            self,
+            target_fps: float = 30.0,
+            knobs: Sequence[QualityKnob] = (),
+            max_skip: int = 3,
+            max_drop_rate: float = 0.2,
+            headroom: float = 0.6,
+            smoothing: float = 0.1,
+            hold: int = 30,
+    ):
+        """Keep the processing time per frame within the 1 / target_fps budget.
+
+        Each processed frame reports its processing time and its input mailbox, from which
+        a windowed drop rate is computed. One controller can serve several pipelines, frame
+        skipping and drop rates are kept per mailbox, forgotten with it. When the smoothed frame time goes over budget, or
+        too many frames get dropped, the controller turns the first knob that can still go
+        cheaper one level down. When the frame time falls under headroom * budget it restores
+        the most recently lowered knob. Every change waits `hold` frames to take effect.
+
+        Frame skipping (processing one frame in N) is the built-in knob of last resort.
+
+        Args:
+            target_fps: output frame rate to hold
+            knobs: block knobs, in the order they should be turned down
+            max_skip: highest N for frame skipping, 1 disables it
+            max_drop_rate: fraction of input frames dropped that counts as overloaded
+            headroom: fraction of the budget under which quality is restored
+            smoothing: exponential moving average weight of new samples
+            hold: frames to wait after a change before the next one
+        """
+        self.budget = 1.0 / target_fps
+        self.max_drop_rate = max_drop_rate
+        self.headroom = headroom
+        self.smoothing = smoothing
+        self.hold = hold
+
+        self.skip = 1
+        self.knobs: List[QualityKnob] = list(knobs)
+        self._skip_knob = QualityKnob("frame_skip", range(1, max(1, max_skip) + 1), self._set_skip)
+        self._lowered: List[QualityKnob] = []
+        self._frame_time: Optional[float] = None
+        self._drop_rate = 0.0
+        # mailbox -> [frames seen by should_process, received, overwritten at the last record]
+        self._mailboxes: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._frame_count = 0  # should_process() calls without a mailbox
+        self._since_change = 0
+
+    def _set_skip(self, skip: int):
+        self.skip = skip
+
+    def add_knobs(self, knobs: Sequence[QualityKnob]):
+        for knob in knobs:
+            if knob not in self.knobs:
+                self.knobs.append(knob)
+
+    @property
+    def frame_time(self) -> float:
+        return self._frame_time or 0.0
+
+    @property
+    def drop_rate(self) -> float:
+        return self._drop_rate
+
+    def _state(self, mailbox: LatestFrameMailbox) -> list:
+        state = self._mailboxes.get(mailbox)
+        if state is None:
+            state = self._mailboxes[mailbox] = [0, 0, 0]
+        return state
+
+    def should_process(self, mailbox: Optional[LatestFrameMailbox] = None) -> bool:
+        """False for the frames frame skipping leaves out, counted per mailbox."""
+        if mailbox is None:
+            self._frame_count += 1
+            return self._frame_count % self.skip == 0
+        state = self._state(mailbox)
+        state[0] += 1
+        return state[0] % self.skip == 0
+
+    def record(self, seconds: float, mailbox: Optional[LatestFrameMailbox] = None):
+        """Report one processed frame's time, and the mailbox it came from."""
+        if self._frame_time is None:
+            self._frame_time = seconds
+        else:
+            self._frame_time += self.smoothing * (seconds - self._frame_time)
+
+        if mailbox is not None:
+            state = self._state(mailbox)
+            new_received = mailbox.received - state[1]
+            if new_received > 0:
+                rate = (mailbox.overwritten - state[2]) / new_received
+                self._drop_rate += self.smoothing * (rate - self._drop_rate)
+            state[1], state[2] = mailbox.received, mailbox.overwritten
+
+        self._since_change += 1
+        if self._since_change < self.hold:
+            return
+
+        if self._frame_time > self.budget or self._drop_rate > self.max_drop_rate:
+            for knob in self.knobs + [self._skip_knob]:
+                if knob.step(+1):
+                    self._lowered.append(knob)
+                    self._since_change = 0
+                    break
+        elif self._frame_time < self.headroom * self.budget and self._lowered:
+            self._lowered.pop().step(-1)
+            self._since_change = 0
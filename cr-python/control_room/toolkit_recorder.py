@@ -0,0 +1,269 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from livekit import rtc
+from numpy import ndarray
+
+from control_room.toolkit_frame import (
+    CHANNEL_ORDER_BGR,
+    CHANNEL_ORDER_BGRA,
+    CHANNEL_ORDER_RGB,
+    CHANNEL_ORDER_RGBA,
+    FrameBuffer,
+)
+from control_room.toolkit_metrics import RECORDER_FRAMES_DROPPED, RECORDER_FRAMES_WRITTEN, RECORDER_QUEUE_DEPTH
+
+# cv2.VideoWriter wants BGR.
+_TO_BGR = {
+    CHANNEL_ORDER_RGB: cv2.COLOR_RGB2BGR,
+    CHANNEL_ORDER_RGBA: cv2.COLOR_RGBA2BGR,
+    CHANNEL_ORDER_BGRA: cv2.COLOR_BGRA2BGR,
+}
+
+DROP_DOWNSAMPLED = "downsampled"  # every other frame skipped, the queue being half full
+DROP_QUEUE_FULL = "queue_full"
+
+
+def _now_us() -> int:
+    return time.time_ns() // 1000
+
+
+class _Segment:
+    def __init__(self, path: str, writer: cv2.VideoWriter, size: Tuple[int, int]):
+        self.path = path
+        self.writer = writer
+        self.size = size
+        self.started = time.monotonic()
+        self.frames = 0
+
+
+class BackgroundRecorder:
+    def __init__(
+            self,
+            path: str,
+            fps: float = 20.0,
+            fourcc: str = "mp4v",
+            extension: str = "mp4",
+            resolution: Optional[Tuple[int, int]] = None,
+            max_queue: int = 16,
+            segment_seconds: Optional[float] = 300.0,
+            segment_bytes: Optional[int] = None,
+            channel_order: str = CHANNEL_ORDER_RGB,
+            name: Optional[str] = None,
+    ):
+        """Records frames to video files on its own thread, never blocking the caller.
+
+        write() copies the frame into a preallocated buffer and queues it, a writer thread
+        converts, encodes and writes it. When the writer falls behind, write() first keeps
+        only every other frame (queue half full), then drops frames (queue full), the
+        timestamps of frames not recorded are listed, one "<timestamp_us> <reason>" per line,
+        in a "<segment>.drops" file next to the segment they'd have been in.
+
+        Recordings are split in segments "<path>-<index>-<start time>.<extension>", a new one
+        starts after segment_seconds, once a segment reaches segment_bytes, or when the frame
+        size changes. close() finishes the current segment, it's also called at exit, an mp4
+        that isn't finished can't be played.
+
+        Args:
+            path: segment file prefix, its directory is created if missing
+            fps: frame rate written in the files, dropped frames shorten the playback
+            fourcc: codec, e.g. "mp4v", "avc1" (if OpenCV's ffmpeg has it) or "MJPG" with extension "avi"
+            extension: segment file extension
+            resolution: (width, height) frames are resized to, None records them as they come
+            max_queue: frames waiting for the writer at most, each one is a preallocated frame buffer
+            segment_seconds: segment duration, None for no time limit
+            segment_bytes: segment file size, None for no size limit
+            channel_order: channel order of the frames given to write()
+            name: metrics label, defaults to the file name of path
+        """
+        self.path = path
+        self.fps = fps
+        self.fourcc = fourcc
+        self.extension = extension
+        self.resolution = resolution
+        self.max_queue = max(2, max_queue)
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.channel_order = channel_order
+        self.name = name or os.path.basename(path)
+
+        self._queue: queue.Queue = queue.Queue()
+        self._free: Dict[Tuple[int, ...], List[ndarray]] = {}  # reusable frame buffers, by shape
+        self._allocated: Dict[Tuple[int, ...], int] = {}
+        self._free_lock = threading.Lock()
+        self._drops: List[Tuple[int, str]] = []
+        self._drops_lock = threading.Lock()
+        self._skip_next = False
+        self._segment: Optional[_Segment] = None
+        self._index = 0
+        self.closed = False
+
+        self._written = RECORDER_FRAMES_WRITTEN.labels(self.name)
+        self._downsampled = RECORDER_FRAMES_DROPPED.labels(self.name, DROP_DOWNSAMPLED)
+        self._queue_full = RECORDER_FRAMES_DROPPED.labels(self.name, DROP_QUEUE_FULL)
+        self._queue_depth = RECORDER_QUEUE_DEPTH.labels(self.name)
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name=f"recorder-{self.name}", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        logging.info(f"⏺ recording to {path}-*.{extension} ({fourcc} {fps}fps, queue {self.max_queue})")
+
+    def write(self, np_frame: ndarray, timestamp_us: Optional[int] = None, channel_order: Optional[str] = None) -> bool:
+        """Queue np_frame for recording, False if it's dropped. Cheap: one copy into a pooled buffer.
+
+        Args:
+            np_frame: (height, width, channels) uint8 frame, the caller may reuse it right away
+            timestamp_us: wall clock time of the frame, now by default
+            channel_order: overrides the recorder's channel_order for this frame
+        """
+        if self.closed:
+            return False
+        timestamp_us = timestamp_us or _now_us()
+        depth = self._queue.qsize()
+        self._queue_depth.set(depth)
+        if depth >= self.max_queue:
+            self._drop(timestamp_us, DROP_QUEUE_FULL)
+            return False
+        if depth >= self.max_queue // 2:
+            # Behind: halve the frame rate until the writer catches up.
+            self._skip_next = not self._skip_next
+            if self._skip_next:
+                self._drop(timestamp_us, DROP_DOWNSAMPLED)
+                return False
+        else:
+            self._skip_next = False
+
+        buffer = self._acquire(np_frame.shape)
+        if buffer is None:
+            self._drop(timestamp_us, DROP_QUEUE_FULL)
+            return False
+        np.copyto(buffer, np_frame)
+        self._queue.put((buffer, timestamp_us, channel_order or self.channel_order))
+        return True
+
+    def write_video_frame(self, video_frame: rtc.VideoFrame, timestamp_us: Optional[int] = None) -> bool:
+        """write() for a packed RGB24 / RGBA / BGRA VideoFrame, other buffer types are skipped."""
+        try:
+            frame_buffer = FrameBuffer(video_frame)
+        except ValueError:
+            return False
+        return self.write(frame_buffer.array, timestamp_us, frame_buffer.channel_order)
+
+    def _drop(self, timestamp_us: int, reason: str):
+        (self._queue_full if reason == DROP_QUEUE_FULL else self._downsampled).inc()
+        with self._drops_lock:
+            self._drops.append((timestamp_us, reason))
+
+    def _acquire(self, shape: Tuple[int, ...]) -> Optional[ndarray]:
+        with self._free_lock:
+            free = self._free.setdefault(shape, [])
+            if free:
+                return free.pop()
+            if self._allocated.get(shape, 0) >= self.max_queue:
+                return None
+            self._allocated[shape] = self._allocated.get(shape, 0) + 1
+        return np.empty(shape, np.uint8)
+
+    def _release(self, buffer: ndarray):
+        with self._free_lock:
+            self._free.setdefault(buffer.shape, []).append(buffer)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            buffer, timestamp_us, channel_order = item
+            try:
+                self._encode(buffer, channel_order)
+            except Exception:
+                logging.exception(f"recorder {self.name} failed to write a frame")
+            finally:
+                self._release(buffer)
+        self._finish_segment()
+
+    def _encode(self, np_frame: ndarray, channel_order: str):
+        if channel_order != CHANNEL_ORDER_BGR:
+            np_frame = cv2.cvtColor(np_frame, _TO_BGR[channel_order])
+        if self.resolution is not None and (np_frame.shape[1], np_frame.shape[0]) != tuple(self.resolution):
+            np_frame = cv2.resize(np_frame, tuple(self.resolution), interpolation=cv2.INTER_AREA)
+        size = (np_frame.shape[1], np_frame.shape[0])
+
+        segment = self._segment
+        if segment is None or segment.size != size or self._segment_full(segment):
+            self._finish_segment()
+            segment = self._start_segment(size)
+        segment.writer.write(np_frame)
+        segment.frames += 1
+        self._written.inc()
+
+    def _segment_full(self, segment: _Segment) -> bool:
+        if self.segment_seconds is not None and time.monotonic() - segment.started >= self.segment_seconds:
+            return True
+        # The file only grows as the encoder flushes, a stat once a second of video is enough.
+        if self.segment_bytes is not None and segment.frames % max(1, int(self.fps)) == 0:
+            return os.path.exists(segment.path) and os.path.getsize(segment.path) >= self.segment_bytes
+        return False
+
+    def _start_segment(self, size: Tuple[int, int]) -> _Segment:
+        self._index += 1
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = f"{self.path}-{self._index:04d}-{stamp}.{self.extension}"
+        writer = cv2.VideoWriter(path, cv2.VideoWriter.fourcc(*self.fourcc), self.fps, size)
+        if not writer.isOpened():
+            raise RuntimeError(f"can't open {path} for writing with {self.fourcc}")
+        self._segment = _Segment(path, writer, size)
+        logging.info(f"⏺ {self.name} segment {path} [{size[0]}x{size[1]}]")
+        return self._segment
+
+    def _finish_segment(self):
+        """Close the current segment, writing the drops that happened while it was open next to it."""
+        with self._drops_lock:
+            drops, self._drops = self._drops, []
+        segment = self._segment
+        if segment is None:
+            if drops:
+                # Nothing recorded yet, the drops go with the next segment.
+                with self._drops_lock:
+                    self._drops = drops + self._drops
+            return
+        segment.writer.release()
+        self._segment = None
+        if drops:
+            with open(f"{segment.path}.drops", "w") as file:
+                file.writelines(f"{timestamp_us} {reason}\n" for timestamp_us, reason in drops)
+        logging.info(f"⏺ {self.name} segment {segment.path} done, {segment.frames} frames, {len(drops)} dropped")
+
+    def close(self, timeout: float = 10.0):
+        """Record what's queued, finish the current segment and stop the writer thread."""
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+
+class RecordingVideoSource(rtc.VideoSource):
+    def __init__(self, width: int, height: int, recorder: BackgroundRecorder):
+        """A VideoSource also handing every captured frame to recorder, as published.
+
+        Use it in place of the output rtc.VideoSource, the loopers do when given a recorder.
+        """
+        super().__init__(width, height)
+        self.recorder = recorder
+
+    def capture_frame(self, frame: rtc.VideoFrame, **kwargs) -> None:
+        self.recorder.write_video_frame(frame)
+        super().capture_frame(frame, **kwargs)
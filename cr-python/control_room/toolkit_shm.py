@@ -0,0 +1,354 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from numpy import ndarray
+
+from control_room.toolkit_frame import CHANNEL_ORDER_BGRA, CHANNEL_ORDER_RGB, CHANNEL_ORDER_RGBA
+
+# Slot header format field, index into this.
+SLOT_FORMATS = (CHANNEL_ORDER_RGB, CHANNEL_ORDER_RGBA, CHANNEL_ORDER_BGRA)
+
+_RING_MAGIC = 0x43524652  # "CRFR"
+_RING_HEADER = np.dtype([("magic", "<u4"), ("slots", "<u4"), ("slot_bytes", "<u8")])
+SLOT_HEADER = np.dtype([
+    ("seq", "<u8"),  # written last by the writer, 0 while a slot is being (re)written
+    ("timestamp_us", "<i8"),
+    ("width", "<u4"),
+    ("height", "<u4"),
+    ("channels", "<u4"),
+    ("format", "<u4"),
+])
+_ALIGN = 64  # slot data starts on a cache line
+
+
+def _aligned(size: int) -> int:
+    return (size + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+class SharedFrameRing:
+    def __init__(
+            self,
+            slots: int = 4,
+            width: Optional[int] = None,
+            height: Optional[int] = None,
+            channels: int = 3,
+            name: Optional[str] = None,
+            create: bool = True,
+    ):
+        """Fixed size frame slots in one shared memory block, readable and writable as numpy views.
+
+        Layout: a ring header (magic, slot count, slot data size), then per slot a small header
+        (seq, timestamp_us, width, height, channels, format) padded to a cache line, then the
+        slot's pixels. Slots hold up to width x height x channels bytes, any smaller frame fits.
+
+        Handoff between processes is by sequence number: the writer fills a slot, stamps its
+        header with a fresh seq and sends (slot, seq) over a queue, the reader checks the header
+        still carries that seq before trusting the pixels. Which process owns a slot at a given
+        time is up to the user, see SharedMemoryWorkers.
+
+        Args:
+            slots: number of frames held at once
+            width, height: largest frame, default to OUTPUT_WIDTH / OUTPUT_HEIGHT
+            channels: largest channel count, 3 for RGB24
+            name: shared memory block name, generated when creating
+            create: create the block, or attach to an existing one by name (see attach())
+        """
+        if create:
+            width = width or int(os.getenv("OUTPUT_WIDTH") or 1024)
+            height = height or int(os.getenv("OUTPUT_HEIGHT") or 768)
+            slot_bytes = width * height * channels
+            stride = _aligned(SLOT_HEADER.itemsize) + _aligned(slot_bytes)
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=_ALIGN + slots * stride)
+            header = np.ndarray((), _RING_HEADER, buffer=self.shm.buf)
+            header["magic"], header["slots"], header["slot_bytes"] = _RING_MAGIC, slots, slot_bytes
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            header = np.ndarray((), _RING_HEADER, buffer=self.shm.buf)
+            if header["magic"] != _RING_MAGIC:
+                raise ValueError(f"shared memory {name} is not a frame ring")
+
+        self.owner = create
+        self.slots = int(header["slots"])
+        self.slot_bytes = int(header["slot_bytes"])
+        self._data_offset = _aligned(SLOT_HEADER.itemsize)
+        self._stride = self._data_offset + _aligned(self.slot_bytes)
+        self._headers = [
+            np.ndarray((), SLOT_HEADER, buffer=self.shm.buf, offset=_ALIGN + i * self._stride)
+            for i in range(self.slots)
+        ]
+
+    @classmethod
+    def attach(cls, name: str) -> "SharedFrameRing":
+        return cls(name=name, create=False)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def fits(self, np_frame: ndarray) -> bool:
+        return np_frame.dtype == np.uint8 and np_frame.nbytes <= self.slot_bytes
+
+    def header(self, slot: int) -> np.ndarray:
+        """The slot's header, a writable 0-d structured array view."""
+        return self._headers[slot]
+
+    def view(self, slot: int, shape: Optional[Tuple[int, int, int]] = None) -> ndarray:
+        """Writable (height, width, channels) uint8 view of the slot, shaped by its header by default."""
+        if shape is None:
+            header = self._headers[slot]
+            shape = (int(header["height"]), int(header["width"]), int(header["channels"]))
+        offset = _ALIGN + slot * self._stride + self._data_offset
+        return np.ndarray(shape, np.uint8, buffer=self.shm.buf, offset=offset)
+
+    def write(
+            self,
+            slot: int,
+            np_frame: ndarray,
+            seq: int,
+            timestamp_us: int = 0,
+            channel_order: str = CHANNEL_ORDER_RGB,
+    ) -> ndarray:
+        """Copy np_frame into slot, unless it's already the slot's view, stamp the header, return the view."""
+        if not self.fits(np_frame):
+            raise ValueError(f"{np_frame.shape} {np_frame.dtype} frame doesn't fit {self.slot_bytes} byte slots")
+        header = self._headers[slot]
+        header["seq"] = 0  # readers holding an older seq now know the pixels are changing
+        view = self.view(slot, np_frame.shape)
+        if not np.shares_memory(view, np_frame):
+            np.copyto(view, np_frame)
+        height, width, channels = np_frame.shape
+        header["timestamp_us"] = timestamp_us
+        header["width"], header["height"], header["channels"] = width, height, channels
+        header["format"] = SLOT_FORMATS.index(channel_order)
+        header["seq"] = seq
+        return view
+
+    def read(self, slot: int, seq: int) -> Optional[ndarray]:
+        """The slot's view if it still holds frame seq, None if it's been rewritten since."""
+        if int(self._headers[slot]["seq"]) != seq:
+            return None
+        return self.view(slot)
+
+    def close(self):
+        """Detach, and free the block if we created it. Views must not be used afterwards."""
+        self._headers = []
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _worker_main(ring_name: str, block: Callable[[ndarray], ndarray], tasks, results):
+    """Worker process loop: run block on the slots it's handed, write results back into the slot."""
+    # Spawned workers share the parent's resource tracker, attaching registers the block with
+    # it again, a no-op: the parent's unlink() unregisters it, once.
+    ring = SharedFrameRing.attach(ring_name)
+
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            slot, seq = task
+            frame = ring.read(slot, seq)
+            if frame is None:
+                results.put((slot, seq, "slot overwritten before processing"))
+                continue
+            try:
+                new_frame = block(frame)
+                # None or the slot's own view: drawn in-place, nothing to copy.
+                if new_frame is not None and not np.shares_memory(new_frame, frame):
+                    ring.write(slot, np.ascontiguousarray(new_frame), seq, int(ring.header(slot)["timestamp_us"]))
+                results.put((slot, seq, None))
+            except Exception as e:
+                results.put((slot, seq, f"{type(e).__name__}: {e}"))
+    finally:
+        ring.close()
+
+
+class SharedMemoryWorkers:
+    def __init__(
+            self,
+            block: Callable[[ndarray], ndarray],
+            workers: int = 2,
+            slots: Optional[int] = None,
+            width: Optional[int] = None,
+            height: Optional[int] = None,
+            channels: int = 3,
+    ):
+        """Worker processes running block on frames passed through a SharedFrameRing.
+
+        Submitting copies the frame into a free slot, once, and sends the (slot, seq) pair to the
+        workers, the block runs on a view of the slot and writes its result back into it. The
+        returned future resolves to a view of the slot, valid until release() is called with it.
+        Frames never get pickled.
+
+        A slot is only reused once no worker can touch it anymore. When a worker dies, which
+        frames it had taken can't be told for sure (its last messages may never have left it),
+        so the whole generation of workers is replaced: the others are terminated, the queues
+        recreated, and every frame submitted to them failed and its slot freed.
+
+        Args:
+            block: picklable, module level ndarray in, ndarray out block, returning None or its
+                   input when drawing in-place, results must fit the slots
+            workers: worker processes
+            slots: frames in flight at most, defaults to workers + 1
+            width, height, channels: slot size, width and height default to OUTPUT_WIDTH / OUTPUT_HEIGHT
+        """
+        self.slots = slots or workers + 1
+        self.ring = SharedFrameRing(self.slots, width, height, channels)
+        # spawn: forking a process running livekit's FFI threads and an event loop isn't safe.
+        context = multiprocessing.get_context("spawn")
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._block = block
+        self._context = context
+        self.workers = workers
+        self._processes: List[multiprocessing.Process] = []
+        try:
+            for _ in range(workers):
+                self._processes.append(self._spawn())
+        except BaseException:
+            # e.g. from a daemonic process, which can't have children: don't leak the block.
+            for process in self._processes:
+                process.terminate()
+            self.ring.close()
+            raise
+
+        self._free: List[int] = list(range(self.slots))
+        self._seq = 0
+        self._generation = 0  # of the worker processes and queues, bumped when they're replaced
+        self._lock = threading.Lock()  # submitting vs replacing the workers
+        self._pending: Dict[int, Tuple[int, asyncio.Future, int]] = {}  # seq -> slot, future, generation
+        self._held: Dict[asyncio.Future, int] = {}  # resolved futures -> slot, until release()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._closed = False
+        self._reader = threading.Thread(target=self._read_results, name="shm-results", daemon=True)
+        self._reader.start()
+        logging.info(
+            f"🧠 SharedMemoryWorkers workers={workers} slots={self.slots} x {self.ring.slot_bytes} bytes"
+            f" in {self.ring.name}"
+        )
+
+    def _spawn(self) -> multiprocessing.Process:
+        process = self._context.Process(
+            target=_worker_main, args=(self.ring.name, self._block, self._tasks, self._results), daemon=True
+        )
+        process.start()
+        return process
+
+    def fits(self, np_frame: ndarray) -> bool:
+        return self.ring.fits(np_frame)
+
+    @property
+    def available(self) -> int:
+        """Free slots, submit() fails when there are none."""
+        return len(self._free)
+
+    def submit(self, np_frame: ndarray, timestamp_us: int = 0) -> asyncio.Future:
+        self._loop = asyncio.get_running_loop()
+        future = self._loop.create_future()
+        if not self._free:
+            future.set_exception(RuntimeError(f"all {self.slots} shared memory slots are in use"))
+            return future
+        slot = self._free.pop()
+        self._seq += 1
+        self.ring.write(slot, np_frame, self._seq, timestamp_us)
+        with self._lock:
+            self._pending[self._seq] = (slot, future, self._generation)
+            self._tasks.put((slot, self._seq))
+        return future
+
+    def release(self, future: asyncio.Future):
+        """Hand the slot behind future back, once its view has been consumed (published)."""
+        slot = self._held.pop(future, None)
+        if slot is not None:
+            self._free.append(slot)
+
+    def _resolve(self, slot: int, seq: int, error: Optional[str]):
+        entry = self._pending.pop(seq, None)
+        if entry is None:
+            return
+        _, future, _ = entry
+        if future.cancelled():
+            self._free.append(slot)
+        elif error is not None:
+            self._free.append(slot)
+            future.set_exception(RuntimeError(f"shared memory worker failed: {error}"))
+        else:
+            self._held[future] = slot
+            future.set_result(self.ring.view(slot))
+
+    def _fail_pending(self, reason: str, generation: Optional[int] = None):
+        """Fail the pending frames of generation and older, all by default, and free their slots.
+
+        Only once no worker can touch them anymore: the processes they were sent to are gone.
+        """
+        for seq, (slot, _, submitted) in list(self._pending.items()):
+            if generation is None or submitted <= generation:
+                self._resolve(slot, seq, reason)
+
+    def _read_results(self):
+        checked = time.monotonic()
+        while not self._closed:
+            # Also when results keep coming: a busy ring is when a dead worker hurts most.
+            if time.monotonic() - checked >= 1.0:
+                checked = time.monotonic()
+                self._check_workers()
+            try:
+                slot, seq, error = self._results.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                if self._closed:
+                    return
+                continue  # the queue was replaced along with the workers
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._resolve, slot, seq, error)
+
+    def _check_workers(self):
+        """Replace every worker when one died, fail the frames submitted to them and free those slots."""
+        dead = [p for p in self._processes if not p.is_alive()]
+        if not dead or self._closed:
+            return
+        logging.warning(f"💥 {len(dead)} shared memory worker(s) died, restarting all {self.workers}")
+        with self._lock:
+            # Terminating a process may leave a queue it shares corrupted, the queues go too.
+            for process in self._processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join(timeout=5.0)
+            for old in (self._tasks, self._results):
+                old.cancel_join_thread()
+                old.close()
+            self._tasks = self._context.Queue()
+            self._results = self._context.Queue()
+            generation = self._generation
+            self._generation += 1
+        self._processes = [self._spawn() for _ in range(self.workers)]
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._fail_pending, "shared memory worker died", generation)
+
+    def shutdown(self, wait: bool = False):
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._processes:
+            self._tasks.put(None)
+        if wait:
+            for process in self._processes:
+                process.join(timeout=5.0)
+        for process in self._processes:
+            if process.is_alive():
+                process.terminate()
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._fail_pending, "shut down")
+        self._reader.join(timeout=2.0)
+        self.ring.close()
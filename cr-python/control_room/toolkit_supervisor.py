@@ -0,0 +1,318 @@
+"""
+Run several agent worker processes on one host, behind one supervisor.
+
+Each worker is a plain agent script (anything going through loop_on), started with:
+- its own room, or its share of a room's participants (CR_SHARD="index/count"), every
+  toolkit looper only subscribes to its share's tracks (see toolkit.subscribe_by_shard),
+- a core set it's pinned to (sched_setaffinity) and matching torch / OpenMP / OpenCV thread counts,
+- config.json overrides (CR_CONFIG_OVERRIDES), e.g. its own metrics_file.
+
+Crashed workers are restarted with an exponential backoff, the workers' metrics files are
+merged, with a worker label, and served / written by the supervisor.
+
+    python -m control_room.toolkit_supervisor agent/background_remover.py --rooms room-a,room-b --shards 4
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import time
+import zlib
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from control_room.toolkit_metrics import MetricsRegistry, export_metrics, serve_metrics
+
+SHARD_ENV = "CR_SHARD"  # "index/count", the participants this worker handles in its room
+OVERRIDES_ENV = "CR_CONFIG_OVERRIDES"  # JSON object merged over config.json
+THREADS_ENV = "CR_THREADS"  # compute threads for torch / OpenCV
+
+
+def worker_shard() -> Optional[Tuple[int, int]]:
+    """(index, count) of this worker's share of its room, None when it handles everyone."""
+    shard = os.getenv(SHARD_ENV)
+    if not shard:
+        return None
+    index, count = (int(part) for part in shard.split("/"))
+    return (index, count) if count > 1 else None
+
+
+def owns_participant(identity: str, shard: Optional[Tuple[int, int]]) -> bool:
+    """Stable participant to shard assignment, every worker of a room agrees without talking."""
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(identity.encode()) % count == index
+
+
+def config_overrides() -> dict:
+    overrides = os.getenv(OVERRIDES_ENV)
+    return json.loads(overrides) if overrides else {}
+
+
+def configure_worker_threads():
+    """Apply CR_THREADS to OpenCV and torch, if torch is loaded (it reads OMP_NUM_THREADS otherwise)."""
+    threads = os.getenv(THREADS_ENV)
+    if not threads:
+        return
+    import cv2
+
+    cv2.setNumThreads(int(threads))
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(int(threads))
+
+
+class WorkerSpec:
+    def __init__(
+            self,
+            index: int,
+            room: str,
+            shard: Tuple[int, int],
+            cores: Sequence[int],
+            threads: int,
+            metrics_file: str,
+    ):
+        """What one worker process runs on and for.
+
+        Args:
+            index: worker number, also its metrics label
+            room: room it joins
+            shard: (index, count) share of the room's participants it handles
+            cores: CPUs it's pinned to
+            threads: compute threads it's allowed, usually len(cores)
+            metrics_file: where it exports its metrics
+        """
+        self.index = index
+        self.room = room
+        self.shard = shard
+        self.cores = list(cores)
+        self.threads = threads
+        self.metrics_file = metrics_file
+
+    def env(self) -> Dict[str, str]:
+        env = dict(os.environ)
+        threads = str(self.threads)
+        env.update({
+            SHARD_ENV: f"{self.shard[0]}/{self.shard[1]}",
+            THREADS_ENV: threads,
+            "OMP_NUM_THREADS": threads,
+            "MKL_NUM_THREADS": threads,
+            "OPENBLAS_NUM_THREADS": threads,
+            OVERRIDES_ENV: json.dumps({
+                **config_overrides(),
+                "target_room_name": self.room,
+                "metrics_file": self.metrics_file,
+                "metrics_port": None,
+                "intra_op_threads": self.threads,
+                "inter_op_threads": 1,
+            }),
+        })
+        return env
+
+
+def plan_workers(
+        rooms: Sequence[str],
+        shards: int,
+        cores: Sequence[int],
+        metrics_dir: str,
+) -> List[WorkerSpec]:
+    """shards workers per room, the cores split evenly between all of them."""
+    count = len(rooms) * shards
+    if count > len(cores):
+        raise ValueError(f"{count} workers for {len(cores)} cores, lower --shards or pass fewer rooms")
+    per_worker = len(cores) // count
+    specs = []
+    for room_index, room in enumerate(rooms):
+        for shard in range(shards):
+            index = room_index * shards + shard
+            worker_cores = cores[index * per_worker:(index + 1) * per_worker]
+            specs.append(WorkerSpec(
+                index, room, (shard, shards), worker_cores, len(worker_cores),
+                os.path.join(metrics_dir, f"worker-{index}.prom"),
+            ))
+    return specs
+
+
+class WorkerMetrics(MetricsRegistry):
+    def __init__(self, specs: Sequence[WorkerSpec]):
+        """The supervisor's own metrics, followed by every worker's metrics file with a worker label.
+
+        Samples are regrouped per metric family, the exposition format wants them together.
+        """
+        super().__init__()
+        self.specs = specs
+
+    def render(self) -> str:
+        families: Dict[str, List[str]] = {}
+        headers: Dict[str, List[str]] = {}
+        for spec in self.specs:
+            try:
+                with open(spec.metrics_file) as file:
+                    text = file.read()
+            except FileNotFoundError:
+                continue
+            family = None
+            for line in text.splitlines():
+                if line.startswith("# "):
+                    family = line.split()[2]
+                    if family not in headers:
+                        headers[family] = []
+                    if len(headers[family]) < 2:
+                        headers[family].append(line)
+                    families.setdefault(family, [])
+                elif line and family is not None:
+                    families[family].append(_with_label(line, "worker", str(spec.index)))
+
+        lines = [super().render().rstrip("\n")]
+        for family, samples in families.items():
+            lines += headers[family] + samples
+        return "\n".join(lines) + "\n"
+
+
+def _with_label(sample: str, name: str, value: str) -> str:
+    metric, rest = sample.split(" ", 1)
+    if "{" in metric:
+        return metric.replace("{", f'{{{name}="{value}",', 1) + " " + rest
+    return f'{metric}{{{name}="{value}"}} {rest}'
+
+
+class Worker:
+    def __init__(self, spec: WorkerSpec):
+        self.spec = spec
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.started = 0.0
+        self.failures = 0  # consecutive short-lived runs
+
+
+class Supervisor:
+    def __init__(
+            self,
+            script: str,
+            specs: Sequence[WorkerSpec],
+            backoff: float = 1.0,
+            max_backoff: float = 60.0,
+            stable_after: float = 60.0,
+    ):
+        """Start one process per spec running script, restart them when they exit, until stopped.
+
+        Args:
+            script: agent script path or module, run as a module of the current directory
+            specs: the workers, see plan_workers()
+            backoff: delay before restarting a worker that crashed right after starting
+            max_backoff: delay cap, the delay doubles with each consecutive quick crash
+            stable_after: a worker that ran this long gets restarted right away
+        """
+        self.module = script[:-3].replace(os.sep, ".") if script.endswith(".py") else script
+        self.workers = [Worker(spec) for spec in specs]
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.metrics = WorkerMetrics(specs)
+        self._up = self.metrics.gauge("cr_worker_up", "Worker process running", ("worker",))
+        self._restarts = self.metrics.counter("cr_worker_restarts_total", "Worker process restarts", ("worker",))
+        self._stopping = asyncio.Event()
+
+    async def _start(self, worker: Worker):
+        spec = worker.spec
+        # A dead worker's last numbers must not be served as if it were alive.
+        if os.path.exists(spec.metrics_file):
+            os.remove(spec.metrics_file)
+        worker.process = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", self.module,
+            env=spec.env(),
+            # Pinned before the interpreter starts, every thread it creates inherits the core set.
+            preexec_fn=lambda: os.sched_setaffinity(0, spec.cores),
+        )
+        worker.started = time.monotonic()
+        self._up.labels(str(spec.index)).set(1)
+        logging.info(
+            f"👷 worker {spec.index} pid={worker.process.pid} room={spec.room}"
+            f" shard={spec.shard[0]}/{spec.shard[1]} cores={spec.cores}"
+        )
+
+    async def _watch(self, worker: Worker):
+        while not self._stopping.is_set():
+            await self._start(worker)
+            code = await worker.process.wait()
+            self._up.labels(str(worker.spec.index)).set(0)
+            if self._stopping.is_set():
+                return
+
+            if time.monotonic() - worker.started >= self.stable_after:
+                worker.failures = 0
+            delay = 0.0 if worker.failures == 0 else min(self.max_backoff, self.backoff * 2 ** (worker.failures - 1))
+            worker.failures += 1
+            self._restarts.labels(str(worker.spec.index)).inc()
+            logging.warning(f"💥 worker {worker.spec.index} exited with {code}, restarting in {delay:.0f}s")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self, timeout: float = 10.0):
+        """SIGTERM every worker (loop_on disconnects cleanly on it), SIGKILL those still there after timeout."""
+        self._stopping.set()
+        running = [w.process for w in self.workers if w.process is not None and w.process.returncode is None]
+        for process in running:
+            process.terminate()
+        if running:
+            await asyncio.wait([asyncio.ensure_future(p.wait()) for p in running], timeout=timeout)
+            for process in running:
+                if process.returncode is None:
+                    process.kill()
+
+    async def run(self, metrics_port: Optional[int] = None, metrics_file: Optional[str] = None):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, lambda: asyncio.ensure_future(self.stop()))
+
+        exports = []
+        if metrics_port:
+            exports.append(asyncio.ensure_future(serve_metrics(metrics_port, registry=self.metrics)))
+        if metrics_file:
+            exports.append(asyncio.ensure_future(export_metrics(metrics_file, registry=self.metrics)))
+
+        await asyncio.gather(*(self._watch(worker) for worker in self.workers))
+        for export in exports:
+            export.cancel()
+
+
+def parse_cores(text: Optional[str]) -> List[int]:
+    """"0-7,16-23" -> [0..7, 16..23], defaults to the cores this process may run on."""
+    if not text:
+        return sorted(os.sched_getaffinity(0))
+    cores = []
+    for part in text.split(","):
+        start, _, end = part.partition("-")
+        cores += range(int(start), int(end or start) + 1)
+    return cores
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run several agent workers on this host.")
+    parser.add_argument("script", help="agent script, e.g. agent/background_remover.py")
+    parser.add_argument("--rooms", default=None, help="comma separated, defaults to config.json's room")
+    parser.add_argument("--shards", type=int, default=1, help="workers per room, splitting its participants")
+    parser.add_argument("--cores", default=None, help='cores to use, e.g. "0-15", defaults to all available')
+    parser.add_argument("--metrics-dir", default="metrics", help="where workers write their metrics")
+    parser.add_argument("--metrics-port", type=int, default=None, help="serve merged metrics on this port")
+    parser.add_argument("--metrics-file", default=None, help="write merged metrics to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.rooms:
+        rooms = args.rooms.split(",")
+    else:
+        with open("config.json") as file:
+            rooms = [json.load(file)["target_room_name"]]
+
+    os.makedirs(args.metrics_dir, exist_ok=True)
+    specs = plan_workers(rooms, args.shards, parse_cores(args.cores), args.metrics_dir)
+    supervisor = Supervisor(args.script, specs)
+    asyncio.run(supervisor.run(args.metrics_port, args.metrics_file))
+
+
+if __name__ == "__main__":
+    main()
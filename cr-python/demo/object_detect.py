@@ -0,0 +1,40 @@
+import logging
+import os
+
+from livekit import rtc
+
+from control_room.toolkit import load_config, loop_on, first_track_queued_frame_looper
+from control_room.toolkit_draw import PerfDecorator
+from control_room.toolkit_executor import EXECUTOR_THREAD
+from control_room.toolkit_object_detect import DetectionStage, DnnDetector, DNN_SSD
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    # ensure LIVEKIT_URL, LIVEKIT_API_KEY, and LIVEKIT_API_SECRET are set
+    loaded_config = load_config()
+
+    # e.g. an SSD MobileNet or YOLO .onnx, labels one per line
+    model_path = os.environ["DETECTOR_MODEL"]
+    labels_path = os.environ.get("DETECTOR_LABELS")
+    labels = open(labels_path).read().splitlines() if labels_path else None
+
+    detector = DnnDetector(
+        model_path,
+        labels=labels,
+        output_format=os.environ.get("DETECTOR_FORMAT", DNN_SSD),
+    )
+    # Full detection on one frame in 5, on its own thread, boxes extrapolated in between.
+    detection = DetectionStage(detector, every=5)
+
+    async def main(room: rtc.Room):
+        return await first_track_queued_frame_looper(
+            room=room,
+            lk_id="object_detect",
+            lk_name="Object Detection",
+            block=PerfDecorator(detection),
+            executor_mode=EXECUTOR_THREAD,
+            max_workers=1)
+
+    loop_on(main)
@@ -7,17 +7,17 @@ from livekit.rtc import VideoFrameEvent
 from control_room.toolkit import load_config, loop_on, first_track_queued_frame_looper
 from control_room.toolkit_draw import draw_red_dot, PerfDecorator, draw_on_frame
 
-logging.basicConfig(level=logging.INFO)
-
-# ensure LIVEKIT_URL, LIVEKIT_API_KEY, and LIVEKIT_API_SECRET are set
-loaded_config = load_config()
-
 WIDTH, HEIGHT = 1024, 768
 
 tasks = set()
 
 # TODO: Not functional.
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    # ensure LIVEKIT_URL, LIVEKIT_API_KEY, and LIVEKIT_API_SECRET are set
+    loaded_config = load_config()
+
     async def main(room: rtc.Room):
 
         perf_decorator = PerfDecorator(draw_red_dot)
@@ -1,28 +1,25 @@
 import cv2
 import cv2 as cv
 
+from control_room.toolkit import build_recoder
+from control_room.toolkit_frame import CHANNEL_ORDER_BGR
+
 # video capture
 vc = cv.VideoCapture(1)
-# video writer
-video_filename = 'webcam.mp4'
-frame_rate = vc.get(cv2.CAP_PROP_FPS)
-frame_size = (int(vc.get(cv2.CAP_PROP_FRAME_WIDTH)), int(vc.get(cv2.CAP_PROP_FRAME_HEIGHT)))
-fourcc = cv.VideoWriter.fourcc(*'mp4v')
-vw = cv.VideoWriter(
-    video_filename,
-    fourcc,
-    frame_rate,
-    frame_size
-)
+# video recorder, encodes on its own thread so the preview loop doesn't wait on it
+frame_rate = vc.get(cv2.CAP_PROP_FPS) or 30.0
+recorder = build_recoder("webcam", frame_rate, resolution=None, channel_order=CHANNEL_ORDER_BGR)
 
-print(f"    {video_filename},; {fourcc},; {frame_rate},; {frame_size} ")
+print(f"    webcam-*.mp4,; {frame_rate},; {int(vc.get(cv2.CAP_PROP_FRAME_WIDTH))}x{int(vc.get(cv2.CAP_PROP_FRAME_HEIGHT))} ")
 while True:
-    _, frame = vc.read()
-    vw.write(frame)
+    ok, frame = vc.read()
+    if not ok:
+        break
+    recorder.write(frame)
     cv.imshow('', frame)
     if cv.waitKey(1) == ord('q'):
         break
 
 vc.release()
-vw.release()
-cv.destroyAllWindows()
\ No newline at end of file
+recorder.close()
+cv.destroyAllWindows()